@@ -1,165 +1,316 @@
 from datetime import date, timedelta
-from typing import List, Dict, Any, Optional, Literal
-from sqlalchemy import select, func
+from typing import List, Dict, Any, Optional, Literal, Sequence, Union
+from sqlalchemy import BigInteger, Float, cast, select, func, literal_column, or_, text, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from .models import SalesDaily, Warehouse
+from .models import SalesDaily, SalesMonthly, SalesYearly, Warehouse
+from .ms_client import BASE as MS_BASE
+from .period_rollup import split_range
 
-def get_revenue_daily(session: Session, days: int = 60) -> List[Dict[str, Any]]:
+# деньги суммируются и приводятся к float8 в БД: драйвер отдаёт готовые float, без Decimal -> float в Python
+def _money(expr):
+    return cast(func.coalesce(expr, 0), Float)
+
+def _pct(part, whole):
+    return cast(func.coalesce(part * 100.0 / func.nullif(whole, 0), 0), Float)
+
+def series_rows(rows, columns: bool = False):
+    """Строки запроса -> [{"date": .., "revenue": ..}, ..] или колонками {"date": [..], "revenue": [..]}."""
+    if not columns:
+        return [r._asdict() for r in rows]
+    keys = list(rows[0]._fields) if rows else []
+    return {k: list(col) for k, col in zip(keys, zip(*rows))}
+
+def _daily_stmt(days: int, *cols):
     start = date.today() - timedelta(days=days)
-    stmt = (
-        select(
-            SalesDaily.date,
-            Warehouse.name.label("warehouse"),
-            func.sum(SalesDaily.revenue).label("revenue"),
-            func.sum(SalesDaily.receipts_count).label("receipts"),
-        )
+    return (
+        select(SalesDaily.date, Warehouse.name.label("warehouse"), *cols)
         .join(Warehouse, Warehouse.id == SalesDaily.warehouse_id)
         .where(SalesDaily.date >= start)
         .group_by(SalesDaily.date, Warehouse.name)
         .order_by(SalesDaily.date.asc(), Warehouse.name.asc())
     )
-    rows = session.execute(stmt).fetchall()
-    return [
-        {
-            "date": r.date.isoformat(),
-            "warehouse": r.warehouse,
-            "revenue": float(r.revenue or 0),
-            "receipts": int(r.receipts or 0),
-        }
-        for r in rows
-    ]
 
-def get_margin_daily(session: Session, days: int = 60) -> List[Dict[str, Any]]:
-    start = date.today() - timedelta(days=days)
+# Запросы для API. У каждого get_* есть async-вариант get_*_async(AsyncSession, ...) для async-роутов:
+# запрос (*_stmt) и разбор результата общие, различается только session.execute.
+
+def _revenue_daily_stmt(days: int):
+    return _daily_stmt(
+        days,
+        _money(func.sum(SalesDaily.revenue)).label("revenue"),
+        cast(func.coalesce(func.sum(SalesDaily.receipts_count), 0), BigInteger).label("receipts"),
+    )
+
+def _margin_daily_stmt(days: int):
+    revenue = func.sum(SalesDaily.revenue)
+    gross_profit = func.sum(SalesDaily.revenue - SalesDaily.cost)
+    return _daily_stmt(
+        days,
+        _money(revenue).label("revenue"),
+        _money(func.sum(SalesDaily.cost)).label("cost"),
+        _money(func.sum(SalesDaily.discount)).label("discount"),
+        _money(gross_profit).label("gross_profit"),
+        _pct(gross_profit, revenue).label("margin_pct"),
+    )
+
+def _inflow_daily_stmt(days: int):
+    return _daily_stmt(days, _money(func.sum(SalesDaily.inflow_cost)).label("inflow"))
+
+def get_revenue_daily(session: Session, days: int = 60, columns: bool = False):
+    return series_rows(session.execute(_revenue_daily_stmt(days)).fetchall(), columns)
+
+async def get_revenue_daily_async(session: AsyncSession, days: int = 60, columns: bool = False):
+    return series_rows((await session.execute(_revenue_daily_stmt(days))).fetchall(), columns)
+
+def get_margin_daily(session: Session, days: int = 60, columns: bool = False):
+    return series_rows(session.execute(_margin_daily_stmt(days)).fetchall(), columns)
+
+async def get_margin_daily_async(session: AsyncSession, days: int = 60, columns: bool = False):
+    return series_rows((await session.execute(_margin_daily_stmt(days))).fetchall(), columns)
+
+def get_inflow_daily(session: Session, days: int = 60, columns: bool = False):
+    return series_rows(session.execute(_inflow_daily_stmt(days)).fetchall(), columns)
+
+async def get_inflow_daily_async(session: AsyncSession, days: int = 60, columns: bool = False):
+    return series_rows((await session.execute(_inflow_daily_stmt(days))).fetchall(), columns)
+
+def _writeoff_daily_stmt(start: date, end: date, warehouse_id: Optional[int]):
+    """Списания по дням и складам: total / defect / inventory / other + доли от total в процентах."""
+    total = func.sum(SalesDaily.writeoff_cost_total)
+    defect = func.sum(SalesDaily.writeoff_cost_defect)
+    inventory = func.sum(SalesDaily.writeoff_cost_inventory)
+    other = func.sum(SalesDaily.writeoff_cost_other)
     stmt = (
         select(
-            SalesDaily.date,
+            SalesDaily.date.label("date"),
             Warehouse.name.label("warehouse"),
-            func.sum(SalesDaily.revenue).label("revenue"),
-            func.sum(SalesDaily.cost).label("cost"),
-            func.sum(SalesDaily.discount).label("discount"),
-            func.sum(SalesDaily.revenue - SalesDaily.cost).label("gross_profit"),
+            _money(total).label("total"),
+            _money(defect).label("defect"),
+            _money(inventory).label("inventory"),
+            _money(other).label("other"),
+            _pct(defect, total).label("defect_pct"),
+            _pct(inventory, total).label("inventory_pct"),
+            _pct(other, total).label("other_pct"),
         )
         .join(Warehouse, Warehouse.id == SalesDaily.warehouse_id)
-        .where(SalesDaily.date >= start)
+        .where(SalesDaily.date >= start, SalesDaily.date <= end)
         .group_by(SalesDaily.date, Warehouse.name)
         .order_by(SalesDaily.date.asc(), Warehouse.name.asc())
     )
-    rows = session.execute(stmt).fetchall()
-    out = []
-    for r in rows:
-        revenue = float(r.revenue or 0)
-        cost = float(r.cost or 0)
-        discount = float(r.discount or 0)
-        gp = float(r.gross_profit or (revenue - cost))
-        margin = (gp / revenue * 100.0) if revenue else 0.0
-        out.append({
-            "date": r.date.isoformat(),
-            "warehouse": r.warehouse,
-            "revenue": revenue,
-            "cost": cost,
-            "discount": discount,
-            "gross_profit": gp,
-            "margin_pct": margin,
-        })
-    return out
+    if warehouse_id:
+        stmt = stmt.where(SalesDaily.warehouse_id == warehouse_id)
+    return stmt
 
-def get_inflow_daily(session: Session, days: int = 60) -> List[Dict[str, Any]]:
-    start = date.today() - timedelta(days=days)
-    stmt = (
+def get_writeoff_daily(session: Session, start: date, end: date, warehouse_id: Optional[int] = None,
+                       columns: bool = False):
+    return series_rows(session.execute(_writeoff_daily_stmt(start, end, warehouse_id)).fetchall(), columns)
+
+async def get_writeoff_daily_async(session: AsyncSession, start: date, end: date,
+                                   warehouse_id: Optional[int] = None, columns: bool = False):
+    return series_rows((await session.execute(_writeoff_daily_stmt(start, end, warehouse_id))).fetchall(), columns)
+
+# ТОП складов по выручке за период
+def _top_warehouses_stmt(start: date, end: date, limit: int):
+    revenue = func.sum(SalesDaily.revenue)
+    checks = func.sum(SalesDaily.receipts_count)
+    gross_profit = revenue - func.sum(SalesDaily.cost)
+    return (
         select(
-            SalesDaily.date,
             Warehouse.name.label("warehouse"),
-            func.sum(SalesDaily.inflow_cost).label("inflow"),
+            _money(revenue).label("revenue"),
+            _money(gross_profit).label("gross_profit"),
+            _pct(gross_profit, revenue).label("margin_pct"),
+            cast(func.coalesce(checks, 0), BigInteger).label("checks"),
+            cast(func.coalesce(revenue / func.nullif(checks, 0), 0), Float).label("avg_ticket"),
         )
         .join(Warehouse, Warehouse.id == SalesDaily.warehouse_id)
-        .where(SalesDaily.date >= start)
-        .group_by(SalesDaily.date, Warehouse.name)
-        .order_by(SalesDaily.date.asc(), Warehouse.name.asc())
+        .where(SalesDaily.date >= start, SalesDaily.date <= end)
+        .group_by(Warehouse.name)
+        .order_by(revenue.desc())
+        .limit(limit)
     )
-    rows = session.execute(stmt).fetchall()
-    return [
-        {
-            "date": r.date.isoformat(),
-            "warehouse": r.warehouse,
-            "inflow": float(r.inflow or 0),
-        }
-        for r in rows
-    ]
+
+def get_top_warehouses(session: Session, start: date, end: date, limit: int = 5) -> List[Dict[str, Any]]:
+    return series_rows(session.execute(_top_warehouses_stmt(start, end, limit)).fetchall())
+
+async def get_top_warehouses_async(session: AsyncSession, start: date, end: date, limit: int = 5) -> List[Dict[str, Any]]:
+    return series_rows((await session.execute(_top_warehouses_stmt(start, end, limit))).fetchall())
+
+# разбивка списаний по причинам из writeoff_daily_reason (как в БД, без нормализации)
+_WRITEOFF_REASONS_SQL = """
+    SELECT r.date, r.warehouse_id, COALESCE(w.name, 'id=' || r.warehouse_id) AS warehouse,
+           COALESCE(r.reason, '') AS reason, CAST(SUM(r.cost) AS float8) AS cost
+      FROM writeoff_daily_reason r
+      LEFT JOIN warehouse w ON w.id = r.warehouse_id
+     WHERE r.date BETWEEN :s AND :e {wh_filter}
+     GROUP BY r.date, r.warehouse_id, w.name, r.reason
+     ORDER BY r.date ASC, r.warehouse_id ASC, reason ASC
+"""
+
+def _writeoff_reasons_query(start: date, end: date, warehouse_id: Optional[int]):
+    sql = _WRITEOFF_REASONS_SQL.format(wh_filter="AND r.warehouse_id = :wid" if warehouse_id else "")
+    return text(sql), {"s": start, "e": end, "wid": warehouse_id}
+
+def get_writeoff_reasons(session: Session, start: date, end: date, warehouse_id: Optional[int] = None):
+    return series_rows(session.execute(*_writeoff_reasons_query(start, end, warehouse_id)).fetchall())
+
+async def get_writeoff_reasons_async(session: AsyncSession, start: date, end: date, warehouse_id: Optional[int] = None):
+    return series_rows((await session.execute(*_writeoff_reasons_query(start, end, warehouse_id))).fetchall())
 
 # ==== Универсальная сводка для произвольного периода ====
 
 Granularity = Literal["day", "month", "year"]
 
-def _date_trunc(granularity: Granularity):
-    mapping = {"day": "day", "month": "month", "year": "year"}
-    return func.date_trunc(mapping[granularity], SalesDaily.date).label("period")
+_SUM_COLUMNS = ("revenue", "cost", "discount", "returns_cost", "inflow_cost", "receipts_count")
 
-def _aggregate_stmt(granularity: Granularity, start: date, end: date, warehouse_id: Optional[int]):
-    period = _date_trunc(granularity)
-    stmt = (
-        select(
-            period,
-            func.sum(SalesDaily.revenue).label("revenue"),
-            func.sum(SalesDaily.cost).label("cost"),
-            func.sum(SalesDaily.discount).label("discount"),
-            func.sum(SalesDaily.returns_cost).label("returns_cost"),
-            func.sum(SalesDaily.inflow_cost).label("inflow_cost"),
-            func.sum(SalesDaily.receipts_count).label("receipts"),
-        )
-        .where(SalesDaily.date >= start, SalesDaily.date <= end)
-        .group_by(period)
-        .order_by(period.asc())
-    )
-    if warehouse_id:
-        stmt = stmt.where(SalesDaily.warehouse_id == warehouse_id)
-    return stmt
+_LEVELS = {
+    "day": (SalesDaily, SalesDaily.date),
+    "month": (SalesMonthly, SalesMonthly.month),
+    "year": (SalesYearly, SalesYearly.year),
+}
 
-def _sum_stmt(start: date, end: date, warehouse_id: Optional[int]):
-    stmt = (
-        select(
-            func.sum(SalesDaily.revenue).label("revenue"),
-            func.sum(SalesDaily.cost).label("cost"),
-            func.sum(SalesDaily.discount).label("discount"),
-            func.sum(SalesDaily.returns_cost).label("returns_cost"),
-            func.sum(SalesDaily.inflow_cost).label("inflow_cost"),
-            func.sum(SalesDaily.receipts_count).label("receipts"),
+# фильтр по складам: один id, список id или None — все склады
+Warehouses = Optional[Union[int, Sequence[int]]]
+
+def _wh_ids(warehouse_id: Warehouses) -> list[int]:
+    if not warehouse_id:
+        return []
+    if isinstance(warehouse_id, int):
+        return [warehouse_id]
+    return sorted(set(warehouse_id))
+
+def _rollup_selects(start: date, end: date, warehouse_id: Warehouses, coarsest: Granularity, *extra) -> list:
+    """
+    SELECT-ы строк (d, warehouse_id, суммы, *extra) за [start..end]: полные годы — из sales_yearly,
+    полные месяцы — из sales_monthly, неполные крайние месяцы — из sales_daily; таблицы не крупнее
+    coarsest. d — ключ строки своей таблицы.
+    """
+    ids = _wh_ids(warehouse_id)
+    selects = []
+    for level, spans in split_range(start, end, coarsest).items():
+        if not spans:
+            continue
+        model, key = _LEVELS[level]
+        stmt = (
+            select(key.label("d"), model.warehouse_id.label("warehouse_id"),
+                   *[getattr(model, c).label(c) for c in _SUM_COLUMNS], *extra)
+            .where(or_(*[key.between(a, b) for a, b in spans]))
         )
-        .where(SalesDaily.date >= start, SalesDaily.date <= end)
-    )
-    if warehouse_id:
-        stmt = stmt.where(SalesDaily.warehouse_id == warehouse_id)
-    return stmt
+        if ids:
+            stmt = stmt.where(model.warehouse_id.in_(ids))
+        selects.append(stmt)
+    return selects
 
-def _as_float(x): return float(x or 0)
+def _union(selects: list, start: date, end: date, *extra):
+    if not selects:
+        # пустой период (start > end)
+        selects = [
+            select(SalesDaily.date.label("d"), SalesDaily.warehouse_id.label("warehouse_id"),
+                   *[getattr(SalesDaily, c).label(c) for c in _SUM_COLUMNS], *extra)
+            .where(SalesDaily.date >= start, SalesDaily.date <= end)
+        ]
+    return (union_all(*selects) if len(selects) > 1 else selects[0]).subquery("src")
 
-def _period_compare(session: Session, start: date, end: date, warehouse_id: Optional[int]) -> Dict[str, Any]:
+def _rollup_source(start: date, end: date, warehouse_id: Warehouses, coarsest: Granularity):
+    return _union(_rollup_selects(start, end, warehouse_id, coarsest), start, end)
+
+def _sums(src, bucket: Optional[str] = None):
+    # с bucket — условная агрегация только по строкам этого диапазона, колонки с префиксом bucket_
+    def agg(col, name):
+        f = func.sum(col)
+        if bucket is None:
+            return f.label(name)
+        return f.filter(src.c.bucket == bucket).label(f"{bucket}_{name}")
+    return [
+        agg(src.c.revenue, "revenue"),
+        agg(src.c.cost, "cost"),
+        agg(src.c.discount, "discount"),
+        agg(src.c.returns_cost, "returns_cost"),
+        agg(src.c.inflow_cost, "inflow_cost"),
+        agg(src.c.receipts_count, "receipts"),
+    ]
+
+def _aggregate_stmt(granularity: Granularity, start: date, end: date, warehouse_id: Warehouses,
+                    by_warehouse: bool = False):
+    # серия по месяцам/годам берёт готовые месяцы/годы и досчитывает только крайние дни
+    src = _rollup_source(start, end, warehouse_id, granularity)
+    period = func.date_trunc(granularity, src.c.d).label("period")
+    keys = [src.c.warehouse_id, period] if by_warehouse else [period]
+    return select(*keys, *_sums(src)).group_by(*keys).order_by(*[k.asc() for k in keys])
+
+COMPARE_BUCKETS = ("current", "previous", "previous_year")
+
+def _year_ago(d: date) -> date:
+    # 29 февраля -> 28 февраля прошлого года
+    try:
+        return d.replace(year=d.year - 1)
+    except ValueError:
+        return d.replace(year=d.year - 1, day=28)
+
+def _compare_ranges(start: date, end: date) -> Dict[str, tuple]:
     length = (end - start).days + 1
     prev_end = start - timedelta(days=1)
     prev_start = prev_end - timedelta(days=length-1)
-    prev_year_start = date(start.year - 1, start.month, start.day)
-    prev_year_end = date(end.year - 1, end.month, end.day)
-
-    cur = session.execute(_sum_stmt(start, end, warehouse_id)).first()
-    prev = session.execute(_sum_stmt(prev_start, prev_end, warehouse_id)).first()
-    yoy = session.execute(_sum_stmt(prev_year_start, prev_year_end, warehouse_id)).first()
-
-    def pack(row):
-        return {
-            "revenue": _as_float(row.revenue),
-            "cost": _as_float(row.cost),
-            "discount": _as_float(row.discount),
-            "returns_cost": _as_float(row.returns_cost),
-            "inflow_cost": _as_float(row.inflow_cost),
-            "receipts": int(row.receipts or 0),
-        }
+    prev_year_start = _year_ago(start)
+    prev_year_end = _year_ago(end)
+    return {
+        "current": (start, end),
+        "previous": (prev_start, prev_end),
+        "previous_year": (prev_year_start, prev_year_end),
+    }
+
+def summary_span(start: date, end: date) -> tuple:
+    """Даты, от которых зависит сводка: текущий период, предыдущий и тот же период год назад."""
+    ranges = _compare_ranges(start, end).values()
+    return min(a for a, _ in ranges), max(b for _, b in ranges)
+
+def _compare_stmt(start: date, end: date, warehouse_id: Warehouses, by_warehouse: bool = False):
+    """
+    Текущий период, предыдущий и тот же период год назад — одним запросом: строки трёх диапазонов
+    (каждый из своих rollup-таблиц) с меткой bucket и SUM(...) FILTER (WHERE bucket = ...).
+    Диапазоны могут пересекаться — строка тогда просто попадает в union дважды, с разными метками.
+    """
+    selects = []
+    for bucket, (s, e) in _compare_ranges(start, end).items():
+        selects += _rollup_selects(s, e, warehouse_id, "year", literal_column(f"'{bucket}'").label("bucket"))
+    src = _union(selects, start, end, literal_column("'current'").label("bucket"))
+    sums = [c for b in COMPARE_BUCKETS for c in _sums(src, b)]
+    if by_warehouse:
+        return select(src.c.warehouse_id, *sums).group_by(src.c.warehouse_id)
+    return select(*sums)
+
+def _as_float(x): return float(x or 0)
+
+_PACK_KEYS = ("revenue", "cost", "discount", "returns_cost", "inflow_cost", "receipts")
 
+def _pack(row, prefix: str = "") -> Dict[str, Any]:
+    def v(name): return getattr(row, prefix + name)
     return {
-        "current": pack(cur),
-        "previous": pack(prev),
-        "previous_year": pack(yoy),
+        "revenue": _as_float(v("revenue")),
+        "cost": _as_float(v("cost")),
+        "discount": _as_float(v("discount")),
+        "returns_cost": _as_float(v("returns_cost")),
+        "inflow_cost": _as_float(v("inflow_cost")),
+        "receipts": int(v("receipts") or 0),
     }
 
+def _compare_result(row) -> Dict[str, Any]:
+    return {b: _pack(row, f"{b}_") for b in COMPARE_BUCKETS}
+
+def _period_compare(session: Session, start: date, end: date, warehouse_id: Optional[int]) -> Dict[str, Any]:
+    return _compare_result(session.execute(_compare_stmt(start, end, warehouse_id)).first())
+
+def _with_margin(item: Dict[str, Any]) -> Dict[str, Any]:
+    item["gross_profit"] = item["revenue"] - item["cost"]
+    item["margin_pct"] = (item["gross_profit"] / item["revenue"] * 100.0) if item["revenue"] else 0.0
+    return item
+
+def _series_item(r) -> Dict[str, Any]:
+    return _with_margin({"period": r.period.date().isoformat(), **_pack(r)})
+
+def _add(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: a.get(k, 0) + b.get(k, 0) for k in _PACK_KEYS}
+
 def get_summary(
     session: Session,
     start: date,
@@ -173,38 +324,267 @@ def get_summary(
       - totals: суммы за текущий период
       - compare: суммы за предыдущий период и за прошлый год, для сравнения
     """
-    stmt = _aggregate_stmt(granularity, start, end, warehouse_id)
-    rows = session.execute(stmt).fetchall()
-    series = []
-    for r in rows:
-        rev = _as_float(r.revenue)
-        cost = _as_float(r.cost)
-        gp = rev - cost
-        margin = (gp / rev * 100.0) if rev else 0.0
-        series.append({
-            "period": r.period.date().isoformat(),
-            "revenue": rev,
-            "cost": cost,
-            "discount": _as_float(r.discount),
-            "returns_cost": _as_float(r.returns_cost),
-            "inflow_cost": _as_float(r.inflow_cost),
-            "receipts": int(r.receipts or 0),
-            "gross_profit": gp,
-            "margin_pct": margin,
+    rows = session.execute(_aggregate_stmt(granularity, start, end, warehouse_id)).fetchall()
+    compare = session.execute(_compare_stmt(start, end, warehouse_id)).first()
+    return _summary_result(rows, compare)
+
+async def get_summary_async(
+    session: AsyncSession,
+    start: date,
+    end: date,
+    granularity: Granularity = "day",
+    warehouse_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    rows = (await session.execute(_aggregate_stmt(granularity, start, end, warehouse_id))).fetchall()
+    compare = (await session.execute(_compare_stmt(start, end, warehouse_id))).first()
+    return _summary_result(rows, compare)
+
+def _summary_result(rows, compare_row) -> Dict[str, Any]:
+    series = [_series_item(r) for r in rows]
+    # totals совпадает с compare.current — отдельный запрос не нужен
+    compare = _compare_result(compare_row)
+    totals = _with_margin(dict(compare["current"]))
+    return {"series": series, "totals": totals, "compare": compare}
+
+def get_summary_multi(
+    session: Session,
+    start: date,
+    end: date,
+    granularity: Granularity = "day",
+    warehouse_ids: Optional[Sequence[int]] = None,
+) -> Dict[str, Any]:
+    """
+    Сводка сразу по нескольким складам (None — по всем, с разбивкой по складам) двумя запросами,
+    сгруппированными по складу: серия и сравнение периодов.
+    Возвращает:
+      - warehouses: [{warehouse_id, series, totals, compare}] — как get_summary для каждого склада
+      - combined: то же, просуммированное по складам
+    """
+    rows = session.execute(_aggregate_stmt(granularity, start, end, warehouse_ids, by_warehouse=True)).fetchall()
+    compare = session.execute(_compare_stmt(start, end, warehouse_ids, by_warehouse=True)).fetchall()
+    return _summary_multi_result(rows, compare, warehouse_ids)
+
+async def get_summary_multi_async(
+    session: AsyncSession,
+    start: date,
+    end: date,
+    granularity: Granularity = "day",
+    warehouse_ids: Optional[Sequence[int]] = None,
+) -> Dict[str, Any]:
+    rows = (await session.execute(_aggregate_stmt(granularity, start, end, warehouse_ids, by_warehouse=True))).fetchall()
+    compare = (await session.execute(_compare_stmt(start, end, warehouse_ids, by_warehouse=True))).fetchall()
+    return _summary_multi_result(rows, compare, warehouse_ids)
+
+def _summary_multi_result(rows, compare_rows, warehouse_ids: Optional[Sequence[int]]) -> Dict[str, Any]:
+    zero = {k: 0.0 for k in _PACK_KEYS} | {"receipts": 0}
+    blocks: Dict[int, Dict[str, Any]] = {}
+
+    def block(wh_id: int) -> Dict[str, Any]:
+        return blocks.setdefault(wh_id, {
+            "warehouse_id": wh_id, "series": [], "totals": None,
+            "compare": {b: dict(zero) for b in COMPARE_BUCKETS},
         })
 
-    totals_row = session.execute(_sum_stmt(start, end, warehouse_id)).first()
-    totals = {
-        "revenue": _as_float(totals_row.revenue),
-        "cost": _as_float(totals_row.cost),
-        "discount": _as_float(totals_row.discount),
-        "returns_cost": _as_float(totals_row.returns_cost),
-        "inflow_cost": _as_float(totals_row.inflow_cost),
-        "receipts": int(totals_row.receipts or 0),
+    for wh_id in _wh_ids(warehouse_ids):
+        block(wh_id)
+    for r in rows:
+        block(r.warehouse_id)["series"].append(_series_item(r))
+    for r in compare_rows:
+        block(r.warehouse_id)["compare"] = _compare_result(r)
+
+    combined_series: Dict[str, Dict[str, Any]] = {}
+    combined_compare = {b: dict(zero) for b in COMPARE_BUCKETS}
+    for b in blocks.values():
+        b["totals"] = _with_margin(dict(b["compare"]["current"]))
+        for item in b["series"]:
+            acc = combined_series.setdefault(item["period"], dict(zero))
+            combined_series[item["period"]] = _add(acc, item)
+        for k in COMPARE_BUCKETS:
+            combined_compare[k] = _add(combined_compare[k], b["compare"][k])
+
+    combined = {
+        "series": [_with_margin({"period": p, **v}) for p, v in sorted(combined_series.items())],
+        "totals": _with_margin(dict(combined_compare["current"])),
+        "compare": combined_compare,
     }
-    totals["gross_profit"] = totals["revenue"] - totals["cost"]
-    totals["margin_pct"] = (totals["gross_profit"] / totals["revenue"] * 100.0) if totals["revenue"] else 0.0
+    return {"warehouses": [blocks[k] for k in sorted(blocks)], "combined": combined}
 
-    compare = _period_compare(session, start, end, warehouse_id)
+# ==== ТОП товаров из локальных фактов ====
 
-    return {"series": series, "totals": totals, "compare": compare}
+# выручка/количество/скидка — из позиций retaildemand (sales_item_fact), себестоимость — qty × buyPrice
+# из assortment_price (модификация без своей цены — цена товара). Имя — из справочника product.
+# assortment_price ищется по полному href (PK), а не по right(href, 36): иначе — полный проход по каталогу.
+_TOP_PRODUCTS_SQL = """
+    WITH sales AS (
+        SELECT product_id::text AS product_id,
+               SUM(revenue) AS revenue,
+               SUM(qty) AS qty,
+               SUM(price * qty - revenue) AS discount
+          FROM sales_item_fact
+         WHERE date BETWEEN :start AND :end {store_filter}
+         GROUP BY 1
+    )
+    SELECT s.product_id, p.name, s.revenue, s.qty, s.discount,
+           s.qty * COALESCE(NULLIF(a.buy_price, 0), pp.buy_price, 0) / 100.0 AS cost
+      FROM sales s
+      LEFT JOIN assortment_price a
+        ON a.href IN (CAST(:base AS text) || '/entity/product/' || s.product_id,
+                     CAST(:base AS text) || '/entity/variant/' || s.product_id)
+      LEFT JOIN assortment_price pp ON pp.href = a.product_href
+      LEFT JOIN product p ON p.ms_id::text = s.product_id
+"""
+
+def top_product_item(name: str, revenue: float, cost: float, qty: float,
+                     discount: float = 0.0, returns_cost: float = 0.0) -> Dict[str, Any]:
+    gp = revenue - cost
+    return {
+        "name": name,
+        "revenue": revenue,
+        "cost": cost,
+        "qty": qty,
+        "discount": discount,
+        "returns_cost": returns_cost,
+        "gross_profit": gp,
+        "margin_pct": (gp / revenue * 100.0) if revenue else 0.0,
+        "avg_price": (revenue / qty) if qty else 0.0,
+    }
+
+def get_top_products(session: Session, start: date, end: date, store_ms_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Все товары периода (по складу МС или по всем), по убыванию выручки. Без обращения к МоемуСкладу:
+    себестоимость — по закупочной цене из кэша assortment_price, возвраты в фактах не хранятся (0).
+    """
+    return _top_products_result(session.execute(*_top_products_query(start, end, store_ms_id)).fetchall())
+
+async def get_top_products_async(session: AsyncSession, start: date, end: date,
+                                 store_ms_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    return _top_products_result((await session.execute(*_top_products_query(start, end, store_ms_id))).fetchall())
+
+def _top_products_query(start: date, end: date, store_ms_id: Optional[str]):
+    sql = _TOP_PRODUCTS_SQL.format(store_filter="AND warehouse_id = CAST(:store AS uuid)" if store_ms_id else "")
+    return text(sql), {"start": start, "end": end, "store": store_ms_id, "base": MS_BASE}
+
+def _top_products_result(rows) -> List[Dict[str, Any]]:
+    items = [
+        top_product_item(r.name or r.product_id, _as_float(r.revenue), _as_float(r.cost),
+                         _as_float(r.qty), _as_float(r.discount))
+        for r in rows
+    ]
+    items.sort(key=lambda x: x["revenue"], reverse=True)
+    return items
+
+# ==== Позиции оприходований и ТОП товаров по продажам и поступлениям (v2/v3) ====
+
+_INFLOW_ITEMS_SQL = """
+    SELECT i.date, i.warehouse_id, w.name AS warehouse,
+           i.product_id, i.qty, i.price, i.cost, i.inventory_based
+      FROM inflow_item_fact i
+      JOIN warehouse w ON w.ms_id = i.warehouse_id::text
+     WHERE i.date BETWEEN :start AND :end {wh_filter}
+     ORDER BY i.date DESC
+     LIMIT :limit
+"""
+
+def _inflow_items_query(start: date, end: date, store_ms_id: Optional[str], limit: int):
+    sql = _INFLOW_ITEMS_SQL.format(wh_filter="AND i.warehouse_id::text = :wh" if store_ms_id else "")
+    return text(sql), {"start": start, "end": end, "wh": store_ms_id, "limit": limit}
+
+def get_inflow_items(session: Session, start: date, end: date, store_ms_id: Optional[str] = None,
+                     limit: int = 500) -> List[Dict[str, Any]]:
+    """Позиции оприходований за период (опционально по складу МС), новые сверху. Деньги — в рублях."""
+    return [dict(r) for r in session.execute(*_inflow_items_query(start, end, store_ms_id, limit)).mappings()]
+
+async def get_inflow_items_async(session: AsyncSession, start: date, end: date, store_ms_id: Optional[str] = None,
+                                 limit: int = 500) -> List[Dict[str, Any]]:
+    rows = (await session.execute(*_inflow_items_query(start, end, store_ms_id, limit))).mappings()
+    return [dict(r) for r in rows]
+
+# продажи и поступления считаются отдельно и сводятся FULL JOIN по товару; фильтры — по агрегатам продаж
+_SALES_INFLOW_CTE = """
+    WITH sales AS (
+        SELECT product_id::text AS product_id,
+               SUM(revenue) AS revenue,
+               SUM(qty) AS sold_qty,
+               CASE WHEN SUM(qty) = 0 THEN 0 ELSE SUM(revenue) / SUM(qty) END AS avg_price
+          FROM sales_item_fact
+         WHERE date BETWEEN :start AND :end
+         GROUP BY 1
+    ),
+    inflow AS (
+        SELECT product_id::text AS product_id,
+               SUM(qty) AS inflow_qty,
+               SUM(cost) AS inflow_cost
+          FROM inflow_item_fact
+         WHERE date BETWEEN :start AND :end
+         GROUP BY 1
+    ),
+    merged AS (
+        SELECT COALESCE(s.product_id, i.product_id) AS product_id,
+               COALESCE(s.revenue, 0) AS revenue,
+               COALESCE(s.sold_qty, 0) AS sold_qty,
+               COALESCE(s.avg_price, 0) AS avg_price,
+               COALESCE(i.inflow_qty, 0) AS inflow_qty,
+               COALESCE(i.inflow_cost, 0) AS inflow_cost
+          FROM sales s
+          FULL JOIN inflow i USING (product_id)
+    )
+"""
+
+# v2 — с именем товара из справочника product и суммами, округлёнными до копеек
+_TOP_PRODUCTS_V2_SQL = _SALES_INFLOW_CTE + """
+    SELECT m.product_id, p.name,
+           ROUND(m.revenue::numeric, 2) AS revenue,
+           m.sold_qty,
+           ROUND(m.avg_price::numeric, 2) AS avg_price,
+           m.inflow_qty,
+           ROUND(m.inflow_cost::numeric, 2) AS inflow_cost
+      FROM merged m
+      LEFT JOIN product p ON p.ms_id::text = m.product_id
+     WHERE m.sold_qty >= :min_qty AND m.revenue >= :min_revenue
+     ORDER BY {sort_col} {sort_dir} NULLS LAST
+     LIMIT :limit
+"""
+
+_TOP_PRODUCTS_V3_SQL = _SALES_INFLOW_CTE + """
+    SELECT product_id, revenue, sold_qty, avg_price, inflow_qty, inflow_cost
+      FROM merged
+     WHERE sold_qty >= :min_qty AND revenue >= :min_revenue
+     ORDER BY {sort_col} {sort_dir} NULLS LAST
+     LIMIT :limit
+"""
+
+# белые списки сортировки: имя колонки подставляется в SQL как есть
+_TOP_V3_SORT = ("revenue", "sold_qty", "avg_price", "inflow_qty", "inflow_cost", "product_id")
+_TOP_V2_SORT = _TOP_V3_SORT + ("name",)
+
+def _top_sales_inflow_query(sql: str, allowed: Sequence[str], start: date, end: date, limit: int,
+                            sort_by: str, order: str, min_qty: float, min_revenue: float):
+    sort_col = sort_by if sort_by in allowed else "revenue"
+    sort_dir = "ASC" if str(order).lower() == "asc" else "DESC"
+    params = {"start": start, "end": end, "limit": limit,
+              "min_qty": float(min_qty or 0), "min_revenue": float(min_revenue or 0)}
+    return text(sql.format(sort_col=sort_col, sort_dir=sort_dir)), params
+
+def _top_products_v2_query(start: date, end: date, limit: int = 20, sort_by: str = "revenue",
+                           order: str = "desc", min_qty: float = 0, min_revenue: float = 0):
+    return _top_sales_inflow_query(_TOP_PRODUCTS_V2_SQL, _TOP_V2_SORT, start, end, limit,
+                                   sort_by, order, min_qty, min_revenue)
+
+def _top_products_v3_query(start: date, end: date, limit: int = 20, sort_by: str = "revenue",
+                           order: str = "desc", min_qty: float = 0, min_revenue: float = 0):
+    return _top_sales_inflow_query(_TOP_PRODUCTS_V3_SQL, _TOP_V3_SORT, start, end, limit,
+                                   sort_by, order, min_qty, min_revenue)
+
+def get_top_products_v2(session: Session, start: date, end: date, **opts) -> List[Dict[str, Any]]:
+    """ТОП товаров за период: продажи + поступления, с именем товара. opts — limit/sort_by/order/min_*."""
+    return [dict(r) for r in session.execute(*_top_products_v2_query(start, end, **opts)).mappings()]
+
+async def get_top_products_v2_async(session: AsyncSession, start: date, end: date, **opts) -> List[Dict[str, Any]]:
+    return [dict(r) for r in (await session.execute(*_top_products_v2_query(start, end, **opts))).mappings()]
+
+def get_top_products_v3(session: Session, start: date, end: date, **opts) -> List[Dict[str, Any]]:
+    """ТОП товаров за период: продажи + поступления (FULL JOIN по product_id), без имён."""
+    return [dict(r) for r in session.execute(*_top_products_v3_query(start, end, **opts)).mappings()]
+
+async def get_top_products_v3_async(session: AsyncSession, start: date, end: date, **opts) -> List[Dict[str, Any]]:
+    return [dict(r) for r in (await session.execute(*_top_products_v3_query(start, end, **opts))).mappings()]
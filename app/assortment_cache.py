@@ -0,0 +1,280 @@
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, NamedTuple, Optional
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from .data_changes import TOPIC_PRICES, notify_topic
+from .db import SessionLocal
+from .models import AssortmentPrice
+from .ms_client import MSClient
+
+KINDS = ("product", "variant")
+
+# id в одном filter=id=..;id=.. запросе списка
+BULK_IDS = 100
+
+class Entry(NamedTuple):
+    kind: str
+    product_href: Optional[str]
+    buy_price: int          # собственный buyPrice, копейки
+    updated: Optional[str]
+
+def norm_href(href: str | None) -> str:
+    return (href or "").split("?", 1)[0]
+
+def buy_minor(node: Any) -> int:
+    """buyPrice из МС -> целые копейки: {'value': 12345.0} или просто число."""
+    if isinstance(node, dict):
+        node = node.get("value")
+    try:
+        return int(Decimal(str(node or 0)).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+    except Exception:
+        return 0
+
+def entry_from_entity(data: dict) -> tuple[str, Entry] | None:
+    """Сущность product/variant (полная или из expand) -> (href, Entry); None, если это не товар/модификация."""
+    meta = data.get("meta") or {}
+    kind = meta.get("type")
+    href = norm_href(meta.get("href"))
+    if kind not in KINDS or not href:
+        return None
+    product_href = norm_href(((data.get("product") or {}).get("meta") or {}).get("href")) or None
+    return href, Entry(kind, product_href, buy_minor(data.get("buyPrice")), (data.get("updated") or "")[:19] or None)
+
+def position_hrefs(positions: list[dict]) -> list[str]:
+    """href товаров/модификаций позиций, которым нужна цена из кэша (без buyPrice в expand)."""
+    out = []
+    for p in positions:
+        ass = p.get("assortment") or {}
+        if buy_minor(ass.get("buyPrice")) > 0:
+            continue
+        out.append(((ass.get("meta") or {}).get("href")))
+        out.append((((ass.get("product") or {}).get("meta") or {}).get("href")))
+    return [h for h in out if h]
+
+def notify_prices_changed(db):
+    """
+    buyPrice влияет только на себестоимость ТОПа товаров (за любые даты): поднимаем версию темы
+    TOPIC_PRICES и сообщаем API в транзакции db — сбрасываются только ответы ТОПа и их ETag.
+    """
+    notify_topic(db, TOPIC_PRICES)
+
+
+class AssortmentPriceCache:
+    """
+    buyPrice товаров и модификаций: LRU в памяти -> таблица assortment_price -> GET в МС.
+    warm() одним проходом по /entity/product и /entity/variant наполняет таблицу, повторный warm()
+    дочитывает только изменённое (updated>= последней отметки). observe() обновляет запись по
+    сущности, пришедшей через expand, если её `updated` новее сохранённого.
+    Цена модификации без своего buyPrice берётся у товара.
+    Изменения цен копятся за прогон: API узнаёт о них одним notify_prices_changed() во flush().
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._lru: "OrderedDict[str, Entry]" = OrderedDict()
+        self._dirty: dict[str, Entry] = {}   # увиденное через observe(), ещё не записанное в БД
+        self._changed = 0                     # записано изменённых цен, о которых API ещё не знает
+        self.stats = {"hits": 0, "db": 0, "fetched": 0}
+
+    # --- память ---
+    def _get_mem(self, href: str) -> Entry | None:
+        e = self._lru.get(href)
+        if e is not None:
+            self._lru.move_to_end(href)
+        return e
+
+    def _put_mem(self, href: str, e: Entry):
+        self._lru[href] = e
+        self._lru.move_to_end(href)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    # --- БД ---
+    def _load_db(self, hrefs: list[str]) -> dict[str, Entry]:
+        if not hrefs:
+            return {}
+        with SessionLocal() as db:
+            rows = db.execute(select(AssortmentPrice).where(AssortmentPrice.href.in_(hrefs))).scalars().all()
+        return {r.href: Entry(r.kind, r.product_href, r.buy_price, r.ms_updated) for r in rows}
+
+    def _save_db(self, entries: dict[str, Entry]) -> int:
+        """
+        Записать цены; возвращает, у скольких href цена новая или изменилась. Считаются только строки,
+        которые upsert действительно записал (RETURNING): более старое `updated` отбрасывается WHERE.
+        Сообщение API — одно на прогон, во flush().
+        """
+        if not entries:
+            return 0
+        rows = [
+            {"href": h, "kind": e.kind, "product_href": e.product_href, "buy_price": e.buy_price, "ms_updated": e.updated}
+            for h, e in entries.items()
+        ]
+        with SessionLocal() as db:
+            hrefs = list(entries)
+            old = dict(db.execute(
+                select(AssortmentPrice.href, AssortmentPrice.buy_price).where(AssortmentPrice.href.in_(hrefs))
+            ).all())
+            changed = 0
+            for i in range(0, len(rows), 1000):
+                ins = insert(AssortmentPrice).values(rows[i:i + 1000])
+                # старое `updated` не затирает более свежую запись
+                written = db.execute(ins.on_conflict_do_update(
+                    index_elements=[AssortmentPrice.href],
+                    set_={
+                        "kind": ins.excluded.kind,
+                        "product_href": ins.excluded.product_href,
+                        "buy_price": ins.excluded.buy_price,
+                        "ms_updated": ins.excluded.ms_updated,
+                        "fetched_at": func.now(),
+                    },
+                    where=AssortmentPrice.ms_updated.is_(None)
+                          | (AssortmentPrice.ms_updated <= func.coalesce(ins.excluded.ms_updated, "")),
+                ).returning(AssortmentPrice.href, AssortmentPrice.buy_price))
+                changed += sum(1 for h, p in written if old.get(h) != p)
+            db.commit()
+        self._changed += changed
+        return changed
+
+    # --- публичное ---
+    def observe(self, entity: dict | None):
+        """Сущность пришла вместе с документом (expand=assortment): освежаем кэш, если она новее."""
+        got = entry_from_entity(entity or {}) if isinstance(entity, dict) else None
+        if not got or got[1].updated is None or "buyPrice" not in entity:
+            return
+        href, e = got
+        cur = self._get_mem(href)
+        if cur is None or (cur.updated or "") < e.updated:
+            self._put_mem(href, e)
+            self._dirty[href] = e
+            if len(self._dirty) >= 1000:
+                self._save_dirty()
+
+    def _save_dirty(self):
+        dirty, self._dirty = self._dirty, {}
+        self._save_db(dirty)
+
+    def flush(self):
+        """Конец прогона: дописать в БД то, что пришло через observe(), и один раз сообщить API об изменённых ценах."""
+        self._save_dirty()
+        if self._changed:
+            with SessionLocal() as db:
+                notify_prices_changed(db)
+                db.commit()
+            self._changed = 0
+
+    async def entry(self, ms: MSClient, href: str) -> Entry | None:
+        href = norm_href(href)
+        if not href:
+            return None
+        e = self._get_mem(href)
+        if e is not None:
+            self.stats["hits"] += 1
+            return e
+        e = self._load_db([href]).get(href)
+        if e is not None:
+            self.stats["db"] += 1
+            self._put_mem(href, e)
+            return e
+        got = entry_from_entity(await ms.get_json(href))
+        self.stats["fetched"] += 1
+        if not got:
+            return None
+        self._put_mem(href, got[1])
+        self._save_db({href: got[1]})
+        return got[1]
+
+    async def _fetch_bulk(self, ms: MSClient, hrefs: list[str]) -> dict[str, Entry]:
+        """Списочные запросы /entity/{product|variant}?filter=id=..;id=.. по BULK_IDS id вместо GET на каждый href."""
+        by_kind: dict[str, list[str]] = {}
+        for h in hrefs:
+            parts = h.rstrip("/").split("/")
+            if len(parts) >= 2 and parts[-2] in KINDS:
+                by_kind.setdefault(parts[-2], []).append(parts[-1])
+        out: dict[str, Entry] = {}
+        for kind, ids in by_kind.items():
+            for i in range(0, len(ids), BULK_IDS):
+                flt = ";".join(f"id={x}" for x in ids[i:i + BULK_IDS])
+                async for row in ms.paged(f"/entity/{kind}", limit=BULK_IDS, params={"filter": flt}):
+                    got = entry_from_entity(row)
+                    if got:
+                        out[got[0]] = got[1]
+        self.stats["fetched"] += len(out)
+        return out
+
+    async def prefetch(self, ms: MSClient, hrefs) -> int:
+        """
+        Разом подготовить цены для набора href (например, всех позиций дня): чего нет в памяти —
+        одним запросом из БД, чего нет и там — списочными запросами в МС; вторым проходом так же
+        подтягиваются товары модификаций без собственной цены. Возвращает число запрошенных в МС.
+        """
+        fetched = 0
+        want = {norm_href(h) for h in hrefs if h}
+        for _ in range(2):   # 1) сами href, 2) товары модификаций
+            missing = [h for h in want if h and self._get_mem(h) is None]
+            if missing:
+                found = self._load_db(missing)
+                self.stats["db"] += len(found)
+                rest = [h for h in missing if h not in found]
+                fresh = await self._fetch_bulk(ms, rest) if rest else {}
+                self._save_db(fresh)
+                fetched += len(rest)
+                for h, e in {**found, **fresh}.items():
+                    self._put_mem(h, e)
+            # товары нужны всем модификациям без цены — и подгруженным сейчас, и уже лежавшим в памяти
+            want = {e.product_href for h in want if (e := self._get_mem(h)) is not None
+                    and e.kind == "variant" and not e.buy_price and e.product_href}
+            if not want:
+                break
+        return fetched
+
+    async def buy_price(self, ms: MSClient, href: str) -> int:
+        """Закупочная цена в копейках; для модификации без своей цены — цена товара. Нет цены — 0."""
+        e = await self.entry(ms, href)
+        if e is None:
+            return 0
+        if e.buy_price or e.kind != "variant" or not e.product_href:
+            return e.buy_price
+        p = await self.entry(ms, e.product_href)
+        return p.buy_price if p else 0
+
+    async def warm(self, ms: MSClient) -> int:
+        """Полная (первый раз) или инкрементальная по `updated` загрузка товаров и модификаций."""
+        n = 0
+        for kind in KINDS:
+            with SessionLocal() as db:
+                since = db.execute(
+                    select(func.max(AssortmentPrice.ms_updated)).where(AssortmentPrice.kind == kind)
+                ).scalar()
+            params = {"filter": f"updated>={since}"} if since else None
+            batch: dict[str, Entry] = {}
+            async for row in ms.paged(f"/entity/{kind}", params=params):
+                got = entry_from_entity(row)
+                if not got:
+                    continue
+                batch[got[0]] = got[1]
+                self._put_mem(*got)
+                if len(batch) >= 1000:
+                    self._save_db(batch); n += len(batch); batch = {}
+            self._save_db(batch); n += len(batch)
+        # одно уведомление на весь прогон, а не на каждую пачку
+        self.flush()
+        return n
+
+    def stats_line(self) -> str:
+        st = self.stats
+        return f"buyPrice cache: mem={st['hits']} db={st['db']} fetched={st['fetched']} size={len(self._lru)}"
+
+
+# общий кэш процесса — как shared_limiter в ms_client
+price_cache = AssortmentPriceCache()
+
+if __name__ == "__main__":
+    import asyncio
+
+    async def _main():
+        async with MSClient() as ms:
+            n = await price_cache.warm(ms)
+            print(f"assortment_price warmed: {n} rows; {ms.stats_line()}")
+
+    asyncio.run(_main())
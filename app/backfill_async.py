@@ -1,29 +1,14 @@
 import asyncio
 import datetime as dt
+import time
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Dict, Tuple, Optional
-import random
-import httpx
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.orm import Session
-from .config import settings
+from typing import Dict, NamedTuple, Tuple, Optional
 from .db import SessionLocal
-from .models import Warehouse, SalesDaily
-
-MS_BASE = settings.MS_BASE_URL.rstrip("/")
-HEADERS = {
-    "Authorization": f"Bearer {settings.MS_API_TOKEN}",
-    "Accept": "application/json;charset=utf-8",
-    "Content-Type": "application/json",
-    "User-Agent": "worker-analytics/backfill-async",
-}
-
-# Глобальный семафор и «тикер» чтобы не превысить лимиты (45 rps в ответах мы видели — возьмём безопасные ~10 rps)
-GLOBAL_CONCURRENCY = 3
-REQS_PER_SECOND = 10
-_last_req_ts = 0.0
-_lock = asyncio.Lock()
-_sem = asyncio.Semaphore(GLOBAL_CONCURRENCY)
+from .models import Warehouse
+from .ms_client import MSClient, BASE as MS_BASE
+from .sales_daily_writer import SalesDailyWriter
+from .checkpoint import done_units, mark
+from .sync_profit_daily import load_profit_facts, profit_range_from_facts
 
 def month_range(y: int, m: int) -> tuple[dt.date, dt.date]:
     start = dt.date(y, m, 1)
@@ -34,63 +19,14 @@ def rub(cents: Decimal | int | float) -> Decimal:
     d = Decimal(str(cents))
     return (d / Decimal(100)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
-async def _pacer():
-    """Примитивный rate-limit по времени между запросами."""
-    global _last_req_ts
-    async with _lock:
-        import time
-        now = time.monotonic()
-        min_gap = 1.0 / REQS_PER_SECOND
-        dt_gap = now - _last_req_ts
-        if dt_gap < min_gap:
-            await asyncio.sleep(min_gap - dt_gap)
-        _last_req_ts = time.monotonic()
-
-def _retry_sleep_hint(resp: httpx.Response) -> float:
-    # Понимаем заголовки МоегоСклада: x-lognex-retry-after (секунды), x-lognex-retry-timeinterval (мс)
-    try:
-        if resp is None:
-            return 1.5
-        h = resp.headers
-        if "x-lognex-retry-after" in h:
-            return max(1.0, float(h.get("x-lognex-retry-after", "1")))
-        if "x-lognex-retry-timeinterval" in h:
-            return max(0.5, float(h.get("x-lognex-retry-timeinterval", "1000"))/1000.0)
-    except Exception:
-        pass
-    return 1.5
-
-async def _get(ac: httpx.AsyncClient, url: str, *, params: Optional[dict]=None, max_attempts: int=6) -> httpx.Response:
-    """GET с троттлингом, ретраями на 429/5xx и экспоненциальным джиттером."""
-    attempt = 0
-    backoff = 1.0
-    while True:
-        attempt += 1
-        async with _sem:
-            await _pacer()
-            r = await ac.get(url, params=params)
-        if r.status_code < 400:
-            return r
-        # ошибки
-        if r.status_code in (429, 500, 502, 503, 504):
-            wait = max(backoff, _retry_sleep_hint(r)) * (1.0 + random.random()*0.25)
-            if attempt >= max_attempts:
-                r.raise_for_status()
-            await asyncio.sleep(wait)
-            backoff = min(backoff*1.7, 15.0)
-            continue
-        r.raise_for_status()
-
-async def fetch_sales_plotseries(ac: httpx.AsyncClient, store_id: str, start: dt.date, end: dt.date):
-    url = f"{MS_BASE}/report/sales/plotseries"
+async def fetch_sales_plotseries(ms: MSClient, store_id: str, start: dt.date, end: dt.date):
     params = {
         "momentFrom": f"{start} 00:00:00",
         "momentTo": f"{end} 23:59:59",
         "interval": "day",
         "filter": f"store={MS_BASE}/entity/store/{store_id}",
     }
-    r = await _get(ac, url, params=params)
-    data = r.json()
+    data = await ms.get_json("/report/sales/plotseries", params=params)
     out: Dict[dt.date, Tuple[Decimal, int]] = {}
     for row in data.get("series") or []:
         d = dt.datetime.strptime(row["date"], "%Y-%m-%d %H:%M:%S").date()
@@ -99,116 +35,189 @@ async def fetch_sales_plotseries(ac: httpx.AsyncClient, store_id: str, start: dt
         out[d] = (revenue, checks)
     return out
 
-async def fetch_profit_by_day(ac: httpx.AsyncClient, store_id: str, day: dt.date) -> Tuple[Decimal, Decimal, Decimal]:
-    """Возвращает (sellCostSum_rub, returnCostSum_rub, discount_rub) за день."""
-    url = f"{MS_BASE}/report/profit/byproduct"
-    params = {
-        "momentFrom": f"{day} 00:00:00",
-        "momentTo": f"{day} 23:59:59",
-        "filter": f"store={MS_BASE}/entity/store/{store_id}",
-        "limit": 1000,
-    }
-    r = await _get(ac, url, params=params)
-    data = r.json()
-    rows = data.get("rows") or []
-    sell_cost_c = Decimal("0")
-    ret_cost_c  = Decimal("0")
-    disc_c      = Decimal("0")
-    for row in rows:
-        sell_cost_c += Decimal(str(row.get("sellCostSum", 0)))
-        ret_cost_c  += Decimal(str(row.get("returnCostSum", 0)))
-        price = Decimal(str(row.get("sellPrice", 0)))
-        qty   = Decimal(str(row.get("sellQuantity", 0)))
-        ssum  = Decimal(str(row.get("sellSum", 0)))
-        disc_c += (price * qty) - ssum
-    return rub(sell_cost_c), rub(ret_cost_c), rub(disc_c)
-
-async def fetch_inflow_by_day(ac: httpx.AsyncClient, store_id: str, day: dt.date) -> Decimal:
-    url = f"{MS_BASE}/entity/enter"
+async def fetch_inflow_by_day(ms: MSClient, store_id: str, day: dt.date) -> Decimal:
     flt = f"moment>={day} 00:00:00;moment<={day} 23:59:59;store={MS_BASE}/entity/store/{store_id}"
     total_c = Decimal("0")
-    limit = 1000
-    offset = 0
-    while True:
-        r = await _get(ac, url, params={"limit": limit, "offset": offset, "filter": flt})
-        data = r.json()
-        rows = data.get("rows", [])
-        for doc in rows:
-            total_c += Decimal(str(doc.get("sum", 0) or 0))
-        if len(rows) < limit:
-            break
-        offset += limit
+    async for doc in ms.paged("/entity/enter", params={"filter": flt}):
+        total_c += Decimal(str(doc.get("sum", 0) or 0))
     return rub(total_c)
 
-async def backfill_month_async(year: int, month: int, concurrency: int = 2):
-    start, end = month_range(year, month)
-    db = SessionLocal()
+# склад-месяц в sync_checkpoint: day = 1-е число месяца
+CHECKPOINT_JOB = "backfill_async"
+
+# метрики-задачи: sales и profit — один запрос-отчёт на склад-месяц, inflow — список документов на склад-день
+METRICS = ("sales", "profit", "inflow")
+
+# сколько готовых складо-месяцев копить до flush + отметки ok
+FLUSH_UNITS = 10
+
+Unit = tuple[int, dt.date]                      # (warehouse.id, 1-е число месяца)
+
+class Task(NamedTuple):
+    w: Warehouse
+    month: dt.date                               # ключ складо-месяца
+    day: dt.date                                 # для inflow — день, для месячных метрик — 1-е число
+    metric: str
+
+def default_workers(ms: MSClient) -> int:
+    # столько задач в работе, сколько запросов помещается в квоту — темп всё равно держит лимитер
+    return max(1, int(ms.limiter.capacity) - ms.limiter.reserve)
+
+def month_tasks(w: Warehouse, y: int, m: int) -> list[Task]:
+    start, end = month_range(y, m)
+    tasks = [Task(w, start, start, "sales"), Task(w, start, start, "profit")]
+    d = start
+    while d <= end:
+        tasks.append(Task(w, start, d, "inflow"))
+        d += dt.timedelta(days=1)
+    return tasks
+
+async def run_task(ms: MSClient, t: Task) -> list[tuple[dt.date, dict]]:
+    """Одна задача (склад, день/месяц, метрика) -> строки для SalesDailyWriter: [(день, колонки)]."""
+    start, end = month_range(t.month.year, t.month.month)
+    if t.metric == "sales":
+        sales = await fetch_sales_plotseries(ms, t.w.ms_id, start, end)
+        out = []
+        d = start
+        while d <= end:
+            rev, checks = sales.get(d, (Decimal("0"), 0))
+            out.append((d, {"revenue": rev, "receipts_count": checks}))
+            d += dt.timedelta(days=1)
+        return out
+    if t.metric == "profit":
+        # себестоимость/возвраты/скидка — один отчёт за месяц, по дням только несошедшиеся;
+        # факты читаем своей короткой сессией до запросов в МС: коннект не держится через await,
+        # а ошибка SQL не ломает общую сессию writer'а
+        with SessionLocal() as rdb:
+            fact_end, sales = load_profit_facts(rdb, t.w.ms_id, start, end)
+        profit = await profit_range_from_facts(ms, t.w.ms_id, start, end, fact_end, sales)
+        return [(d, {"cost": c, "returns_cost": r, "discount": disc}) for d, (c, r, disc) in sorted(profit.items())]
+    if t.metric == "inflow":
+        return [(t.day, {"inflow_cost": await fetch_inflow_by_day(ms, t.w.ms_id, t.day)})]
+    raise ValueError(f"unknown metric: {t.metric}")
+
+async def run_tasks(ms: MSClient, db, tasks: list[Task], workers: int | None = None) -> int:
+    """
+    Очередь задач (склад, день, метрика) по всем складам и месяцам сразу: workers задач в работе,
+    темп запросов — общий лимитер клиента. Строки копятся по складо-месяцу и уходят
+    в SalesDailyWriter, только когда выполнены все его задачи; ok в sync_checkpoint — после записи.
+    При падении любой задачи складо-месяц — error: его накопленные строки выбрасываются,
+    остальные задачи (и уже летящие) в запись не попадают.
+    Возвращает число упавших складо-месяцев.
+    """
+    workers = workers or default_workers(ms)
+    queue: asyncio.Queue = asyncio.Queue()
+    left: dict[Unit, int] = {}
+    for t in tasks:
+        queue.put_nowait(t)
+        left[(t.w.id, t.month)] = left.get((t.w.id, t.month), 0) + 1
+    names = {t.w.id: t.w.name for t in tasks}
+    started: dict[Unit, float] = {}
+    failed: dict[Unit, str] = {}
+    ready: list[Unit] = []
+    pending: dict[Unit, list[tuple[dt.date, dict]]] = {}
+    print(f"== backfill: {len(tasks)} tasks, {len(left)} warehouse-months, workers={workers} ==")
+
+    def commit_ready():
+        writer.flush()
+        for u in ready:
+            mark(CHECKPOINT_JOB, u[0], u[1], "ok", duration_s=time.monotonic() - started[u])
+            print(f"[{names[u[0]]}] {u[1]:%Y-%m}: ok")
+        ready.clear()
+
+    async def worker():
+        while True:
+            try:
+                t = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            u = (t.w.id, t.month)
+            if u in failed:
+                continue
+            if u not in started:
+                started[u] = time.monotonic()
+                mark(CHECKPOINT_JOB, u[0], u[1], "running")
+            try:
+                rows = await run_task(ms, t)
+            except Exception as e:
+                if u in failed:
+                    continue
+                pending.pop(u, None)
+                failed[u] = f"{t.metric} {t.day}: {type(e).__name__}: {e}"
+                mark(CHECKPOINT_JOB, u[0], u[1], "error", duration_s=time.monotonic() - started[u],
+                     error=failed[u][:2000])
+                print(f"[{names[u[0]]}] {u[1]:%Y-%m}: FAIL {failed[u]}")
+                continue
+            if u in failed:
+                # складо-месяц упал, пока задача была в работе
+                continue
+            pending.setdefault(u, []).extend(rows)
+            left[u] -= 1
+            if left[u] == 0:
+                for d, values in pending.pop(u):
+                    writer.add(d, t.w.id, **values)
+                ready.append(u)
+                if len(ready) >= FLUSH_UNITS:
+                    commit_ready()
+
+    # плоский sync-контекст: writer синхронный, задачи пишут в него из одного event loop
+    with SalesDailyWriter(db) as writer:
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        commit_ready()
+    return len(failed)
+
+def plan(db, months: list[tuple[int, int]], resume: bool = True) -> list[Task]:
+    """Задачи по всем складам и месяцам; с resume складо-месяцы, отмеченные ok, пропускаются."""
     warehouses = db.query(Warehouse).all()
-    if not warehouses:
-        print("no warehouses in DB"); db.close(); return
-
-    async with httpx.AsyncClient(timeout=60.0, headers=HEADERS, http2=True) as ac:
+    if not warehouses or not months:
+        return []
+    first, _ = month_range(*months[0])
+    _, last = month_range(*months[-1])
+    done = done_units(CHECKPOINT_JOB, first, last) if resume else set()
+    tasks: list[Task] = []
+    # месяц за месяцем, внутри — все склады: ранние месяцы дописываются первыми
+    for y, m in months:
         for w in warehouses:
-            sales_map = await fetch_sales_plotseries(ac, w.ms_id, start, end)
-
-            sem_local = asyncio.Semaphore(max(1, concurrency))
-
-            async def one_day(d: dt.date):
-                async with sem_local:
-                    cost, ret_cost, disc = await fetch_profit_by_day(ac, w.ms_id, d)
-                    inflow = await fetch_inflow_by_day(ac, w.ms_id, d)
-                    rev, checks = sales_map.get(d, (Decimal("0"), 0))
-                    return d, rev, checks, cost, ret_cost, disc, inflow
-
-            days = []
-            cur = start
-            while cur <= end:
-                days.append(cur)
-                cur += dt.timedelta(days=1)
-
-            results = []
-            # небольшие порции, чтобы ровнее ложился rate-limit
-            chunk_size = max(3, concurrency * 2)
-            for i in range(0, len(days), chunk_size):
-                chunk = days[i:i+chunk_size]
-                results += await asyncio.gather(*[one_day(d) for d in chunk])
-                # пауза между пачками
-                await asyncio.sleep(0.5)
-
-            # один коммит на склад-месяц
-            for d, rev, checks, cost, ret_cost, disc, inflow in results:
-                ins = insert(SalesDaily).values(
-                    date=d, warehouse_id=w.id,
-                    revenue=rev, receipts_count=checks,
-                    cost=cost, returns_cost=ret_cost,
-                    discount=disc, inflow_cost=inflow,
-                )
-                up = ins.on_conflict_do_update(
-                    index_elements=[SalesDaily.date, SalesDaily.warehouse_id],
-                    set_={
-                        "revenue": ins.excluded.revenue,
-                        "receipts_count": ins.excluded.receipts_count,
-                        "cost": ins.excluded.cost,
-                        "returns_cost": ins.excluded.returns_cost,
-                        "discount": ins.excluded.discount,
-                        "inflow_cost": ins.excluded.inflow_cost,
-                    },
-                )
-                db.execute(up)
-            db.commit()
-            print(f"[{w.name}] {year}-{month:02d}: {len(results)} days upserted")
-
-    db.close()
-    print(f"month {year}-{month:02d} done")
-
-async def backfill_range(y_from: int, m_from: int, y_to: int, m_to: int):
+            if (w.id, dt.date(y, m, 1)) in done:
+                continue
+            tasks.extend(month_tasks(w, y, m))
+    return tasks
+
+def months_between(y_from: int, m_from: int, y_to: int, m_to: int) -> list[tuple[int, int]]:
+    out = []
     y, m = y_from, m_from
     while (y < y_to) or (y == y_to and m <= m_to):
-        await backfill_month_async(y, m, concurrency=2)
-        if m == 12:
-            y += 1; m = 1
-        else:
-            m += 1
+        out.append((y, m))
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return out
+
+async def backfill_range(y_from: int, m_from: int, y_to: int, m_to: int, resume: bool = True,
+                         workers: int | None = None, ms: Optional[MSClient] = None) -> int:
+    """Все месяцы диапазона по всем складам одной очередью задач. Возвращает число упавших складо-месяцев."""
+    if ms is None:
+        # один клиент (и пул соединений) на весь диапазон
+        async with MSClient() as own:
+            failed = await backfill_range(y_from, m_from, y_to, m_to, resume, workers, ms=own)
+            print(own.stats_line())
+        return failed
+
+    db = SessionLocal()
+    try:
+        tasks = plan(db, months_between(y_from, m_from, y_to, m_to), resume)
+        if not tasks:
+            print("nothing to do")
+            return 0
+        failed = await run_tasks(ms, db, tasks, workers)
+    finally:
+        db.close()
+    if failed:
+        print(f"failed warehouse-months: {failed} (rerun to retry)")
+    return failed
+
+async def backfill_month_async(year: int, month: int, workers: int | None = None, ms: Optional[MSClient] = None,
+                               resume: bool = True) -> int:
+    """Месяц по всем складам (та же очередь задач). Возвращает число упавших складов."""
+    return await backfill_range(year, month, year, month, resume, workers, ms)
 
 def main():
     import os
@@ -216,7 +225,10 @@ def main():
     m1 = int(os.environ.get("BF_FROM_MONTH"))
     y2 = int(os.environ.get("BF_TO_YEAR"))
     m2 = int(os.environ.get("BF_TO_MONTH"))
-    asyncio.run(backfill_range(y1, m1, y2, m2))
+    # BF_FORCE=1 — перезалить и то, что уже отмечено ok
+    # BF_WORKERS — задач в работе одновременно (по умолчанию — по квоте лимитера)
+    workers = int(os.environ.get("BF_WORKERS") or 0) or None
+    asyncio.run(backfill_range(y1, m1, y2, m2, resume=os.environ.get("BF_FORCE") != "1", workers=workers))
 
 if __name__ == "__main__":
     main()
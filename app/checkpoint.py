@@ -0,0 +1,63 @@
+import datetime as dt
+import time
+from contextlib import contextmanager
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from .db import SessionLocal
+from .models import SyncCheckpoint
+
+# warehouse_id для job, которые идут по дню сразу по всем складам
+ALL_WAREHOUSES = 0
+
+def done_units(job: str, start: dt.date, end: dt.date) -> set[tuple[int, dt.date]]:
+    """(warehouse_id, day) со статусом ok за период — их перезапуск пропускает."""
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(SyncCheckpoint.warehouse_id, SyncCheckpoint.day).where(
+                SyncCheckpoint.job == job,
+                SyncCheckpoint.status == "ok",
+                SyncCheckpoint.day.between(start, end),
+            )
+        ).all()
+    return {(r[0], r[1]) for r in rows}
+
+def mark(job: str, warehouse_id: int, day: dt.date, status: str,
+         rows: int = 0, duration_s: float = 0.0, error: str | None = None):
+    # своя сессия: отметка не зависит от транзакции загрузки (и переживает её откат)
+    ins = insert(SyncCheckpoint).values(
+        job=job, warehouse_id=warehouse_id, day=day, status=status,
+        rows=rows, duration_s=round(duration_s, 3), error=error,
+    )
+    with SessionLocal() as db:
+        db.execute(ins.on_conflict_do_update(
+            index_elements=[SyncCheckpoint.job, SyncCheckpoint.warehouse_id, SyncCheckpoint.day],
+            set_={
+                "status": ins.excluded.status,
+                "rows": ins.excluded.rows,
+                "duration_s": ins.excluded.duration_s,
+                "error": ins.excluded.error,
+                "updated_at": func.now(),
+            },
+        ))
+        db.commit()
+
+@contextmanager
+def track(job: str, warehouse_id: int, day: dt.date):
+    """
+    Отмечает единицу работы: running на входе, ok с числом строк и длительностью на выходе,
+    error с текстом исключения при падении (исключение пробрасывается дальше).
+
+        with track("writeoff_items", wh.id, day) as cp:
+            ...
+            cp["rows"] = n
+    """
+    cp = {"rows": 0}
+    t0 = time.monotonic()
+    mark(job, warehouse_id, day, "running")
+    try:
+        yield cp
+    except BaseException as e:
+        mark(job, warehouse_id, day, "error", cp["rows"], time.monotonic() - t0,
+             f"{type(e).__name__}: {e}"[:2000])
+        raise
+    mark(job, warehouse_id, day, "ok", cp["rows"], time.monotonic() - t0)
@@ -21,9 +21,14 @@ class Settings(BaseSettings):
     DB_NAME: str = Field(default="worker_analytics")
     DB_USER: str = Field(default="worker")
     DB_PASS: str = Field(default="worker_pass")
+    # пул async-движка API: ожидание соединения не занимает поток, поэтому пул шире синхронного
+    DB_ASYNC_POOL_SIZE: int = 20
+    DB_ASYNC_MAX_OVERFLOW: int = 20
 
     # Токен МойСклад (не обязателен для импорта конфига)
     MS_TOKEN: str | None = None
+    # запросов к МС в полёте одновременно на клиент (темп отдельно держит лимитер)
+    MS_MAX_IN_FLIGHT: int = 20
 
 # экземпляр настроек
 settings = Settings()
@@ -0,0 +1,201 @@
+import datetime as dt
+import json
+import threading
+from typing import Callable, Iterable, Optional
+from sqlalchemy import text
+from .config import settings
+from .checkpoint import ALL_WAREHOUSES
+
+# канал NOTIFY, по которому синки сообщают API, какие данные поменялись
+CHANNEL = "analytics_changed"
+
+# warehouse_id=None — изменение по всем складам (факты, которые грузятся по дню целиком)
+Span = tuple[Optional[int], dt.date, dt.date]
+
+# спанов в одном NOTIFY: payload у Postgres ограничен 8000 байт
+SPANS_PER_NOTIFY = 200
+
+def spans_from_cells(cells: Iterable[tuple[dt.date, Optional[int]]]) -> list[Span]:
+    """Ячейки (date, warehouse_id) -> по одному спану (warehouse_id, min date, max date) на склад."""
+    by_wh: dict[Optional[int], list[dt.date]] = {}
+    for d, wh in cells:
+        span = by_wh.setdefault(wh, [d, d])
+        span[0] = min(span[0], d)
+        span[1] = max(span[1], d)
+    return [(wh, a, b) for wh, (a, b) in by_wh.items()]
+
+# версия складо-месяцев спана — следующее значение общей последовательности: у любой новой записи
+# версия больше всех прежних, поэтому max() по набору ячеек меняется при любом их изменении
+_BUMP = """
+    INSERT INTO data_version (month, warehouse_id, version)
+    SELECT m::date, :wh, nextval('data_version_seq')
+      FROM generate_series(date_trunc('month', CAST(:a AS date)), CAST(:b AS date), interval '1 month') AS m
+    ON CONFLICT (month, warehouse_id) DO UPDATE SET version = EXCLUDED.version, updated_at = now()
+"""
+
+def notify_changed(conn, spans: Iterable[Span]):
+    """
+    Поднять data_version затронутых складо-месяцев и pg_notify в текущей транзакции conn
+    (Session или Connection): Postgres доставит сообщение слушателям только после COMMIT,
+    откат отменит и сообщение, и новые версии — API не узнает о незаписанном.
+    """
+    spans = list(spans)
+    for wh, a, b in spans:
+        conn.execute(text(_BUMP), {"wh": ALL_WAREHOUSES if wh is None else wh, "a": a, "b": b})
+    for i in range(0, len(spans), SPANS_PER_NOTIFY):
+        payload = json.dumps([[wh, a.isoformat(), b.isoformat()] for wh, a, b in spans[i:i + SPANS_PER_NOTIFY]])
+        conn.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": CHANNEL, "payload": payload})
+
+# изменения, не привязанные к датам: закупочные цены (assortment_price) влияют только на ТОП товаров —
+# у таких ответов своя тема, сбрасываются и получают новый ETag только они
+TOPIC_PRICES = "prices"
+
+_BUMP_TOPIC = """
+    INSERT INTO data_topic_version (topic, version) VALUES (:topic, nextval('data_version_seq'))
+    ON CONFLICT (topic) DO UPDATE SET version = EXCLUDED.version, updated_at = now()
+"""
+
+def notify_topic(conn, topic: str):
+    """Поднять версию темы и сообщить API ({"topic": ...}) в текущей транзакции conn — как notify_changed."""
+    conn.execute(text(_BUMP_TOPIC), {"topic": topic})
+    conn.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": CHANNEL, "payload": json.dumps({"topic": topic})})
+
+def parse_payload(payload: str) -> list[Span]:
+    return [(wh, dt.date.fromisoformat(a), dt.date.fromisoformat(b)) for wh, a, b in json.loads(payload)]
+
+def payload_topic(payload: str) -> Optional[str]:
+    """Тема сообщения notify_topic(); None — сообщение со спанами дат."""
+    msg = json.loads(payload)
+    return msg["topic"] if isinstance(msg, dict) else None
+
+class DataVersions:
+    """
+    Копия data_version в памяти API: load() при старте и после разрыва LISTEN, reload(spans) по
+    сообщениям синков. stamp() для периода и складов считается без обращения к БД.
+    """
+
+    def __init__(self):
+        self._v: dict[tuple[dt.date, int], tuple[int, dt.datetime]] = {}
+        self._month: dict[dt.date, tuple[int, dt.datetime]] = {}     # максимум по всем складам месяца
+        self._topics: dict[str, tuple[int, dt.datetime]] = {}
+        self._lock = threading.Lock()
+
+    def _query(self, where: str = "", params: dict | None = None):
+        from .db import SessionLocal
+        with SessionLocal() as db:
+            return db.execute(text(f"SELECT month, warehouse_id, version, updated_at FROM data_version {where}"),
+                              params or {}).fetchall()
+
+    def _apply(self, rows):
+        for r in rows:
+            cur = (r.version, r.updated_at)
+            self._v[(r.month, r.warehouse_id)] = cur
+            if r.month not in self._month or self._month[r.month][0] < cur[0]:
+                self._month[r.month] = cur
+
+    def _query_topics(self, topic: Optional[str] = None):
+        from .db import SessionLocal
+        where = "WHERE topic = :topic" if topic else ""
+        with SessionLocal() as db:
+            return db.execute(text(f"SELECT topic, version, updated_at FROM data_topic_version {where}"),
+                              {"topic": topic}).fetchall()
+
+    def load(self):
+        rows = self._query()
+        topics = self._query_topics()
+        with self._lock:
+            self._v.clear()
+            self._month.clear()
+            self._apply(rows)
+            self._topics = {r.topic: (r.version, r.updated_at) for r in topics}
+
+    def reload_topic(self, topic: str):
+        rows = self._query_topics(topic)
+        with self._lock:
+            for r in rows:
+                self._topics[r.topic] = (r.version, r.updated_at)
+
+    def reload(self, spans: Iterable[Span]):
+        for wh, a, b in spans:
+            where = "WHERE month BETWEEN :a AND :b"
+            if wh is not None:
+                where += " AND warehouse_id IN (:wh, :all)"
+            rows = self._query(where, {"a": a.replace(day=1), "b": b, "wh": wh, "all": ALL_WAREHOUSES})
+            with self._lock:
+                self._apply(rows)
+
+    def stamp(self, start: dt.date, end: dt.date, warehouses: Optional[Iterable[int]] = None,
+              topics: Iterable[str] = ()) -> tuple[int, Optional[dt.datetime]]:
+        """(максимальная версия, время её записи) по месяцам [start..end], складам (None — всем) и темам."""
+        whs = None if warehouses is None else set(warehouses) | {ALL_WAREHOUSES}
+        best: tuple[int, Optional[dt.datetime]] = (0, None)
+        m = start.replace(day=1)
+        with self._lock:
+            for t in topics:
+                cur = self._topics.get(t)
+                if cur and cur[0] > best[0]:
+                    best = cur
+            while m <= end:
+                if whs is None:
+                    cur = self._month.get(m)
+                    if cur and cur[0] > best[0]:
+                        best = cur
+                else:
+                    for w in whs:
+                        cur = self._v.get((m, w))
+                        if cur and cur[0] > best[0]:
+                            best = cur
+                m = dt.date(m.year + (m.month == 12), m.month % 12 + 1, 1)
+        return best
+
+def _conninfo() -> str:
+    return (
+        f"host={settings.DB_HOST} port={settings.DB_PORT} dbname={settings.DB_NAME} "
+        f"user={settings.DB_USER} password={settings.DB_PASS}"
+    )
+
+class ChangeListener(threading.Thread):
+    """
+    Фоновый поток API: LISTEN на CHANNEL отдельным соединением, на каждое сообщение — on_change(spans).
+    Соединение потеряно — переподключаемся и зовём on_reset(): пропущенные сообщения не восстановить.
+    """
+
+    def __init__(self, on_change: Callable[[list[Span]], None], on_reset: Callable[[], None],
+                 on_topic: Optional[Callable[[str], None]] = None, poll_s: float = 1.0):
+        super().__init__(name="analytics-change-listener", daemon=True)
+        self.on_change = on_change
+        self.on_reset = on_reset
+        self.on_topic = on_topic
+        self.poll_s = poll_s
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        import psycopg
+        first = True
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect(_conninfo(), autocommit=True) as conn:
+                    conn.execute(f"LISTEN {CHANNEL}")
+                    if not first:
+                        self.on_reset()
+                    first = False
+                    while not self._stop.is_set():
+                        for n in conn.notifies(timeout=self.poll_s):
+                            try:
+                                topic = payload_topic(n.payload)
+                                if topic is None:
+                                    self.on_change(parse_payload(n.payload))
+                                elif self.on_topic:
+                                    self.on_topic(topic)
+                                else:
+                                    self.on_reset()
+                            except (ValueError, TypeError, KeyError) as e:
+                                print(f"[{CHANNEL}] bad payload: {e}")
+                                self.on_reset()
+            except Exception as e:
+                print(f"[{CHANNEL}] listener error: {type(e).__name__}: {e}")
+                first = False
+                self._stop.wait(5.0)
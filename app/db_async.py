@@ -0,0 +1,18 @@
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from .config import settings
+from .db import _db_url
+
+# async-движок для роутов API (тот же psycopg 3, async-режим). Отдельным модулем:
+# sqlalchemy.ext.asyncio требует greenlet, синк-скриптам через db.py он не нужен
+async_engine = create_async_engine(
+    _db_url(),
+    pool_pre_ping=True,
+    pool_size=settings.DB_ASYNC_POOL_SIZE,
+    max_overflow=settings.DB_ASYNC_MAX_OVERFLOW,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# FastAPI dependency для async-роутов
+async def get_async_session():
+    async with AsyncSessionLocal() as session:
+        yield session
@@ -0,0 +1,40 @@
+import datetime as dt
+import json
+from decimal import Decimal
+from typing import Any, Iterable, Sequence
+from fastapi.responses import JSONResponse
+
+# orjson не обязателен: без него — тот же формат через стандартный json
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+def _default(o: Any):
+    # то, чего orjson/json не умеют сами: Decimal из Numeric-колонок, множества; date для json
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (set, frozenset, tuple)):
+        return list(o)
+    if isinstance(o, (dt.date, dt.datetime)):
+        return o.isoformat()
+    raise TypeError(f"not JSON serializable: {type(o).__name__}")
+
+def render_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON-ответ через orjson: date/datetime нативно, Decimal — в float без прохода jsonable_encoder.
+    Эндпоинт, который возвращает FastJSONResponse сам, минует сериализацию FastAPI целиком.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return render_json(content)
+
+def to_columns(rows: Sequence[dict], keys: Iterable[str] | None = None) -> dict[str, list]:
+    """Список строк-словарей -> колоночный вид {"date": [...], "revenue": [...]} (для графиков)."""
+    keys = list(keys) if keys is not None else (list(rows[0]) if rows else [])
+    return {k: [r.get(k) for r in rows] for k in keys}
@@ -1,24 +1,34 @@
 from fastapi import FastAPI, Request, Form, status, Depends, Query
-from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from pathlib import Path
-from sqlalchemy.orm import Session
-from sqlalchemy import select, func
-from datetime import datetime, date, timedelta
-import httpx
+from typing import Literal
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from datetime import datetime, date, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import time
 
 from .config import settings
-from .db import get_session
-from .models import Warehouse, SalesDaily
-from .api import get_revenue_daily, get_margin_daily, get_inflow_daily, get_summary
-try:
-    from sqlalchemy import text as _sa_text
-except Exception:  # на всякий случай (юнит-тесты/линтер без SA)
-    _sa_text = lambda x: x
+from .db_async import async_engine, get_async_session
+from .models import Warehouse
+from .ms_client import MSClient, BASE as MS_BASE
+from .api import (
+    get_revenue_daily_async, get_margin_daily_async, get_inflow_daily_async, get_summary_async,
+    get_summary_multi_async, get_top_products_async, get_top_warehouses_async, get_writeoff_daily_async,
+    get_writeoff_reasons_async, get_inflow_items_async, get_top_products_v2_async, get_top_products_v3_async,
+    top_product_item, summary_span,
+)
+from .json_response import FastJSONResponse, to_columns
+from .response_cache import MISS, response_cache, cached_endpoint, make_key, scope as cache_scope
+from .data_changes import TOPIC_PRICES, ChangeListener, DataVersions
 
 
 def is_public(path: str) -> bool:
@@ -51,7 +61,42 @@ def _is_public_path(path: str) -> bool:
         "/api/top/products_v2",
     )
     return any(path.startswith(a) for a in allow)
-app = FastAPI(title="Worker Analytics")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # один клиент МоегоСклада на процесс: пул соединений живёт между запросами
+    app.state.ms = MSClient()
+    # версии данных для ETag — из БД при старте, дальше по сообщениям синков
+    try:
+        await run_in_threadpool(data_versions.load)
+    except Exception as e:
+        print(f"data_version load failed: {type(e).__name__}: {e}")
+    # синки сообщают через NOTIFY, какие даты/склады поменялись — сбрасываем только их ответы;
+    # сначала кэш, потом версии: новый ETag не должен достаться старому закэшированному ответу
+    def on_change(spans):
+        response_cache.invalidate(spans)
+        data_versions.reload(spans)
+
+    def on_topic(topic):
+        response_cache.invalidate_topic(topic)
+        data_versions.reload_topic(topic)
+
+    def on_reset():
+        response_cache.clear()
+        data_versions.load()
+
+    listener = ChangeListener(on_change=on_change, on_reset=on_reset, on_topic=on_topic)
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        await app.state.ms.close()
+        await async_engine.dispose()
+
+# ответы по умолчанию — через orjson (date/Decimal без jsonable_encoder); эндпоинты с большими
+# сериями возвращают FastJSONResponse сами, чтобы FastAPI не обходил payload своим энкодером
+app = FastAPI(title="Worker Analytics", lifespan=lifespan, default_response_class=FastJSONResponse)
 app.mount("/static", StaticFiles(directory=Path(__file__).parent / "static"), name="static")
 
 # CORS
@@ -66,9 +111,86 @@ app.add_middleware(
 WHITELIST_EXACT = {"/login", "/health"}
 WHITELIST_PREFIXES = ("/static", "/favicon.ico")
 
-from sqlalchemy import text as _sqlalchemy_text
+data_versions = DataVersions()
+
+# эндпоинты с ETag: путь -> span периода, от которого зависит ответ (как у cached_endpoint)
+ETAG_PATHS = {
+    "/api/summary": summary_span,
+    "/api/summary/multi": summary_span,
+    "/api/top/warehouses": None,
+    "/api/top/products": None,
+    "/api/top/products_v3": None,
+    "/api/writeoff/daily": None,
+    "/api/writeoff/reasons": None,
+    "/api/inflow/items": None,
+}
+# серии за последние days дней (по всем складам): период — [сегодня - days .. сегодня]
+ETAG_DAYS_PATHS = {"/api/revenue/daily", "/api/margin/daily", "/api/inflow/daily"}
+# warehouse_id здесь — UUID склада МС, а не локальный id: версия берётся по всем складам
+ETAG_ANY_WAREHOUSE = {"/api/inflow/items"}
+# ответы, зависящие ещё и от тем data_changes.notify_topic (себестоимость ТОПа — от закупочных цен)
+ETAG_TOPICS = {"/api/top/products": (TOPIC_PRICES,)}
+# /api/top/products_v2 без ETag: имена товаров из справочника product не ведут data_version
+DAILY_DAYS = 60
+# поднять при смене формата ответов, чтобы старые ETag браузеров перестали совпадать
+ETAG_FORMAT = "1"
+
+class ETagMiddleware(BaseHTTPMiddleware):
+    """
+    ETag = хэш запроса + максимальная data_version складо-месяцев периода (из памяти, без БД).
+    If-None-Match совпал — 304 сразу, эндпоинт и БД не трогаются.
+    """
+    async def dispatch(self, request: Request, call_next):
+        path = (request.url.path or "/").rstrip("/")
+        q = request.query_params
+        if request.method != "GET" or (q.get("refresh") or "").lower() in ("1", "true", "yes", "on") \
+                or (path not in ETAG_PATHS and path not in ETAG_DAYS_PATHS):
+            return await call_next(request)
+        try:
+            if path in ETAG_DAYS_PATHS:
+                days = int(q.get("days") or DAILY_DAYS)
+                if not 1 <= days <= 365:
+                    raise ValueError(days)
+                e = date.today()
+                s = e - timedelta(days=days)
+                whs = None
+            else:
+                s = date.fromisoformat(q["start"])
+                e = date.fromisoformat(q["end"])
+                whs = None if path in ETAG_ANY_WAREHOUSE else ([int(x) for x in q.getlist("warehouse_id") if x] or None)
+                span = ETAG_PATHS[path]
+                if span:
+                    s, e = span(s, e)
+        except (KeyError, ValueError):
+            # ошибку параметров отдаст сам эндпоинт
+            return await call_next(request)
 
-_sa_text = None
+        version, updated = data_versions.stamp(s, e, whs, ETAG_TOPICS.get(path, ()))
+        # период в ключе: у серий за days дней он сдвигается вместе с датой
+        key = hashlib.sha1(f"{ETAG_FORMAT}|{path}|{s}|{e}|{sorted(q.multi_items())}".encode()).hexdigest()[:16]
+        etag = f'W/"{key}-{version}"'
+        # no-cache: браузер хранит ответ, но каждый раз переспрашивает с If-None-Match
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if updated:
+            headers["Last-Modified"] = format_datetime(updated.astimezone(timezone.utc), usegmt=True)
+
+        inm = request.headers.get("if-none-match")
+        if inm:
+            if inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]:
+                return Response(status_code=304, headers=headers)
+        elif updated and request.headers.get("if-modified-since"):
+            try:
+                if parsedate_to_datetime(request.headers["if-modified-since"]) >= updated.replace(microsecond=0):
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+
+        resp = await call_next(request)
+        if resp.status_code == 200:
+            resp.headers.update(headers)
+        return resp
+
+app.add_middleware(ETagMiddleware)
 
 class AuthRequiredMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -133,48 +255,80 @@ def health():
 
 # ===== API: существующие =====
 
+# вид серий: rows — [{"date": .., "revenue": ..}, ..]; columns — {"date": [..], "revenue": [..]}
+SeriesFormat = Literal["rows", "columns"]
+
 @app.get("/api/revenue/daily")
-def api_revenue_daily(days: int = Query(60, ge=1, le=365), session: Session = Depends(get_session)):
+async def api_revenue_daily(days: int = Query(DAILY_DAYS, ge=1, le=365), format: SeriesFormat = "rows",
+                            session: AsyncSession = Depends(get_async_session)):
     try:
-        data = get_revenue_daily(session, days=days)
-        return {"data": data}
+        data = await get_revenue_daily_async(session, days=days, columns=format == "columns")
+        return FastJSONResponse({"data": data})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.get("/api/margin/daily")
-def api_margin_daily(days: int = Query(60, ge=1, le=365), session: Session = Depends(get_session)):
+async def api_margin_daily(days: int = Query(DAILY_DAYS, ge=1, le=365), format: SeriesFormat = "rows",
+                           session: AsyncSession = Depends(get_async_session)):
     try:
-        data = get_margin_daily(session, days=days)
-        return {"data": data}
+        data = await get_margin_daily_async(session, days=days, columns=format == "columns")
+        return FastJSONResponse({"data": data})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.get("/api/inflow/daily")
-def api_inflow_daily(days: int = Query(60, ge=1, le=365), session: Session = Depends(get_session)):
+async def api_inflow_daily(days: int = Query(DAILY_DAYS, ge=1, le=365), format: SeriesFormat = "rows",
+                           session: AsyncSession = Depends(get_async_session)):
     try:
-        data = get_inflow_daily(session, days=days)
-        return {"data": data}
+        data = await get_inflow_daily_async(session, days=days, columns=format == "columns")
+        return FastJSONResponse({"data": data})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.get("/api/warehouses")
-def api_warehouses(session: Session = Depends(get_session)):
-    rows = session.query(Warehouse.id, Warehouse.name).order_by(Warehouse.name.asc()).all()
+async def api_warehouses(session: AsyncSession = Depends(get_async_session)):
+    rows = (await session.execute(select(Warehouse.id, Warehouse.name).order_by(Warehouse.name.asc()))).fetchall()
     return {"data": [{"id": r.id, "name": r.name} for r in rows]}
 
 @app.get("/api/summary")
-def api_summary(
+@cached_endpoint("summary", span=summary_span)
+async def api_summary(
     request: Request,
     start: str,
     end: str,
     group: str = "day",
     warehouse_id: int | None = None,
-    session: Session = Depends(get_session),
+    format: SeriesFormat = "rows",
+    session: AsyncSession = Depends(get_async_session),
 ):
     try:
         start_d = datetime.strptime(start, "%Y-%m-%d").date()
         end_d = datetime.strptime(end, "%Y-%m-%d").date()
-        data = get_summary(session, start=start_d, end=end_d, granularity=group, warehouse_id=warehouse_id)
+        data = await get_summary_async(session, start=start_d, end=end_d, granularity=group, warehouse_id=warehouse_id)
+        if format == "columns":
+            data["series"] = to_columns(data["series"])
+        return data
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/api/summary/multi")
+@cached_endpoint("summary_multi", span=summary_span)
+async def api_summary_multi(
+    start: str,
+    end: str,
+    group: str = "day",
+    warehouse_id: list[int] | None = Query(None),
+    format: SeriesFormat = "rows",
+    session: AsyncSession = Depends(get_async_session),
+):
+    # несколько складов одним запросом: ?warehouse_id=1&warehouse_id=2; без warehouse_id — все склады
+    try:
+        start_d = datetime.strptime(start, "%Y-%m-%d").date()
+        end_d = datetime.strptime(end, "%Y-%m-%d").date()
+        data = await get_summary_multi_async(session, start=start_d, end=end_d, granularity=group, warehouse_ids=warehouse_id)
+        if format == "columns":
+            for block in data["warehouses"] + [data["combined"]]:
+                block["series"] = to_columns(block["series"])
         return data
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -182,112 +336,116 @@ def api_summary(
 # ===== Новые API: ТОП складов (из БД) и ТОП товаров (из МоегоСклада) =====
 
 @app.get("/api/top/warehouses")
-def api_top_warehouses(
+@cached_endpoint("top_warehouses")
+async def api_top_warehouses(
     start: str,
     end: str,
     limit: int = Query(5, ge=1, le=20),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     s = datetime.strptime(start, "%Y-%m-%d").date()
     e = datetime.strptime(end, "%Y-%m-%d").date()
-    stmt = (
-        select(
-            Warehouse.name.label("warehouse"),
-            func.sum(SalesDaily.revenue).label("revenue"),
-            func.sum(SalesDaily.cost).label("cost"),
-            func.sum(SalesDaily.receipts_count).label("checks"),
-        )
-        .join(Warehouse, Warehouse.id == SalesDaily.warehouse_id)
-        .where(SalesDaily.date >= s, SalesDaily.date <= e)
-        .group_by(Warehouse.name)
-        .order_by(func.sum(SalesDaily.revenue).desc())
-        .limit(limit)
-    )
-    rows = session.execute(stmt).fetchall()
-    out = []
-    for r in rows:
-        rev = float(r.revenue or 0)
-        cost = float(r.cost or 0)
-        gp = rev - cost
-        out.append({
-            "warehouse": r.warehouse,
-            "revenue": rev,
-            "gross_profit": gp,
-            "margin_pct": (gp / rev * 100.0) if rev else 0.0,
-            "checks": int(r.checks or 0),
-            "avg_ticket": (rev / int(r.checks)) if int(r.checks or 0) else 0.0,
-        })
-    return {"data": out}
+    return {"data": await get_top_warehouses_async(session, s, e, limit)}
 
-@app.get("/api/top/products")
-def api_top_products(
-    start: str,
-    end: str,
-    warehouse_id: int | None = None,
-    limit: int = Query(10, ge=1, le=50),
-    session: Session = Depends(get_session),
-):
-    # если указан склад, получаем его ms_id
-    store_ms_id = None
-    if warehouse_id:
-        w = session.query(Warehouse).filter(Warehouse.id == warehouse_id).first()
-        if not w:
-            return JSONResponse(status_code=400, content={"error": "warehouse_id not found"})
-        store_ms_id = w.ms_id
-
-    MS_BASE = settings.MS_BASE_URL.rstrip("/")
-    headers = {
-        "Authorization": f"Bearer {settings.MS_API_TOKEN}",
-        "Accept": "application/json;charset=utf-8",
-        "Content-Type": "application/json",
-        "User-Agent": "worker-analytics/top-products",
-    }
+async def _top_products_live(ms: MSClient, start: str, end: str, store_ms_id: str | None) -> list:
+    """report/profit/byproduct из МоегоСклада, все страницы (а не только первые 1000 строк)."""
     params = {
         "momentFrom": f"{start} 00:00:00",
         "momentTo": f"{end} 23:59:59",
-        "limit": 1000,
     }
     if store_ms_id:
         params["filter"] = f"store={MS_BASE}/entity/store/{store_ms_id}"
 
-    with httpx.Client(timeout=60.0, headers=headers) as c:
-        r = c.get(f"{MS_BASE}/report/profit/byproduct", params=params)
-        r.raise_for_status()
-        data = r.json()
-
     agg = {}
-    for row in (data.get("rows") or []):
-        name = None
-        code = None
-        try:
-            ass = row.get("assortment") or {}
-            name = ass.get("name") or "Без названия"
-            code = ass.get("code") or ""
-        except Exception:
-            name = "Без названия"
+    async for row in ms.paged("/report/profit/byproduct", params=params):
+        ass = row.get("assortment") or {}
+        name = ass.get("name") or "Без названия"
+        code = ass.get("code") or ""
         key = f"{name} {('['+code+']') if code else ''}".strip()
         ssum = float(row.get("sellSum", 0) or 0) / 100.0
-        scost = float(row.get("sellCostSum", 0) or 0) / 100.0
         qty = float(row.get("sellQuantity", 0) or 0)
-        ret_cost = float(row.get("returnCostSum", 0) or 0) / 100.0
         price = float(row.get("sellPrice", 0) or 0) / 100.0
-        disc = price * qty - ssum
-        a = agg.setdefault(key, {"name": key, "revenue": 0.0, "cost": 0.0, "qty": 0.0, "discount": 0.0, "returns_cost": 0.0})
+        a = agg.setdefault(key, {"revenue": 0.0, "cost": 0.0, "qty": 0.0, "discount": 0.0, "returns_cost": 0.0})
         a["revenue"] += ssum
-        a["cost"] += scost
+        a["cost"] += float(row.get("sellCostSum", 0) or 0) / 100.0
         a["qty"] += qty
-        a["discount"] += disc
-        a["returns_cost"] += ret_cost
+        a["discount"] += price * qty - ssum
+        a["returns_cost"] += float(row.get("returnCostSum", 0) or 0) / 100.0
 
-    items = list(agg.values())
+    items = [top_product_item(k, **v) for k, v in agg.items()]
     items.sort(key=lambda x: x["revenue"], reverse=True)
-    items = items[:limit]
-    for it in items:
-        it["gross_profit"] = it["revenue"] - it["cost"]
-        it["margin_pct"] = (it["gross_profit"] / it["revenue"] * 100.0) if it["revenue"] else 0.0
-        it["avg_price"] = (it["revenue"] / it["qty"]) if it["qty"] else 0.0
+    return items
+
+# refresh=1 ходит в МойСклад за всеми страницами отчёта — не чаще раза в TOP_REFRESH_INTERVAL_S с одного адреса
+TOP_REFRESH_INTERVAL_S = 30
+_top_refresh_last: dict[str, float] = {}
+
+def _top_refresh_wait(request: Request) -> float:
+    """Сколько секунд ещё ждать этому клиенту до следующего refresh=1 (0 — можно сейчас)."""
+    now = time.monotonic()
+    client = request.client.host if request.client else "-"
+    wait = _top_refresh_last.get(client, float("-inf")) + TOP_REFRESH_INTERVAL_S - now
+    if wait > 0:
+        return wait
+    if len(_top_refresh_last) > 1024:
+        for k in [k for k, t in _top_refresh_last.items() if t + TOP_REFRESH_INTERVAL_S <= now]:
+            del _top_refresh_last[k]
+    _top_refresh_last[client] = now
+    return 0
+
+@app.get("/api/top/products")
+async def api_top_products(
+    request: Request,
+    start: str,
+    end: str,
+    warehouse_id: int | None = None,
+    limit: int = Query(10, ge=1, le=50),
+    refresh: bool = Query(False, description="пересчитать по отчёту прибыльности МоегоСклада"),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """
+    ТОП товаров за период. По умолчанию — из локальных фактов (sales_item_fact + assortment_price),
+    результат кэшируется на (период, склад) в общем response_cache. refresh=1 — явный пересчёт
+    по отчёту МоегоСклада: только для вошедших пользователей и с ограничением частоты,
+    не кэшируется и не получает ETag — кэш и ETag остаются только за локальным результатом.
+    """
+    try:
+        s = datetime.strptime(start, "%Y-%m-%d").date()
+        e = datetime.strptime(end, "%Y-%m-%d").date()
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "start/end must be YYYY-MM-DD"})
+    if refresh:
+        # ручка публичная, но живой отчёт — нет
+        if "session" in request.scope and not request.session.get("user"):
+            return JSONResponse(status_code=401, content={"error": "refresh requires login"})
+        wait = _top_refresh_wait(request)
+        if wait:
+            return JSONResponse(status_code=429, content={"error": "refresh rate limited"},
+                                headers={"Retry-After": str(int(wait) + 1)})
+
+    # если указан склад, получаем его ms_id
+    store_ms_id = None
+    if warehouse_id:
+        store_ms_id = (await session.execute(select(Warehouse.ms_id).where(Warehouse.id == warehouse_id))).scalar()
+        if not store_ms_id:
+            return JSONResponse(status_code=400, content={"error": "warehouse_id not found"})
+
+    if refresh:
+        items = await _top_products_live(request.app.state.ms, start, end, store_ms_id)
+        return {"data": items[:limit], "source": "moysklad"}
 
-    return {"data": items}
+    # кэш — полный отсортированный список на (период, склад), limit режется при ответе;
+    # сбрасывается сообщениями синков о новых фактах за эти даты
+    key = make_key("top_products", {"start": start, "end": end, "warehouse_id": warehouse_id})
+    hit = response_cache.get(key)
+    epoch = response_cache.epoch()
+    if hit is MISS:
+        items = await get_top_products_async(session, s, e, store_ms_id)
+        hit = {"source": "local", "items": items}
+        # себестоимость — из закупочных цен: запись сбрасывается и по их изменению (TOPIC_PRICES)
+        response_cache.put(key, hit, cache_scope(s, e, warehouse_id, (TOPIC_PRICES,)), epoch)
+
+    return {"data": hit["items"][:limit], "source": hit["source"]}
 
 # ===== Dashboard =====
 
@@ -415,11 +573,13 @@ def not_found_handler(request: Request, exc: StarletteHTTPException):
 # ===== NEW: Writeoff APIs =====
 
 @app.get("/api/writeoff/daily")
-def api_writeoff_daily(
+@cached_endpoint("writeoff_daily")
+async def api_writeoff_daily(
     start: str,
     end: str,
     warehouse_id: int | None = None,
-    session: Session = Depends(get_session),
+    format: SeriesFormat = "rows",
+    session: AsyncSession = Depends(get_async_session),
 ):
     """
     Агрегация списаний по дням из sales_daily:
@@ -427,396 +587,63 @@ def api_writeoff_daily(
     """
     s = datetime.strptime(start, "%Y-%m-%d").date()
     e = datetime.strptime(end, "%Y-%m-%d").date()
-    stmt = (
-        select(
-            SalesDaily.date.label("date"),
-            Warehouse.name.label("warehouse"),
-            func.sum(SalesDaily.writeoff_cost_total).label("total"),
-            func.sum(SalesDaily.writeoff_cost_defect).label("defect"),
-            func.sum(SalesDaily.writeoff_cost_inventory).label("inventory"),
-            func.sum(SalesDaily.writeoff_cost_other).label("other"),
-        )
-        .join(Warehouse, Warehouse.id == SalesDaily.warehouse_id)
-        .where(SalesDaily.date >= s, SalesDaily.date <= e)
-        .group_by(SalesDaily.date, Warehouse.name)
-        .order_by(SalesDaily.date.asc(), Warehouse.name.asc())
-    )
-    if warehouse_id:
-        stmt = stmt.where(SalesDaily.warehouse_id == warehouse_id)
-
-    rows = session.execute(stmt).fetchall()
-    out = []
-    for r in rows:
-        total = float(r.total or 0)
-        defect = float(r.defect or 0)
-        inventory = float(r.inventory or 0)
-        other = float(r.other or 0)
-        out.append({
-            "date": r.date.isoformat(),
-            "warehouse": r.warehouse,
-            "total": total,
-            "defect": defect,
-            "inventory": inventory,
-            "other": other,
-            "defect_pct": (defect/total*100.0) if total else 0.0,
-            "inventory_pct": (inventory/total*100.0) if total else 0.0,
-            "other_pct": (other/total*100.0) if total else 0.0,
-        })
-    return {"data": out}
+    return {"data": await get_writeoff_daily_async(session, s, e, warehouse_id, columns=format == "columns")}
 
 @app.get("/api/writeoff/reasons")
-def api_writeoff_reasons(
+@cached_endpoint("writeoff_reasons")
+async def api_writeoff_reasons(
     start: str,
     end: str,
     warehouse_id: int | None = None,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     """
     Разбивка списаний по причинам из writeoff_daily_reason (как в БД, без нормализации).
     """
-    from sqlalchemy import text
     s = datetime.strptime(start, "%Y-%m-%d").date()
     e = datetime.strptime(end, "%Y-%m-%d").date()
-
-    if warehouse_id:
-        sql = text("""
-          SELECT date, warehouse_id, reason, SUM(cost) AS cost
-          FROM writeoff_daily_reason
-          WHERE date BETWEEN :s AND :e AND warehouse_id = :wid
-          GROUP BY date, warehouse_id, reason
-          ORDER BY date ASC, warehouse_id ASC, reason ASC
-        """)
-        rows = session.execute(sql, {"s": s, "e": e, "wid": warehouse_id}).fetchall()
-    else:
-        sql = text("""
-          SELECT date, warehouse_id, reason, SUM(cost) AS cost
-          FROM writeoff_daily_reason
-          WHERE date BETWEEN :s AND :e
-          GROUP BY date, warehouse_id, reason
-          ORDER BY date ASC, warehouse_id ASC, reason ASC
-        """)
-        rows = session.execute(sql, {"s": s, "e": e}).fetchall()
-
-    wh_map = {w.id: w.name for w in session.query(Warehouse).all()}
-    out = []
-    for r in rows:
-        out.append({
-            "date": r.date.isoformat(),
-            "warehouse_id": int(r.warehouse_id),
-            "warehouse": wh_map.get(int(r.warehouse_id), f"id={r.warehouse_id}"),
-            "reason": r.reason or "",
-            "cost": float(r.cost or 0),
-        })
-    return {"data": out}
+    return {"data": await get_writeoff_reasons_async(session, s, e, warehouse_id)}
 
 @app.get("/api/inflow/items")
-def api_inflow_items(
-    start: str = Query(..., description="YYYY-MM-DD"),
-    end: str = Query(..., description="YYYY-MM-DD"),
-    warehouse_id: str = Query(None, description="UUID склада"),
-    limit: int = Query(500, ge=1, le=5000),
-    session = Depends(get_session),
-):
-    # Позиции оприходований за период (и опционально по складу)
-    q = (
-        "SELECT i.date, i.warehouse_id, w.name AS warehouse, "
-        "i.product_id, i.qty, i.price, i.cost, i.inventory_based "
-        "FROM inflow_item_fact i "
-        "JOIN warehouse w ON w.ms_id = i.warehouse_id::text "
-        "WHERE i.date BETWEEN :start AND :end "
-        "{wh_filter} "
-        "ORDER BY i.date DESC "
-        "LIMIT :limit"
-    )
-    wh_filter = ""
-    params = {"start": start, "end": end, "limit": limit}
-    if warehouse_id:
-        wh_filter = "AND i.warehouse_id::text = :wh"
-        params["wh"] = warehouse_id
-    q = q.format(wh_filter=wh_filter)
-    from sqlalchemy import text as _sa_text  # local
-    rows = session.execute(_sa_text(q), params).mappings().all()
-    return {"data": [dict(r) for r in rows]}
-
-@app.get("/api/inflow/items")
-def api_inflow_items(
+async def api_inflow_items(
     start: str = Query(..., description="YYYY-MM-DD"),
     end: str = Query(..., description="YYYY-MM-DD"),
     warehouse_id: str | None = Query(None, description="UUID склада"),
     limit: int = Query(500, ge=1, le=5000),
-    session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     """
     Позиции оприходований по периоду (и опционально по складу).
     Источник: inflow_item_fact. Денежные поля в рублях.
     """
-    q = (
-        "SELECT "
-        "  i.date, "
-        "  i.warehouse_id, "
-        "  w.name AS warehouse, "
-        "  i.product_id, "
-        "  i.qty, "
-        "  i.price, "
-        "  i.cost, "
-        "  i.inventory_based "
-        "FROM inflow_item_fact i "
-        "JOIN warehouse w ON i.warehouse_id::text = w.ms_id "
-        "WHERE i.date BETWEEN :start AND :end "
-        "{wh_filter} "
-        "ORDER BY i.date DESC "
-        "LIMIT :limit"
-    )
-    wh_filter = ""
-    params = {"start": start, "end": end, "limit": limit}
-    if warehouse_id:
-        wh_filter = "AND i.warehouse_id::text = :wh "
-        params["wh"] = warehouse_id
-    q = q.format(wh_filter=wh_filter)
-    from sqlalchemy import text as _sa_text  # local
-    rows = session.execute(_sa_text(q), params).mappings().all()
-    return {"data": [dict(r) for r in rows]}
-
+    s = datetime.strptime(start, "%Y-%m-%d").date()
+    e = datetime.strptime(end, "%Y-%m-%d").date()
+    return {"data": await get_inflow_items_async(session, s, e, warehouse_id, limit)}
 
 @app.get("/api/top/products_v2")
-def api_top_products_v2(
+async def api_top_products_v2(
     start: str = Query(..., description="YYYY-MM-DD"),
     end: str = Query(..., description="YYYY-MM-DD"),
     limit: int = Query(20, ge=1, le=1000),
-    sort_by: str = Query("revenue", description="revenue|sold_qty|avg_price|inflow_qty|inflow_cost|product_id"),
+    sort_by: str = Query("revenue", description="revenue|sold_qty|avg_price|inflow_qty|inflow_cost|product_id|name"),
     order: str = Query("desc", description="asc|desc"),
     min_qty: float = Query(0),
     min_revenue: float = Query(0),
-    session = Depends(get_session),
-):
-    """
-    Агрегаты по товарам за период, с фильтрами/сортировкой.
-    """
-    # Белый список сортируемых полей
-    sort_map = {
-        "revenue": "revenue",
-        "sold_qty": "sold_qty",
-        "avg_price": "avg_price",
-        "inflow_qty": "inflow_qty",
-        "inflow_cost": "inflow_cost",
-        "product_id": "product_id",
-    }
-    sort_col = sort_map.get((sort_by or "").lower(), "revenue")
-    ord_kw = "ASC" if (order or "").lower() == "asc" else "DESC"
-
-    # SQL: считаем отдельно продажи и оприходование, потом FULL JOIN, после чего фильтры по агрегатам
-    q = (
-        "WITH sales AS ("
-        "  SELECT product_id::text AS product_id,"
-        "         SUM(revenue) AS revenue,"
-        "         SUM(qty) AS sold_qty,"
-        "         CASE WHEN SUM(qty)=0 THEN 0 ELSE SUM(revenue)/SUM(qty) END AS avg_price "
-        "  FROM sales_item_fact "
-        "  WHERE date BETWEEN :start AND :end "
-        "  GROUP BY 1"
-        "), "
-        "inflow AS ("
-        "  SELECT product_id::text AS product_id,"
-        "         SUM(qty) AS inflow_qty,"
-        "         SUM(cost) AS inflow_cost "
-        "  FROM inflow_item_fact "
-        "  WHERE date BETWEEN :start AND :end "
-        "  GROUP BY 1"
-        ") "
-        "SELECT COALESCE(s.product_id, i.product_id) AS product_id, "
-        "       COALESCE(s.revenue,0) AS revenue, "
-        "       COALESCE(s.sold_qty,0) AS sold_qty, "
-        "       COALESCE(s.avg_price,0) AS avg_price, "
-        "       COALESCE(i.inflow_qty,0) AS inflow_qty, "
-        "       COALESCE(i.inflow_cost,0) AS inflow_cost "
-        "FROM sales s FULL JOIN inflow i USING (product_id) "
-        "WHERE COALESCE(s.sold_qty,0) >= :min_qty "
-        "  AND COALESCE(s.revenue,0)  >= :min_revenue "
-        f"ORDER BY {sort_col} {ord_kw} NULLS LAST "
-        "LIMIT :limit"
-    )
-
-    params = {
-        "start": start,
-        "end": end,
-        "limit": int(limit or 20),
-        "min_qty": float(min_qty or 0),
-        "min_revenue": float(min_revenue or 0),
-    }
-
-    rows = session.execute(_sa_text(q), params).mappings().all()
-    return {"data": [dict(r) for r in rows]}
-@app.get("/api/top/products_v2")
-def api_top_products_v2(
-    start: str = Query(..., description="YYYY-MM-DD"),
-    end: str = Query(..., description="YYYY-MM-DD"),
-    limit: int = Query(20, ge=1, le=1000),
-    sort_by: str = Query("revenue"),
-    order: str = Query("desc"),
-    min_qty: float = Query(0),
-    min_revenue: float = Query(0),
-    session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     """
     Топ товаров за период (продажи + приход), с именем товара и сортировкой.
     """
-    # безопасная валидация сортировки
-    sort_map = {
-        "revenue": "revenue",
-        "sold_qty": "sold_qty",
-        "avg_price": "avg_price",
-        "inflow_qty": "inflow_qty",
-        "inflow_cost": "inflow_cost",
-        "name": "name"
-    }
-    col = sort_map.get(sort_by, "revenue")
-    ord_sql = "DESC" if str(order).lower() == "desc" else "ASC"
-    order_expr = f"{col} {ord_sql}"
-
-    q = """
-    WITH sales AS (
-      SELECT
-        product_id::text AS product_id,
-        SUM(revenue) AS revenue,
-        SUM(qty) AS sold_qty,
-        CASE WHEN SUM(qty)=0 THEN 0 ELSE SUM(revenue)/SUM(qty) END AS avg_price
-      FROM sales_item_fact
-      WHERE date BETWEEN :start AND :end
-      GROUP BY 1
-    ),
-    inflow AS (
-      SELECT
-        product_id::text AS product_id,
-        SUM(qty) AS inflow_qty,
-        SUM(cost) AS inflow_cost
-      FROM inflow_item_fact
-      WHERE date BETWEEN :start AND :end
-      GROUP BY 1
-    ),
-    merged AS (
-      SELECT
-        COALESCE(s.product_id, i.product_id) AS product_id,
-        COALESCE(s.revenue, 0)      AS revenue,
-        COALESCE(s.sold_qty, 0)     AS sold_qty,
-        COALESCE(s.avg_price, 0)    AS avg_price,
-        COALESCE(i.inflow_qty, 0)   AS inflow_qty,
-        COALESCE(i.inflow_cost, 0)  AS inflow_cost
-      FROM sales s
-      FULL JOIN inflow i USING (product_id)
-    )
-    SELECT
-      m.product_id,
-      p.name,
-      ROUND(m.revenue::numeric, 2)       AS revenue,
-      m.sold_qty,
-      ROUND(m.avg_price::numeric, 2)     AS avg_price,
-      m.inflow_qty,
-      ROUND(m.inflow_cost::numeric, 2)   AS inflow_cost
-    FROM merged m
-    LEFT JOIN product p ON p.ms_id::uuid = m.product_id::uuid
-    WHERE m.sold_qty >= :min_qty AND m.revenue >= :min_rev
-    ORDER BY {order_expr}
-    LIMIT :limit
-    """.format(order_expr=order_expr)
-
-    global _sa_text
-    if _sa_text is None:
-        try:
-            _sa_text = _sqlalchemy_text  # типизированный импорт, который у нас уже есть
-        except Exception:
-            from sqlalchemy import text as _sa_text  # запасной путь
-
-    params = {
-        "start": start,
-        "end": end,
-        "limit": limit,
-        "min_qty": min_qty,
-        "min_rev": min_revenue,
-    }
-    rows = session.execute(_sa_text(q), params).mappings().all()
-    # приводим к dict + ensure float
-    out = []
-    for r in rows:
-        d = dict(r)
-        # на всякий случай float-каст денег
-        for k in ("revenue", "avg_price", "inflow_cost"):
-            if d.get(k) is not None:
-                d[k] = float(d[k])
-        if d.get("inflow_qty") is not None:
-            d["inflow_qty"] = float(d["inflow_qty"])
-        if d.get("sold_qty") is not None:
-            d["sold_qty"] = float(d["sold_qty"])
-        out.append(d)
-    return {"data": out}
-
-@app.get("/api/top/products_v3")
-def api_top_products_v3(
-    start: str = Query(..., description="YYYY-MM-DD"),
-    end: str = Query(..., description="YYYY-MM-DD"),
-    limit: int = Query(20, ge=1, le=1000),
-    sort_by: str = Query("revenue", description="revenue|sold_qty|avg_price|inflow_qty|inflow_cost|product_id"),
-    order: str = Query("desc", description="asc|desc"),
-    min_qty: float = Query(0, ge=0),
-    min_revenue: float = Query(0, ge=0),
-    session = Depends(get_session),
-):
-    # локальный импорт sqlalchemy.text — не зависит от глобального _sa_text
-    try:
-        from sqlalchemy import text as sa_text  # type: ignore
-    except Exception:
-        from sqlalchemy.sql import text as sa_text  # type: ignore
-    """
-    Топ товаров за период с агрегацией продаж и поступлений.
-    """
-    # валидация сортировки
-    allowed_cols = {"revenue","sold_qty","avg_price","inflow_qty","inflow_cost","product_id"}
-    sort_col = sort_by if sort_by in allowed_cols else "revenue"
-    sort_dir = "ASC" if str(order).lower() == "asc" else "DESC"
-
-    q = (
-        "WITH sales AS ("
-        "  SELECT product_id::text AS product_id,"
-        "         SUM(revenue) AS revenue,"
-        "         SUM(qty) AS sold_qty,"
-        "         CASE WHEN SUM(qty)=0 THEN 0 ELSE SUM(revenue)/SUM(qty) END AS avg_price "
-        "  FROM sales_item_fact "
-        "  WHERE date BETWEEN :start AND :end "
-        "  GROUP BY 1"
-        "), "
-        "inflow AS ("
-        "  SELECT product_id::text AS product_id,"
-        "         SUM(qty) AS inflow_qty,"
-        "         SUM(cost) AS inflow_cost "
-        "  FROM inflow_item_fact "
-        "  WHERE date BETWEEN :start AND :end "
-        "  GROUP BY 1"
-        ") "
-        "SELECT "
-        "  COALESCE(s.product_id, i.product_id) AS product_id, "
-        "  COALESCE(s.revenue,0) AS revenue, "
-        "  COALESCE(s.sold_qty,0) AS sold_qty, "
-        "  COALESCE(s.avg_price,0) AS avg_price, "
-        "  COALESCE(i.inflow_qty,0) AS inflow_qty, "
-        "  COALESCE(i.inflow_cost,0) AS inflow_cost "
-        "FROM sales s "
-        "FULL JOIN inflow i USING (product_id) "
-        "WHERE COALESCE(s.revenue,0) >= :min_revenue "
-        "  AND COALESCE(s.sold_qty,0) >= :min_qty "
-        f"ORDER BY {sort_col} {sort_dir} NULLS LAST "
-        "LIMIT :limit"
-    )
-    params = {
-        "start": start,
-        "end": end,
-        "limit": limit,
-        "min_revenue": min_revenue,
-        "min_qty": min_qty,
-    }
-    rows = session.execute(sa_text(q), params).mappings().all()
-    return {"data": [dict(r) for r in rows]}
+    s = datetime.strptime(start, "%Y-%m-%d").date()
+    e = datetime.strptime(end, "%Y-%m-%d").date()
+    items = await get_top_products_v2_async(session, s, e, limit=limit, sort_by=sort_by, order=order,
+                                            min_qty=min_qty, min_revenue=min_revenue)
+    # Decimal из ROUND(..)/SUM(..) FastJSONResponse сам отдаёт числами
+    return FastJSONResponse({"data": items})
 
 @app.get("/api/top/products_v3")
-def api_top_products_v3(
+@cached_endpoint("top_products_v3")
+async def api_top_products_v3(
     start: str = Query(..., description="YYYY-MM-DD"),
     end: str = Query(..., description="YYYY-MM-DD"),
     limit: int = Query(20, ge=1, le=1000),
@@ -824,65 +651,12 @@ def api_top_products_v3(
     order: str = Query("desc", description="asc|desc"),
     min_qty: float = Query(0, ge=0),
     min_revenue: float = Query(0, ge=0),
-    session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     """
     Топ товаров за период: продажи + поступления (FULL JOIN по product_id).
     """
-    # локальный импорт на случай отсутствия глобального
-    try:
-        from sqlalchemy import text as _sa_text  # type: ignore
-    except Exception:
-        from sqlalchemy.sql import text as _sa_text  # type: ignore
-
-    # валидация сортировки/направления
-    allowed_cols = {"revenue","sold_qty","avg_price","inflow_qty","inflow_cost","product_id"}
-    sort_col = sort_by if sort_by in allowed_cols else "revenue"
-    sort_dir = "ASC" if str(order).lower() == "asc" else "DESC"
-
-    q = (
-        "WITH sales AS ("
-        "  SELECT product_id::text AS product_id, "
-        "         SUM(revenue) AS revenue, "
-        "         SUM(qty) AS sold_qty, "
-        "         CASE WHEN SUM(qty)=0 THEN 0 ELSE SUM(revenue)/SUM(qty) END AS avg_price "
-        "  FROM sales_item_fact "
-        "  WHERE date BETWEEN :start AND :end "
-        "  GROUP BY 1"
-        "), "
-        "inflow AS ("
-        "  SELECT product_id::text AS product_id, "
-        "         SUM(qty) AS inflow_qty, "
-        "         SUM(cost) AS inflow_cost "
-        "  FROM inflow_item_fact "
-        "  WHERE date BETWEEN :start AND :end "
-        "  GROUP BY 1"
-        ") "
-        "SELECT "
-        "  COALESCE(s.product_id, i.product_id) AS product_id, "
-        "  COALESCE(s.revenue,0) AS revenue, "
-        "  COALESCE(s.sold_qty,0) AS sold_qty, "
-        "  COALESCE(s.avg_price,0) AS avg_price, "
-        "  COALESCE(i.inflow_qty,0) AS inflow_qty, "
-        "  COALESCE(i.inflow_cost,0) AS inflow_cost "
-        "FROM sales s "
-        "FULL JOIN inflow i USING (product_id) "
-        "WHERE COALESCE(s.revenue,0) >= :min_revenue "
-        "  AND COALESCE(s.sold_qty,0) >= :min_qty "
-        f"ORDER BY {sort_col} {sort_dir} NULLS LAST "
-        "LIMIT :limit"
-    )
-    params = {
-        "start": start,
-        "end": end,
-        "limit": limit,
-        "min_revenue": float(min_revenue),
-        "min_qty": float(min_qty),
-    }
-    try:
-        rows = session.execute(_sa_text(q), params).mappings().all()
-        return {"data": [dict(r) for r in rows]}
-    except Exception as e:
-        # отдадим понятный текст ошибки, чтобы её видно было в curl
-        return {"error": str(e)}
-
+    s = datetime.strptime(start, "%Y-%m-%d").date()
+    e = datetime.strptime(end, "%Y-%m-%d").date()
+    return {"data": await get_top_products_v3_async(session, s, e, limit=limit, sort_by=sort_by, order=order,
+                                                    min_qty=min_qty, min_revenue=min_revenue)}
@@ -1,5 +1,5 @@
-from datetime import date
-from sqlalchemy import Column, Integer, String, Date, Numeric, ForeignKey, UniqueConstraint
+from datetime import date, datetime
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, Numeric, Text, ForeignKey, UniqueConstraint, func
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from .db import Base
 
@@ -37,3 +37,95 @@ class SalesDaily(Base):
     writeoff_cost_defect: Mapped[float] = mapped_column(Numeric(14, 2), nullable=False, default=0)
     writeoff_cost_inventory: Mapped[float] = mapped_column(Numeric(14, 2), nullable=False, default=0)
     writeoff_cost_other: Mapped[float] = mapped_column(Numeric(14, 2), nullable=False, default=0)
+
+class SyncCheckpoint(Base):
+    """Единица бэкофила (job, склад, день): по ней перезапуск пропускает готовое и повторяет упавшее."""
+    __tablename__ = "sync_checkpoint"
+
+    job: Mapped[str] = mapped_column(String(64), primary_key=True)
+    warehouse_id: Mapped[int] = mapped_column(Integer, primary_key=True)   # 0 — все склады сразу
+    day: Mapped[date] = mapped_column(Date, primary_key=True)              # для помесячных job — 1-е число
+
+    status: Mapped[str] = mapped_column(String(16), nullable=False)        # running / ok / error
+    rows: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    duration_s: Mapped[float] = mapped_column(Numeric(10, 3), nullable=False, default=0)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class SyncWatermark(Base):
+    """High-water mark инкрементального синка: максимальный `updated` обработанных документов сущности МС."""
+    __tablename__ = "sync_watermark"
+
+    entity: Mapped[str] = mapped_column(String(64), primary_key=True)      # retaildemand / enter / loss
+    updated_from: Mapped[str] = mapped_column(String(32), nullable=False)  # "YYYY-MM-DD HH:MM:SS", время МС
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class AssortmentPrice(Base):
+    """Закупочная цена товара/модификации МС: кэш для расчёта себестоимости списаний."""
+    __tablename__ = "assortment_price"
+
+    href: Mapped[str] = mapped_column(String(255), primary_key=True)                # meta.href без query
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)                   # product / variant
+    product_href: Mapped[str | None] = mapped_column(String(255), nullable=True)    # для variant — его товар
+    buy_price: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)   # собственный buyPrice, копейки
+    ms_updated: Mapped[str | None] = mapped_column(String(32), nullable=True)       # `updated` сущности в МС
+    fetched_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class SalesMonthly(Base):
+    """Суммы sales_daily по складу за календарный месяц; ведётся app.period_rollup при каждой записи в sales_daily."""
+    __tablename__ = "sales_monthly"
+
+    month: Mapped[date] = mapped_column(Date, primary_key=True)            # 1-е число месяца
+    warehouse_id: Mapped[int] = mapped_column(ForeignKey("warehouse.id", ondelete="RESTRICT"), primary_key=True)
+
+    revenue: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    cost: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    discount: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    returns_cost: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    receipts_count: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    inflow_cost: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_total: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_defect: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_inventory: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_other: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+
+class SalesYearly(Base):
+    """Суммы sales_monthly по складу за календарный год."""
+    __tablename__ = "sales_yearly"
+
+    year: Mapped[date] = mapped_column(Date, primary_key=True)             # 1 января
+    warehouse_id: Mapped[int] = mapped_column(ForeignKey("warehouse.id", ondelete="RESTRICT"), primary_key=True)
+
+    revenue: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    cost: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    discount: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    returns_cost: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    receipts_count: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    inflow_cost: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_total: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_defect: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_inventory: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+    writeoff_cost_other: Mapped[float] = mapped_column(Numeric(16, 2), nullable=False, default=0)
+
+class DataVersion(Base):
+    """
+    Версия данных складо-месяца для ETag: синки поднимают её (nextval общей последовательности)
+    в той же транзакции, что и запись. warehouse_id=0 — изменение сразу по всем складам.
+    """
+    __tablename__ = "data_version"
+
+    month: Mapped[date] = mapped_column(Date, primary_key=True)            # 1-е число месяца
+    warehouse_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class DataTopicVersion(Base):
+    """
+    Версия данных, не привязанных к датам (например, закупочные цены — тема "prices"):
+    из той же последовательности data_version_seq, ETag зависимых ответов берёт max с ней.
+    """
+    __tablename__ = "data_topic_version"
+
+    topic: Mapped[str] = mapped_column(String(32), primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
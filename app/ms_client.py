@@ -1,9 +1,15 @@
+import asyncio
+import random
+import time
+from collections import deque
 import httpx
 from typing import AsyncIterator, Dict, Any, Optional
 from .config import settings
 
+TOKEN = settings.MS_API_TOKEN or settings.MS_TOKEN
+
 HEADERS = {
-    "Authorization": f"Bearer {settings.MS_API_TOKEN}",
+    "Authorization": f"Bearer {TOKEN}",
     "Accept": "application/json;charset=utf-8",
     "Accept-Encoding": "gzip",
     "User-Agent": "worker-analytics/1.0"
@@ -11,27 +17,253 @@ HEADERS = {
 
 BASE = settings.MS_BASE_URL.rstrip("/")
 
+# HTTP/2, если установлен h2 (pip install httpx[http2]); иначе HTTP/1.1 с keep-alive
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# один пул соединений на клиент: живёт весь прогон, TLS-рукопожатие — один раз на соединение
+POOL_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=120.0)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _num(v) -> Optional[float]:
+    try:
+        return float(v) if v not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Token bucket на весь процесс: один на все синки и все клиенты.
+
+    Стартовая квота МоегоСклада — 45 запросов за 3 секунды. Дальше ведро
+    подстраивается под заголовки ответов:
+      - X-RateLimit-Limit + X-Lognex-Retry-TimeInterval (мс) — реальная квота и окно;
+      - X-RateLimit-Remaining — сколько запросов осталось в окне;
+      - X-Lognex-Reset (мс) — когда окно сбросится;
+      - X-Lognex-Retry-After (мс) / Retry-After (сек) — пауза после 429.
+    Токены резервируются сразу (баланс может уйти в минус), поэтому запросы
+    стартуют по очереди с равным шагом, а не пачкой после общего sleep.
+    """
+
+    def __init__(self, limit: int = 45, interval: float = 3.0, reserve: int = 3):
+        self.capacity = float(limit)
+        self.rate = limit / interval          # токенов в секунду
+        self.reserve = reserve                # не выбираем квоту до нуля — запас для соседних процессов
+        self._tokens = float(limit)
+        self._ts = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def _block(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        wait = max(self._blocked_until - now, -self._tokens / self.rate if self._tokens < 0 else 0.0)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update(self, resp: httpx.Response):
+        """Подстраиваем ведро под то, что сервер сообщил о квоте."""
+        h = resp.headers
+        limit = _num(h.get("X-RateLimit-Limit"))
+        interval_ms = _num(h.get("X-Lognex-Retry-TimeInterval"))
+        if limit and interval_ms:
+            self.capacity = limit
+            self.rate = limit / (interval_ms / 1000.0)
+
+        remaining = _num(h.get("X-RateLimit-Remaining"))
+        if remaining is not None:
+            self._tokens = min(self._tokens, remaining - self.reserve)
+            if remaining <= self.reserve:
+                reset_ms = _num(h.get("X-Lognex-Reset"))
+                self._block(reset_ms / 1000.0 if reset_ms else 1.0 / self.rate)
+
+        if resp.status_code == 429:
+            retry_ms = _num(h.get("X-Lognex-Retry-After"))
+            retry_s = _num(h.get("Retry-After"))
+            if retry_ms is not None:
+                pause = retry_ms / 1000.0
+            elif retry_s is not None:
+                pause = retry_s
+            else:
+                pause = 3.0
+            self._tokens = min(self._tokens, 0.0)
+            self._block(max(pause, 0.5))
+
+
+# общий лимитер процесса — квота у МоегоСклада одна на аккаунт
+shared_limiter = RateLimiter()
+
+
+class RequestMetrics:
+    """
+    Фактический темп и параллельность запросов клиента:
+      rps — стартов в секунду за последние window секунд;
+      in_flight / peak — запросов в полёте сейчас и максимум за прогон;
+      avg_concurrency — суммарное время в полёте / время жизни клиента (закон Литтла).
+    """
+
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self.t0 = time.monotonic()
+        self._starts: deque[float] = deque()
+        self.in_flight = 0
+        self.peak = 0
+        self.done = 0
+        self.busy_s = 0.0
+
+    def _trim(self, now: float):
+        while self._starts and self._starts[0] < now - self.window:
+            self._starts.popleft()
+
+    def started(self) -> float:
+        now = time.monotonic()
+        self._starts.append(now)
+        self._trim(now)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        return now
+
+    def finished(self, t_start: float):
+        self.in_flight -= 1
+        self.done += 1
+        self.busy_s += time.monotonic() - t_start
+
+    def rps(self) -> float:
+        now = time.monotonic()
+        self._trim(now)
+        span = min(self.window, now - self.t0)
+        return len(self._starts) / span if span > 0 else 0.0
+
+    def avg_concurrency(self) -> float:
+        span = time.monotonic() - self.t0
+        return self.busy_s / span if span > 0 else 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "rps": round(self.rps(), 2),
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak,
+            "avg_concurrency": round(self.avg_concurrency(), 2),
+            "done": self.done,
+        }
+
+
 class MSClient:
-    def __init__(self, timeout: float = 30.0):
-        self._client = httpx.AsyncClient(timeout=timeout, headers=HEADERS, base_url=BASE)
+    """
+    Долгоживущий клиент МоегоСклада. Создаём один на прогон/приложение и передаём
+    во все fetch-функции: пул соединений переиспользуется между складами и днями.
+    stats считает запросы против новых соединений/TLS-рукопожатий — видно, работает ли reuse.
+
+    Планирование запроса в два независимых шага: лимитер решает, когда запрос может
+    стартовать, а отдельный потолок max_in_flight — сколько их одновременно в полёте.
+    Ожидание темпа не занимает слот, а медленный ответ не задерживает старт следующих.
+    """
+
+    def __init__(self, timeout: float = 60.0, token: Optional[str] = None,
+                 limiter: Optional[RateLimiter] = None, max_attempts: int = 6,
+                 max_in_flight: Optional[int] = None):
+        headers = dict(HEADERS)
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        self._client = httpx.AsyncClient(
+            timeout=timeout, headers=headers, base_url=BASE,
+            http2=HTTP2, limits=POOL_LIMITS,
+        )
+        self.limiter = limiter or shared_limiter
+        self.max_attempts = max_attempts
+        self.stats = {"requests": 0, "connections": 0, "tls_handshakes": 0}
+        self.max_in_flight = max(1, max_in_flight or settings.MS_MAX_IN_FLIGHT)
+        self.metrics = RequestMetrics()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _in_flight_slots(self) -> asyncio.Semaphore:
+        # семафор привязан к event loop: создаём лениво в том loop, где идут запросы
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._slots_loop = loop
+        return self._slots
+
+    async def _trace(self, event: str, info: Dict[str, Any]):
+        # события httpcore: новое TCP-соединение и завершённый TLS handshake
+        if event == "connection.connect_tcp.complete":
+            self.stats["connections"] += 1
+        elif event == "connection.start_tls.complete":
+            self.stats["tls_handshakes"] += 1
+
+    def stats_line(self) -> str:
+        st = self.stats
+        m = self.metrics.snapshot()
+        proto = "h2" if HTTP2 else "http/1.1"
+        return (f"http[{proto}]: requests={st['requests']} connections={st['connections']} tls_handshakes={st['tls_handshakes']}"
+                f" rps={m['rps']} avg_concurrency={m['avg_concurrency']} peak_in_flight={m['peak_in_flight']}/{self.max_in_flight}")
 
     async def close(self):
         await self._client.aclose()
 
+    async def __aenter__(self) -> "MSClient":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get(self, url: str, params: Optional[Dict[str, Any]] = None) -> httpx.Response:
+        """GET через общий лимитер: ретраи на 429/5xx и сетевые ошибки с экспоненциальным джиттером."""
+        backoff = 1.0
+        for attempt in range(1, self.max_attempts + 1):
+            # сначала темп (слот не занят, пока ждём очереди), потом слот — только на сам запрос
+            await self.limiter.acquire()
+            self.stats["requests"] += 1
+            try:
+                async with self._in_flight_slots():
+                    t = self.metrics.started()
+                    try:
+                        r = await self._client.get(url, params=params, extensions={"trace": self._trace})
+                    finally:
+                        self.metrics.finished(t)
+            except httpx.TransportError:
+                if attempt >= self.max_attempts:
+                    raise
+                await asyncio.sleep(backoff * (1.0 + random.random() * 0.25))
+                backoff = min(backoff * 2, 30.0)
+                continue
+            self.limiter.update(r)
+            if r.status_code not in RETRY_STATUSES or attempt >= self.max_attempts:
+                r.raise_for_status()
+                return r
+            if r.status_code != 429:
+                # на 429 паузу уже выставил лимитер, на 5xx ждём сами
+                await asyncio.sleep(backoff * (1.0 + random.random() * 0.25))
+                backoff = min(backoff * 2, 30.0)
+        raise RuntimeError("unreachable")
+
+    async def get_json(self, url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        r = await self.get(url, params=params)
+        return r.json()
+
     async def paged(self, path: str, limit: int = 1000, params: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
-        offset = 0
-        params = dict(params or {})
-        while True:
-            q = params | {"limit": limit, "offset": offset}
-            r = await self._client.get(path, params=q)
-            r.raise_for_status()
-            data = r.json()
-            rows = data.get("rows", [])
-            for row in rows:
+        """Все строки списка/отчёта: первая страница по path, дальше — по meta.nextHref."""
+        url: Optional[str] = path
+        q: Optional[Dict[str, Any]] = dict(params or {}) | {"limit": limit, "offset": 0}
+        while url:
+            data = await self.get_json(url, params=q)
+            for row in data.get("rows") or []:
                 yield row
-            if len(rows) < limit:
-                break
-            offset += limit
+            url, q = (data.get("meta") or {}).get("nextHref"), None
 
     async def get_stores(self) -> AsyncIterator[Dict[str, Any]]:
         async for row in self.paged("/entity/store"):
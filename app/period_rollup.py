@@ -0,0 +1,134 @@
+import datetime as dt
+from typing import Iterable
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from .data_changes import notify_changed, spans_from_cells
+
+# колонки, которые суммируются в sales_monthly / sales_yearly (все значения sales_daily)
+COLUMNS = (
+    "revenue", "cost", "discount", "returns_cost", "receipts_count", "inflow_cost",
+    "writeoff_cost_total", "writeoff_cost_defect", "writeoff_cost_inventory", "writeoff_cost_other",
+)
+
+_COLS = ", ".join(COLUMNS)
+_SUMS = ", ".join(f"COALESCE(SUM(s.{c}), 0)" for c in COLUMNS)
+_SET = ", ".join(f"{c} = EXCLUDED.{c}" for c in COLUMNS)
+
+# месяцы пересчитываются целиком из sales_daily: месяц без дневных строк получает нули
+_MONTHLY = f"""
+    INSERT INTO sales_monthly (month, warehouse_id, {_COLS})
+    SELECT c.month, c.warehouse_id, {_SUMS}
+      FROM unnest(CAST(:periods AS date[]), CAST(:whs AS integer[])) AS c(month, warehouse_id)
+      LEFT JOIN sales_daily s
+        ON s.warehouse_id = c.warehouse_id
+       AND s.date >= c.month AND s.date < c.month + interval '1 month'
+     GROUP BY c.month, c.warehouse_id
+    ON CONFLICT (month, warehouse_id) DO UPDATE SET {_SET}
+"""
+
+# год — из уже пересчитанных месяцев (не больше 12 строк на склад)
+_YEARLY = f"""
+    INSERT INTO sales_yearly (year, warehouse_id, {_COLS})
+    SELECT c.year, c.warehouse_id, {_SUMS}
+      FROM unnest(CAST(:periods AS date[]), CAST(:whs AS integer[])) AS c(year, warehouse_id)
+      LEFT JOIN sales_monthly s
+        ON s.warehouse_id = c.warehouse_id
+       AND s.month >= c.year AND s.month < c.year + interval '1 year'
+     GROUP BY c.year, c.warehouse_id
+    ON CONFLICT (year, warehouse_id) DO UPDATE SET {_SET}
+"""
+
+# Параллельные транзакции (синк + бэкфилл) по одному складо-месяцу пересчитывали бы его каждая
+# из своего снимка sales_daily — последняя запись затёрла бы чужие дни. Поэтому перед пересчётом
+# берём транзакционные advisory-блокировки на каждый складо-месяц и складо-год, всегда
+# в порядке возрастания ключа (без взаимных блокировок); INSERT ... SELECT после них
+# видит уже закоммиченные дни соседа. Ключ: склад * 100000 + год * 13 + месяц (0 — весь год).
+_LOCK = """
+    SELECT pg_advisory_xact_lock(hashtext('sales_period'), k.key)
+      FROM (SELECT key FROM unnest(CAST(:keys AS integer[])) WITH ORDINALITY AS t(key, n) ORDER BY n) AS k
+"""
+
+def period_lock_keys(months: Iterable[tuple[dt.date, int]]) -> list[int]:
+    """Ключи advisory-блокировок для складо-месяцев и их складо-годов, по возрастанию."""
+    keys = set()
+    for m, wh in months:
+        keys.add(wh * 100000 + m.year * 13 + m.month)
+        keys.add(wh * 100000 + m.year * 13)
+    return sorted(keys)
+
+def refresh_periods(db: Session, cells: Iterable[tuple[dt.date, int]]) -> int:
+    """
+    Пересчитать месяцы и годы, в которые попали изменённые ячейки (date, warehouse_id) sales_daily.
+    Вызывается в той же транзакции, что и запись в sales_daily; коммит — на стороне вызывающего.
+    Складо-месяцы и годы блокируются (pg_advisory_xact_lock) до конца транзакции.
+    Заодно сообщает API (NOTIFY) об изменённых датах и складах. Возвращает число пересчитанных складо-месяцев.
+    """
+    cells = list(cells)
+    months = sorted({(d.replace(day=1), wh) for d, wh in cells})
+    if not months:
+        return 0
+    years = sorted({(m.replace(month=1), wh) for m, wh in months})
+    db.execute(text(_LOCK), {"keys": period_lock_keys(months)})
+    db.execute(text(_MONTHLY), {"periods": [m for m, _ in months], "whs": [w for _, w in months]})
+    db.execute(text(_YEARLY), {"periods": [y for y, _ in years], "whs": [w for _, w in years]})
+    notify_changed(db, spans_from_cells(cells))
+    return len(months)
+
+def split_range(start: dt.date, end: dt.date, coarsest: str = "year") -> dict[str, list[tuple[dt.date, dt.date]]]:
+    """
+    [start..end] -> куски по самой крупной таблице (не крупнее coarsest), которая их целиком покрывает:
+      year  — полные календарные годы (sales_yearly),
+      month — полные месяцы вне полных лет (sales_monthly),
+      day   — неполные крайние месяцы (sales_daily).
+    Каждый кусок — (from, to) включительно по ключу своей таблицы; соседние куски склеены.
+    """
+    out: dict[str, list[tuple[dt.date, dt.date]]] = {"year": [], "month": [], "day": []}
+
+    def add(level: str, a: dt.date, b: dt.date, step_prev):
+        spans = out[level]
+        if spans and step_prev(a) == spans[-1][1]:
+            spans[-1] = (spans[-1][0], b)
+        else:
+            spans.append((a, b))
+
+    cur = start
+    while cur <= end:
+        next_year = dt.date(cur.year + 1, 1, 1)
+        next_month = dt.date(cur.year + (cur.month == 12), cur.month % 12 + 1, 1)
+        if coarsest == "year" and cur.month == 1 and cur.day == 1 and next_year - dt.timedelta(days=1) <= end:
+            add("year", cur, cur, lambda d: dt.date(d.year - 1, 1, 1))
+            cur = next_year
+        elif coarsest in ("year", "month") and cur.day == 1 and next_month - dt.timedelta(days=1) <= end:
+            add("month", cur, cur, lambda d: (d - dt.timedelta(days=1)).replace(day=1))
+            cur = next_month
+        else:
+            last = min(end, next_month - dt.timedelta(days=1))
+            add("day", cur, last, lambda d: d - dt.timedelta(days=1))
+            cur = last + dt.timedelta(days=1)
+    return out
+
+def rebuild(db: Session, start: dt.date | None = None, end: dt.date | None = None) -> int:
+    """Полный пересчёт месяцев/лет по всем складам за период (по умолчанию — всё, что есть в sales_daily)."""
+    bounds = db.execute(text("SELECT min(date), max(date) FROM sales_daily")).first()
+    start = start or bounds[0]
+    end = end or bounds[1]
+    if not start or not end:
+        return 0
+    wh_ids = [r[0] for r in db.execute(text("SELECT id FROM warehouse ORDER BY id"))]
+    cells = []
+    m = start.replace(day=1)
+    while m <= end:
+        cells.extend((m, w) for w in wh_ids)
+        m = dt.date(m.year + (m.month == 12), m.month % 12 + 1, 1)
+    return refresh_periods(db, cells)
+
+if __name__ == "__main__":
+    import os
+    from .db import SessionLocal
+    # START/END — необязательный период, иначе весь sales_daily
+    start = dt.date.fromisoformat(os.environ["START"]) if os.environ.get("START") else None
+    end = dt.date.fromisoformat(os.environ["END"]) if os.environ.get("END") else None
+    with SessionLocal() as db:
+        n = rebuild(db, start, end)
+        db.commit()
+    print(f"period rollup rebuilt: {n} warehouse-months")
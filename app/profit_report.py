@@ -0,0 +1,64 @@
+import datetime as dt
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy.dialects.postgresql import insert
+from .models import SalesDaily
+from .ms_client import MSClient, BASE as MS_BASE
+
+# общий для sync_profit_daily / sync_discounts_daily / sync_incremental: отчёт прибыльности за сутки
+# и запись его полей в sales_daily
+
+def _rub(cents: Decimal) -> Decimal:
+    # из копеек в рубли
+    return (cents / Decimal(100)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+async def fetch_profit_snapshot(ms: MSClient, store_ms_id: str, day: dt.date) -> tuple[Decimal, Decimal, Decimal]:
+    """
+    Один запрос report/profit/byproduct за сутки по складу -> (cost, returns_cost, discount) в рублях.
+    cost = ΣsellCostSum, returns_cost = ΣreturnCostSum, скидка = Σ(sellPrice * sellQuantity - sellSum).
+    """
+    params = {
+        "momentFrom": f"{day} 00:00:00",
+        "momentTo": f"{day} 23:59:59",
+        "filter": f"store={MS_BASE}/entity/store/{store_ms_id}",
+    }
+    sell_cost_sum = Decimal("0")
+    return_cost_sum = Decimal("0")
+    disc_cents = Decimal("0")
+    async for row in ms.paged("/report/profit/byproduct", params=params):
+        sell_cost_sum += Decimal(str(row.get("sellCostSum", 0)))
+        return_cost_sum += Decimal(str(row.get("returnCostSum", 0)))
+        price = Decimal(str(row.get("sellPrice", 0)))
+        qty   = Decimal(str(row.get("sellQuantity", 0)))
+        sum_  = Decimal(str(row.get("sellSum", 0)))
+        disc_cents += (price * qty) - sum_
+    return _rub(sell_cost_sum), _rub(return_cost_sum), _rub(disc_cents)
+
+def upsert_costs(session, warehouse_id: int, day: dt.date, cost_rub: Decimal, returns_cost_rub: Decimal):
+    # месяцы/годы пересчитывает вызывающий — одним refresh_periods на склад перед коммитом
+    ins = insert(SalesDaily).values(
+        date=day,
+        warehouse_id=warehouse_id,
+        cost=cost_rub,
+        returns_cost=returns_cost_rub,
+    )
+    upsert = ins.on_conflict_do_update(
+        index_elements=[SalesDaily.date, SalesDaily.warehouse_id],
+        set_={
+            "cost": ins.excluded.cost,
+            "returns_cost": ins.excluded.returns_cost,
+        },
+    )
+    session.execute(upsert)
+
+def upsert_discount(session, warehouse_id: int, day: dt.date, discount_rub: Decimal):
+    # месяцы/годы пересчитывает вызывающий — одним refresh_periods на склад перед коммитом
+    ins = insert(SalesDaily).values(
+        date=day,
+        warehouse_id=warehouse_id,
+        discount=discount_rub,
+    )
+    upsert = ins.on_conflict_do_update(
+        index_elements=[SalesDaily.date, SalesDaily.warehouse_id],
+        set_={"discount": ins.excluded.discount},
+    )
+    session.execute(upsert)
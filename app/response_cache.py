@@ -0,0 +1,197 @@
+import datetime as dt
+import functools
+import inspect
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable, NamedTuple, Optional
+from starlette.responses import Response
+from .data_changes import Span
+from .json_response import render_json
+
+MISS = object()
+
+class Scope(NamedTuple):
+    start: dt.date
+    end: dt.date
+    warehouses: Optional[frozenset]     # None — зависит от всех складов
+    topics: frozenset = frozenset()     # темы data_changes.notify_topic, от которых ещё зависит ответ
+
+class _Entry(NamedTuple):
+    value: Any
+    scope: Scope
+    size: int
+
+def make_key(endpoint: str, params: dict) -> tuple:
+    # нормализация: порядок параметров и значения по умолчанию не создают разных ключей
+    norm = []
+    for k, v in sorted(params.items()):
+        if v is None or v == "":
+            continue
+        if isinstance(v, (list, tuple, set, frozenset)):
+            v = tuple(sorted(v))
+        norm.append((k, v))
+    return (endpoint, tuple(norm))
+
+class ResponseCache:
+    """
+    Готовые ответы аналитических эндпоинтов: LRU с ограничением по числу записей и по объёму
+    (размер — длина JSON ответа). Ответы эндпоинтов хранятся уже отрендеренными (bytes): попадание
+    в кэш отдаётся без повторной сериализации. Каждая запись помнит, от каких дат и складов она зависит;
+    invalidate() по сообщениям синков выкидывает только пересекающиеся записи.
+    Потокобезопасен: sync-эндпоинты FastAPI работают в пуле потоков, слушатель — в своём.
+    """
+
+    def __init__(self, max_entries: int = 2000, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._epoch = 0         # растёт на каждом invalidate/clear
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0, "evicted": 0}
+
+    def get(self, key: tuple) -> Any:
+        with self._lock:
+            e = self._data.get(key)
+            if e is None:
+                self.stats["misses"] += 1
+                return MISS
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return e.value
+
+    def epoch(self) -> int:
+        return self._epoch
+
+    def put(self, key: tuple, value: Any, scope: Scope, epoch: Optional[int] = None):
+        """epoch — значение epoch() до расчёта: если с тех пор что-то сбрасывалось, ответ мог устареть — не кладём."""
+        size = len(value) if isinstance(value, bytes) else len(render_json(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._data[key] = _Entry(value, scope, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                _, e = self._data.popitem(last=False)
+                self._bytes -= e.size
+                self.stats["evicted"] += 1
+
+    def invalidate(self, spans: Iterable[Span]) -> int:
+        """Выкинуть записи, чей период пересекается с изменённым и склад совпадает (None — любой)."""
+        spans = list(spans)
+        n = 0
+        with self._lock:
+            self._epoch += 1
+            for key in list(self._data):
+                sc = self._data[key].scope
+                for wh, a, b in spans:
+                    if a <= sc.end and sc.start <= b and (wh is None or sc.warehouses is None or wh in sc.warehouses):
+                        self._bytes -= self._data.pop(key).size
+                        n += 1
+                        break
+            self.stats["invalidated"] += n
+        return n
+
+    def invalidate_topic(self, topic: str) -> int:
+        """Выкинуть записи, зависящие от темы (например, TOPIC_PRICES — только ТОП товаров)."""
+        n = 0
+        with self._lock:
+            self._epoch += 1
+            for key in [k for k, e in self._data.items() if topic in e.scope.topics]:
+                self._bytes -= self._data.pop(key).size
+                n += 1
+            self.stats["invalidated"] += n
+        return n
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+            self._bytes = 0
+
+    def cached(self, endpoint: str, params: dict, scope: Scope, compute: Callable[[], Any]) -> Any:
+        """
+        Тело ответа (JSON bytes) из кэша или compute() с рендером и сохранением.
+        Ответы-ошибки (не dict, например JSONResponse) не кэшируются и возвращаются как есть.
+        """
+        key = make_key(endpoint, params)
+        value = self.get(key)
+        if value is MISS:
+            epoch = self._epoch
+            value = compute()
+            if isinstance(value, dict):
+                value = render_json(value)
+                self.put(key, value, scope, epoch)
+        return value
+
+    async def cached_async(self, endpoint: str, params: dict, scope: Scope, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """То же для async-эндпоинтов: compute() — корутина."""
+        key = make_key(endpoint, params)
+        value = self.get(key)
+        if value is MISS:
+            epoch = self._epoch
+            value = await compute()
+            if isinstance(value, dict):
+                value = render_json(value)
+                self.put(key, value, scope, epoch)
+        return value
+
+    def stats_line(self) -> str:
+        st = self.stats
+        return (f"response cache: entries={len(self._data)} bytes={self._bytes} hits={st['hits']} "
+                f"misses={st['misses']} invalidated={st['invalidated']} evicted={st['evicted']}")
+
+def scope(start: dt.date, end: dt.date, warehouse_id: Any = None, topics: Iterable[str] = ()) -> Scope:
+    if not warehouse_id:
+        return Scope(start, end, None, frozenset(topics))
+    ids = [warehouse_id] if isinstance(warehouse_id, int) else list(warehouse_id)
+    return Scope(start, end, frozenset(ids), frozenset(topics))
+
+# общий кэш процесса API
+response_cache = ResponseCache()
+
+def cached_endpoint(name: str, span: Optional[Callable[[dt.date, dt.date], tuple[dt.date, dt.date]]] = None):
+    """
+    Декоратор эндпоинта (sync или async) с параметрами start/end (YYYY-MM-DD) и необязательным warehouse_id:
+    ответ кэшируется по имени + параметрам запроса (кроме session/request).
+    span(start, end) — если ответ зависит от более широкого периода (например, сравнение с прошлым годом).
+    """
+    def key_scope(kwargs: dict) -> Optional[tuple[dict, Scope]]:
+        try:
+            s = dt.date.fromisoformat(str(kwargs["start"]))
+            e = dt.date.fromisoformat(str(kwargs["end"]))
+            if span:
+                s, e = span(s, e)
+        except (KeyError, ValueError):
+            return None     # кривые даты — пусть эндпоинт сам ответит ошибкой
+        params = {k: v for k, v in kwargs.items() if k not in ("session", "request")}
+        return params, scope(s, e, kwargs.get("warehouse_id"))
+
+    def respond(value: Any) -> Any:
+        if isinstance(value, bytes):
+            return Response(content=value, media_type="application/json")
+        return value
+
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(**kwargs):
+                ks = key_scope(kwargs)
+                if ks is None:
+                    return await fn(**kwargs)
+                return respond(await response_cache.cached_async(name, *ks, lambda: fn(**kwargs)))
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(**kwargs):
+            ks = key_scope(kwargs)
+            if ks is None:
+                return fn(**kwargs)
+            return respond(response_cache.cached(name, *ks, lambda: fn(**kwargs)))
+        return wrapper
+    return deco
@@ -0,0 +1,127 @@
+import datetime as dt
+from typing import Iterable
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from .period_rollup import refresh_periods
+
+# части sales_daily, которые восстанавливаются из локальных фактов;
+# cost / returns_cost / discount в фактах не хранятся — их по-прежнему даёт отчёт прибыли
+PARTS = ("sales", "inflow", "writeoff")
+
+# ячейки — параллельные массивы дат и складов (warehouse.id); факты продаж/оприходований
+# ключуются ms_id склада (uuid), списания — warehouse.id
+_CELLS = """
+    WITH cells AS (
+        SELECT c.date, c.warehouse_id, w.ms_id::uuid AS store
+          FROM unnest(CAST(:days AS date[]), CAST(:whs AS integer[])) AS c(date, warehouse_id)
+          JOIN warehouse w ON w.id = c.warehouse_id
+    )
+"""
+
+_SQL = {
+    # выручка и чеки из позиций retaildemand
+    "sales": _CELLS + """
+        INSERT INTO sales_daily (date, warehouse_id, revenue, receipts_count,
+                                 cost, discount, returns_cost, inflow_cost,
+                                 writeoff_cost_total, writeoff_cost_defect, writeoff_cost_inventory, writeoff_cost_other)
+        SELECT c.date, c.warehouse_id, COALESCE(SUM(f.revenue), 0), COUNT(DISTINCT f.doc_id),
+               0, 0, 0, 0, 0, 0, 0, 0
+          FROM cells c
+          LEFT JOIN sales_item_fact f ON f.date = c.date AND f.warehouse_id = c.store
+         GROUP BY c.date, c.warehouse_id
+        ON CONFLICT (date, warehouse_id) DO UPDATE SET
+            revenue = EXCLUDED.revenue,
+            receipts_count = EXCLUDED.receipts_count
+    """,
+    # оприходования по себестоимости из позиций enter
+    "inflow": _CELLS + """
+        INSERT INTO sales_daily (date, warehouse_id, inflow_cost,
+                                 revenue, receipts_count, cost, discount, returns_cost,
+                                 writeoff_cost_total, writeoff_cost_defect, writeoff_cost_inventory, writeoff_cost_other)
+        SELECT c.date, c.warehouse_id, COALESCE(SUM(f.cost), 0),
+               0, 0, 0, 0, 0, 0, 0, 0, 0
+          FROM cells c
+          LEFT JOIN inflow_item_fact f ON f.date = c.date AND f.warehouse_id = c.store
+         GROUP BY c.date, c.warehouse_id
+        ON CONFLICT (date, warehouse_id) DO UPDATE SET
+            inflow_cost = EXCLUDED.inflow_cost
+    """,
+    # списания по корзинам; writeoff_item.reason — уже название корзины (writeoff_reasons.REASON_NAMES)
+    "writeoff": _CELLS + """
+        , items AS (
+            SELECT c.date, c.warehouse_id, x.cost, x.reason
+              FROM cells c
+              LEFT JOIN writeoff_item x ON x.day = c.date AND x.warehouse_id = c.warehouse_id
+        )
+        INSERT INTO sales_daily (date, warehouse_id,
+                                 writeoff_cost_total, writeoff_cost_defect, writeoff_cost_inventory, writeoff_cost_other,
+                                 revenue, receipts_count, cost, discount, returns_cost, inflow_cost)
+        SELECT date, warehouse_id,
+               COALESCE(SUM(cost), 0),
+               COALESCE(SUM(cost) FILTER (WHERE reason = 'Брак'), 0),
+               COALESCE(SUM(cost) FILTER (WHERE reason = 'Инвентаризация'), 0),
+               COALESCE(SUM(cost) FILTER (WHERE reason = 'Прочее'), 0),
+               0, 0, 0, 0, 0, 0
+          FROM items
+         GROUP BY date, warehouse_id
+        ON CONFLICT (date, warehouse_id) DO UPDATE SET
+            writeoff_cost_total = EXCLUDED.writeoff_cost_total,
+            writeoff_cost_defect = EXCLUDED.writeoff_cost_defect,
+            writeoff_cost_inventory = EXCLUDED.writeoff_cost_inventory,
+            writeoff_cost_other = EXCLUDED.writeoff_cost_other
+    """,
+}
+
+# разбивка списаний по причинам для тех же ячеек: старые строки ячеек удаляем, новые считаем из writeoff_item
+_REASON_DELETE = """
+    DELETE FROM writeoff_daily_reason r
+     USING unnest(CAST(:days AS date[]), CAST(:whs AS integer[])) AS c(date, warehouse_id)
+     WHERE r.date = c.date AND r.warehouse_id = c.warehouse_id
+"""
+_REASON_INSERT = """
+    INSERT INTO writeoff_daily_reason (date, warehouse_id, reason, cost)
+    SELECT x.day, x.warehouse_id, x.reason, SUM(x.cost)
+      FROM unnest(CAST(:days AS date[]), CAST(:whs AS integer[])) AS c(date, warehouse_id)
+      JOIN writeoff_item x ON x.day = c.date AND x.warehouse_id = c.warehouse_id
+     GROUP BY 1, 2, 3
+"""
+
+def recompute_cells(db: Session, cells: Iterable[tuple[dt.date, int]], parts: Iterable[str] = PARTS) -> int:
+    """
+    Пересчёт «грязных» ячеек (date, warehouse_id) sales_daily из локальных фактов:
+    по одному set-based INSERT ... SELECT ... ON CONFLICT на часть, только указанные колонки.
+    Ячейки без фактов получают нули. Коммит — на стороне вызывающего. Возвращает число ячеек.
+    """
+    cells = sorted(set(cells))
+    if not cells:
+        return 0
+    parts = tuple(parts)
+    unknown = set(parts) - set(PARTS)
+    if unknown:
+        raise ValueError(f"unknown rollup parts: {sorted(unknown)}")
+    params = {"days": [c[0] for c in cells], "whs": [c[1] for c in cells]}
+    for part in parts:
+        db.execute(text(_SQL[part]), params)
+    if "writeoff" in parts:
+        db.execute(text(_REASON_DELETE), params)
+        db.execute(text(_REASON_INSERT), params)
+    refresh_periods(db, cells)
+    return len(cells)
+
+def range_cells(db: Session, start: dt.date, end: dt.date) -> list[tuple[dt.date, int]]:
+    """Все ячейки периода: каждый день × каждый склад."""
+    wh_ids = [r[0] for r in db.execute(text("SELECT id FROM warehouse ORDER BY id"))]
+    days = [start + dt.timedelta(days=i) for i in range((end - start).days + 1)]
+    return [(d, w) for d in days for w in wh_ids]
+
+if __name__ == "__main__":
+    import os
+    from .db import SessionLocal
+    # START/END — период, PARTS=sales,inflow,writeoff — какие колонки пересчитать
+    start = dt.date.fromisoformat(os.environ["START"])
+    end = dt.date.fromisoformat(os.environ.get("END") or os.environ["START"])
+    parts = [p for p in (os.environ.get("PARTS") or ",".join(PARTS)).split(",") if p]
+    with SessionLocal() as db:
+        n = recompute_cells(db, range_cells(db, start, end), parts)
+        db.commit()
+    print(f"rollup {start}..{end} {parts}: {n} cells")
@@ -0,0 +1,85 @@
+import datetime as dt
+from typing import Any, Iterable
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import SalesDaily
+from .period_rollup import refresh_periods
+
+# колонки sales_daily, которые пишут синки (каждый — только свои)
+VALUE_COLUMNS = (
+    "revenue", "receipts_count", "cost", "returns_cost", "discount", "inflow_cost",
+    "writeoff_cost_total", "writeoff_cost_defect", "writeoff_cost_inventory", "writeoff_cost_other",
+)
+
+BATCH_SIZE = 1000
+
+def upsert_rows(db: Session, rows: Iterable[dict[str, Any]]) -> int:
+    """
+    Пакетный upsert в sales_daily: строки — dict с date, warehouse_id и любым подмножеством VALUE_COLUMNS.
+    Строки с одинаковым набором колонок идут одним INSERT ... VALUES (...), (...) ON CONFLICT,
+    обновляются только переданные колонки, затронутые месяцы/годы пересчитываются в той же
+    транзакции. Коммит — на стороне вызывающего.
+    """
+    rows = list(rows)
+    groups: dict[tuple[str, ...], list[dict[str, Any]]] = {}
+    for r in rows:
+        cols = tuple(c for c in VALUE_COLUMNS if c in r)
+        if cols:
+            groups.setdefault(cols, []).append(r)
+
+    n = 0
+    for cols, group in groups.items():
+        for i in range(0, len(group), BATCH_SIZE):
+            chunk = group[i:i + BATCH_SIZE]
+            ins = insert(SalesDaily).values(chunk)
+            db.execute(ins.on_conflict_do_update(
+                index_elements=[SalesDaily.date, SalesDaily.warehouse_id],
+                set_={c: ins.excluded[c] for c in cols},
+            ))
+            n += len(chunk)
+    if n:
+        refresh_periods(db, {(r["date"], r["warehouse_id"]) for r in rows})
+    return n
+
+class SalesDailyWriter:
+    """
+    Буфер частичных строк sales_daily. add() складывает колонки по ключу (date, warehouse_id),
+    при batch_size ключей — flush(): пакетный upsert и один коммит на пачку.
+
+        with SalesDailyWriter(db) as w:
+            w.add(day, wh_id, cost=..., returns_cost=...)
+    """
+
+    def __init__(self, db: Session, batch_size: int = BATCH_SIZE, commit: bool = True):
+        self.db = db
+        self.batch_size = batch_size
+        self.commit = commit
+        self.written = 0
+        self._rows: dict[tuple[dt.date, int], dict[str, Any]] = {}
+
+    def add(self, day: dt.date, warehouse_id: int, **values):
+        unknown = set(values) - set(VALUE_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown sales_daily columns: {sorted(unknown)}")
+        row = self._rows.setdefault((day, warehouse_id), {"date": day, "warehouse_id": warehouse_id})
+        row.update(values)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        if not self._rows:
+            return 0
+        n = upsert_rows(self.db, self._rows.values())
+        self._rows.clear()
+        if self.commit:
+            self.db.commit()
+        self.written += n
+        return n
+
+    def __enter__(self) -> "SalesDailyWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # при ошибке недописанную пачку не пишем
+        if exc_type is None:
+            self.flush()
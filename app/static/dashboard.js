@@ -159,49 +159,15 @@ async function fetchSummary(start,end,group,whId){ // one warehouse
   if(whId) url.searchParams.set('warehouse_id',whId);
   return jget(url.toString());
 }
-function sumTotals(a,b){ // sums totals-like objects
-  const out={}; for(const k of ['revenue','cost','discount','returns_cost','inflow_cost','receipts']){
-    out[k]=(a?.[k]||0)+(b?.[k]||0);
-  } return out;
-}
-function sumSeries(a,b){
-
-  // Склеиваем по ключу period и суммируем все основные поля, если они есть
-  const map=new Map();
-  const take = (obj, k) => {
-    if(!obj) return 0;
-    const v = obj[k];
-    return Number.isFinite(+v) ? (+v) : 0;
-  };
-  const KEYS = ['revenue','cost','discount','returns_cost','inflow_cost','receipts'];
-  for(const r of (a||[])){
-    const row = { period: r.period };
-    for(const k of KEYS) row[k] = take(r,k);
-    map.set(r.period, row);
-  }
-  for(const r of (b||[])){
-    const m = map.get(r.period) || { period:r.period };
-    for(const k of KEYS) m[k] = (m[k]||0) + take(r,k);
-    map.set(r.period, m);
-  }
-  return [...map.values()].sort((x,y)=>x.period.localeCompare(y.period));
-}
 async function fetchSummaryTotalsMulti(start,end,group,whIds){
   if(!whIds || whIds.length===0) return fetchSummary(start,end,group,null);
-  const arr=await Promise.all(whIds.map(id=>fetchSummary(start,end,group,id)));
-  // reduce totals + compare
-  const base = {totals:{}, compare:{previous:{}, previous_year:{}}};
-  const out = arr.reduce((acc,cur)=>{
-    acc.totals = sumTotals(acc.totals, cur.totals);
-    acc.compare = {
-      previous: sumTotals(acc.compare.previous, cur.compare?.previous),
-      previous_year: sumTotals(acc.compare.previous_year, cur.compare?.previous_year),
-    };
-    // series суммировать для сравнительного графика
-    acc.series = sumSeries(acc.series, cur.series);
-    return acc;
-  }, {...base, series:[]});
-  return out;
+  if(whIds.length===1) return fetchSummary(start,end,group,whIds[0]);
+  // все выбранные склады одним запросом, суммы по складам уже посчитаны на сервере
+  const url=new URL('/api/summary/multi',location.origin);
+  url.searchParams.set('start',start); url.searchParams.set('end',end); url.searchParams.set('group',group||'day');
+  for(const id of whIds) url.searchParams.append('warehouse_id',id);
+  const data=await jget(url.toString());
+  return data.combined || {series:[], totals:{}, compare:{previous:{}, previous_year:{}}};
 }
 async function fetchSummarySeriesMulti(start,end,group,whIds){
 
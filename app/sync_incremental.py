@@ -0,0 +1,147 @@
+import os
+import asyncio
+import datetime as dt
+from zoneinfo import ZoneInfo
+from sqlalchemy.dialects.postgresql import insert
+from .db import SessionLocal
+from .models import Warehouse, SyncWatermark
+from .ms_client import MSClient, BASE as MS_BASE
+from .sales_daily_writer import SalesDailyWriter
+from .profit_report import fetch_profit_snapshot
+from .sync_writeoff_daily import _ensure_reason_table
+from .rollup import recompute_cells
+from .sync_writeoff_items import load_store_day
+from .assortment_cache import price_cache
+from .tools import load_retail_day, load_enter_day
+
+# сущности МС, по изменениям которых пересчитываются ячейки (склад, день);
+# retailsalesreturn — возвраты, меняют returns_cost в том же отчёте прибыли
+ENTITIES = ("retaildemand", "retailsalesreturn", "enter", "loss")
+
+# без сохранённой отметки начинаем с «сейчас минус N дней»
+BOOTSTRAP_DAYS = int(os.getenv("INCREMENTAL_BOOTSTRAP_DAYS") or 2)
+
+# change feed не видит удалённых документов: последние N дней перезаливаются целиком
+# (факты дня заменяются, ячейки всех складов пересчитываются); 0 — только feed
+REPULL_DAYS = int(os.getenv("REPULL_DAYS") or 0)
+
+# moment/updated в МС — московское время, отметки и дни считаем в нём же, а не в поясе сервера
+MS_TZ = ZoneInfo("Europe/Moscow")
+
+Cell = tuple[str, dt.date]   # (store ms_id, день)
+
+def _uid(meta: dict | None) -> str:
+    href = (meta or {}).get("href") or ""
+    return href.rsplit("/", 1)[-1]
+
+def load_watermarks(db) -> dict[str, str]:
+    return {r.entity: r.updated_from for r in db.query(SyncWatermark).all()}
+
+def save_watermark(db, entity: str, updated_from: str):
+    ins = insert(SyncWatermark).values(entity=entity, updated_from=updated_from)
+    db.execute(ins.on_conflict_do_update(
+        index_elements=[SyncWatermark.entity],
+        set_={"updated_from": ins.excluded.updated_from, "updated_at": dt.datetime.now(dt.timezone.utc)},
+    ))
+
+async def changed_cells(ms: MSClient, entity: str, since: str) -> tuple[set[Cell], str | None, int]:
+    """
+    Документы сущности с updated>=since: затронутые (склад, день), новый максимум updated и число документов.
+    Отметка включительная — документы на границе пересчитаются ещё раз, это безопасно.
+    """
+    cells: set[Cell] = set()
+    max_updated = None
+    n = 0
+    params = {"filter": f"updated>={since}", "order": "updated"}
+    async for doc in ms.paged(f"/entity/{entity}", params=params):
+        n += 1
+        store = _uid((doc.get("store") or {}).get("meta"))
+        moment = (doc.get("moment") or "")[:10]
+        if store and moment:
+            cells.add((store, dt.date.fromisoformat(moment)))
+        upd = (doc.get("updated") or "")[:19]
+        if upd and (max_updated is None or upd > max_updated):
+            max_updated = upd
+    return cells, max_updated, n
+
+def _local(whs: dict[str, Warehouse], cells: set[Cell]) -> list[tuple[dt.date, int]]:
+    # (store ms_id, день) -> (день, warehouse.id) для rollup
+    return [(d, whs[store].id) for store, d in cells if store in whs]
+
+def repull_cells(whs: dict[str, Warehouse], days: int, today: dt.date) -> set[Cell]:
+    """Все (склад, день) за последние days дней, включая сегодня."""
+    return {(store, today - dt.timedelta(days=i)) for store in whs for i in range(days)}
+
+async def recompute_profit(ms: MSClient, writer: SalesDailyWriter, whs: dict[str, Warehouse], cells: set[Cell]):
+    """cost/returns/discount — единственное, чего нет в локальных фактах: отчёт прибыли по ячейке."""
+    for store, d in sorted(cells):
+        w = whs.get(store)
+        if w is None:
+            continue
+        cost, ret_cost, disc = await fetch_profit_snapshot(ms, store, d)
+        writer.add(d, w.id, cost=cost, returns_cost=ret_cost, discount=disc)
+
+async def run(since: str | None = None, repull_days: int = REPULL_DAYS):
+    """
+    Один проход change feed: для каждой сущности — документы с updated>=отметки,
+    пересчёт только затронутых ячеек (склад, день), затем сдвиг отметок.
+    Отметки сохраняются после успешной записи — упавший прогон повторит те же документы.
+    repull_days>0 — к затронутым ячейкам добавляются все ячейки последних дней: так из фактов
+    уходят документы, удалённые в МС (их нет в выдаче updated>=).
+    """
+    db = SessionLocal()
+    _ensure_reason_table(db)
+    db.commit()
+    whs = {w.ms_id: w for w in db.query(Warehouse).all()}
+    marks = load_watermarks(db)
+    now = dt.datetime.now(MS_TZ)
+    default_since = (now - dt.timedelta(days=BOOTSTRAP_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    repull = repull_cells(whs, repull_days, now.date())
+
+    try:
+        async with MSClient() as ms:
+            changed: dict[str, set[Cell]] = {}
+            new_marks: dict[str, str] = {}
+            for entity in ENTITIES:
+                frm = since or marks.get(entity) or default_since
+                cells, max_upd, n = await changed_cells(ms, entity, frm)
+                changed[entity] = cells | repull
+                if max_upd:
+                    new_marks[entity] = max_upd
+                print(f"[{entity}] updated>={frm}: {n} docs, {len(cells)} cells")
+
+            # позиционные факты — по дням целиком (загрузчики работают по дню для всех складов)
+            for day in sorted({d for _, d in changed["retaildemand"]}):
+                docs, n = await load_retail_day.load_day(ms, day)
+                print(f"[retail] {day}: {docs} docs, {n} positions")
+            for day in sorted({d for _, d in changed["enter"]}):
+                docs, n = await load_enter_day.load_day(ms, day)
+                print(f"[enter] {day}: {docs} docs, {n} positions")
+
+            # позиции списаний по затронутым складо-дням
+            for store, d in sorted(changed["loss"]):
+                w = whs.get(store)
+                if w is not None:
+                    st = {"id": w.id, "href": f"{MS_BASE}/entity/store/{store}", "name": w.name}
+                    await load_store_day(ms, db, st, d, commit=False)
+
+            # закупочные цены, подтянутые для списаний, — одно уведомление API на прогон
+            price_cache.flush()
+
+            # выручка/чеки, оприходования и списания — rollup из только что обновлённых фактов
+            recompute_cells(db, _local(whs, changed["retaildemand"]), parts=("sales",))
+            recompute_cells(db, _local(whs, changed["enter"]), parts=("inflow",))
+            recompute_cells(db, _local(whs, changed["loss"]), parts=("writeoff",))
+            with SalesDailyWriter(db, commit=False) as writer:
+                await recompute_profit(ms, writer, whs, changed["retaildemand"] | changed["retailsalesreturn"])
+            for entity, mark in new_marks.items():
+                save_watermark(db, entity, mark)
+            db.commit()
+            print(ms.stats_line())
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    # SINCE="YYYY-MM-DD HH:MM:SS" — разово пройти с указанного момента (отметки всё равно сдвинутся)
+    # REPULL_DAYS=N — заодно перезалить последние N дней целиком (ловит удаления)
+    asyncio.run(run(since=os.getenv("SINCE")))
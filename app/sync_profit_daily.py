@@ -1,60 +1,180 @@
+import asyncio
 import datetime as dt
-from decimal import Decimal, ROUND_HALF_UP
-import httpx
-from sqlalchemy.dialects.postgresql import insert
-from .config import settings
+from decimal import Decimal
+from sqlalchemy import text
 from .db import SessionLocal
-from .models import Warehouse, SalesDaily
+from .period_rollup import refresh_periods
+from .models import Warehouse
+from .ms_client import MSClient, BASE as MS_BASE
+from .profit_report import _rub, fetch_profit_snapshot, upsert_costs, upsert_discount
 
-MS_BASE = settings.MS_BASE_URL.rstrip("/")
-HEADERS = {
-    "Authorization": f"Bearer {settings.MS_API_TOKEN}",
-    "Accept": "application/json;charset=utf-8",
-    "Content-Type": "application/json",
-    "User-Agent": "worker-analytics/1.0",
-}
-
-def fetch_profit_by_day(store_ms_id: str, day: dt.date) -> tuple[Decimal, Decimal]:
+async def fetch_profit_by_day(ms: MSClient, store_ms_id: str, day: dt.date) -> tuple[Decimal, Decimal]:
     """Возвращает (sellCostSum, returnCostSum) за сутки по складу."""
+    cost, ret_cost, _ = await fetch_profit_snapshot(ms, store_ms_id, day)
+    return cost, ret_cost
+
+# --- помесячный режим: один отчёт за период + раскладка по дням через sales_item_fact ---
+
+QTY_EPS = Decimal("0.001")
+SUM_EPS = Decimal("1")  # копеек на строку (день, товар): выручка в фактах округлена до копейки
+
+def _uid(meta: dict | None) -> str:
+    href = (meta or {}).get("href") or ""
+    return href.rsplit("/", 1)[-1]
+
+def _d(v) -> Decimal:
+    return Decimal(str(v or 0))
+
+async def fetch_profit_by_product(ms: MSClient, store_ms_id: str, start: dt.date, end: dt.date) -> dict[str, dict]:
+    """
+    report/profit/byproduct за весь период по складу: assortment_id -> суммы в копейках.
+    Отчёт не группируется по складам, поэтому запрос всё равно один на склад — но на месяц, а не на день.
+    """
     params = {
-        "momentFrom": f"{day} 00:00:00",
-        "momentTo": f"{day} 23:59:59",
+        "momentFrom": f"{start} 00:00:00",
+        "momentTo": f"{end} 23:59:59",
         "filter": f"store={MS_BASE}/entity/store/{store_ms_id}",
-        "limit": 1000,
     }
-    url = f"{MS_BASE}/report/profit/byproduct"
-    with httpx.Client(timeout=60.0, headers=HEADERS) as c:
-        r = c.get(url, params=params)
-        r.raise_for_status()
-        data = r.json()
-    rows = data.get("rows") or []
-    sell_cost_sum = Decimal("0")
-    return_cost_sum = Decimal("0")
-    for row in rows:
-        sell_cost_sum += Decimal(str(row.get("sellCostSum", 0)))
-        return_cost_sum += Decimal(str(row.get("returnCostSum", 0)))
-    # из копеек в рубли
-    sell_cost_sum = (sell_cost_sum / Decimal(100)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    return_cost_sum = (return_cost_sum / Decimal(100)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    return sell_cost_sum, return_cost_sum
-
-def upsert_costs(session, warehouse_id: int, day: dt.date, cost_rub: Decimal, returns_cost_rub: Decimal):
-    ins = insert(SalesDaily).values(
-        date=day,
-        warehouse_id=warehouse_id,
-        cost=cost_rub,
-        returns_cost=returns_cost_rub,
-    )
-    upsert = ins.on_conflict_do_update(
-        index_elements=[SalesDaily.date, SalesDaily.warehouse_id],
-        set_={
-            "cost": ins.excluded.cost,
-            "returns_cost": ins.excluded.returns_cost,
-        },
-    )
-    session.execute(upsert)
-
-def main(days_back: int = 14):
+    out: dict[str, dict] = {}
+    async for row in ms.paged("/report/profit/byproduct", params=params):
+        pid = _uid((row.get("assortment") or {}).get("meta"))
+        out[pid] = {
+            "sell_qty": _d(row.get("sellQuantity")),
+            "sell_cost": _d(row.get("sellCostSum")),
+            "sell_price": _d(row.get("sellPrice")),
+            "sell_sum": _d(row.get("sellSum")),
+            "ret_qty": _d(row.get("returnQuantity")),
+            "ret_cost": _d(row.get("returnCostSum")),
+        }
+    return out
+
+async def fetch_return_qty_by_day(ms: MSClient, store_ms_id: str, start: dt.date, end: dt.date) -> dict[tuple[dt.date, str], Decimal]:
+    """Розничные возвраты за период: (день, assortment_id) -> количество."""
+    params = {
+        "expand": "positions",
+        "filter": f"moment>={start} 00:00:00;moment<={end} 23:59:59;store={MS_BASE}/entity/store/{store_ms_id}",
+    }
+    out: dict[tuple[dt.date, str], Decimal] = {}
+    # expand работает только при limit<=100
+    async for doc in ms.paged("/entity/retailsalesreturn", limit=100, params=params):
+        day = dt.date.fromisoformat((doc.get("moment") or "")[:10])
+        for p in (doc.get("positions") or {}).get("rows") or []:
+            key = (day, _uid((p.get("assortment") or {}).get("meta")))
+            out[key] = out.get(key, Decimal("0")) + _d(p.get("quantity"))
+    return out
+
+def load_sales_qty_by_day(db, store_ms_id: str, start: dt.date, end: dt.date) -> dict[tuple[dt.date, str], tuple[Decimal, Decimal]]:
+    """Продажи из sales_item_fact: (день, product_id) -> (qty, revenue в рублях)."""
+    rows = db.execute(text("""
+        SELECT date, product_id::text, SUM(qty), SUM(revenue)
+          FROM sales_item_fact
+         WHERE warehouse_id = CAST(:wh AS uuid) AND date BETWEEN :start AND :end
+         GROUP BY 1, 2
+    """), {"wh": store_ms_id, "start": start, "end": end}).all()
+    return {(r[0], r[1]): (_d(r[2]), _d(r[3])) for r in rows}
+
+def last_fact_day(db, store_ms_id: str, start: dt.date, end: dt.date) -> dt.date | None:
+    """Последний день периода, по которому в sales_item_fact уже есть продажи склада."""
+    return db.execute(text("""
+        SELECT MAX(date) FROM sales_item_fact
+         WHERE warehouse_id = CAST(:wh AS uuid) AND date BETWEEN :start AND :end
+    """), {"wh": store_ms_id, "start": start, "end": end}).scalar()
+
+def distribute_profit(by_product: dict[str, dict],
+                      sales: dict[tuple[dt.date, str], tuple[Decimal, Decimal]],
+                      returns: dict[tuple[dt.date, str], Decimal],
+                      days: list[dt.date]) -> tuple[dict[dt.date, tuple[Decimal, Decimal, Decimal]], set[dt.date]]:
+    """
+    Раскладывает период по дням: себестоимость — по средней себестоимости единицы товара за период,
+    скидка — sellPrice (средняя цена за период) * qty минус фактическая выручка позиции.
+    Это не то же, что дневной отчёт: себестоимость дня — доля периода, а не себестоимость партий,
+    проданных именно в этот день; суммы за период с отчётом совпадают.
+    Товар сходится, если с отчётом совпали и количество, и выручка (sellSum); иначе его дни несошедшиеся.
+    Возвращает (день -> (cost, returns_cost, discount), дни, которые не сошлись с отчётом).
+    Если расхождение нельзя привязать к дням (товара нет в фактах вовсе) — все дни несошедшиеся.
+    """
+    cost_c = {d: Decimal("0") for d in days}
+    ret_c = {d: Decimal("0") for d in days}
+    disc_c = {d: Decimal("0") for d in days}
+    bad: set[dt.date] = set()
+
+    sold_qty: dict[str, Decimal] = {}
+    sold_sum: dict[str, Decimal] = {}
+    sold_rows: dict[str, int] = {}
+    for (d, pid), (qty, revenue) in sales.items():
+        sold_qty[pid] = sold_qty.get(pid, Decimal("0")) + qty
+        sold_sum[pid] = sold_sum.get(pid, Decimal("0")) + revenue * 100
+        sold_rows[pid] = sold_rows.get(pid, 0) + 1
+    ret_qty: dict[str, Decimal] = {}
+    for (d, pid), qty in returns.items():
+        ret_qty[pid] = ret_qty.get(pid, Decimal("0")) + qty
+
+    for pid, p in by_product.items():
+        if abs(sold_qty.get(pid, Decimal("0")) - p["sell_qty"]) > QTY_EPS:
+            if pid not in sold_qty and p["sell_qty"]:
+                return {}, set(days)
+            bad.update(d for (d, q) in sales if q == pid)
+        elif pid in sold_sum and abs(sold_sum[pid] - p["sell_sum"]) > SUM_EPS * sold_rows[pid]:
+            bad.update(d for (d, q) in sales if q == pid)
+        if abs(ret_qty.get(pid, Decimal("0")) - p["ret_qty"]) > QTY_EPS:
+            if pid not in ret_qty and p["ret_qty"]:
+                return {}, set(days)
+            bad.update(d for (d, q) in returns if q == pid)
+
+    for (d, pid), (qty, revenue) in sales.items():
+        p = by_product.get(pid)
+        if p is None:
+            # продажа есть в фактах, но не в отчёте — день не сходится
+            bad.add(d)
+            continue
+        if p["sell_qty"]:
+            cost_c[d] += p["sell_cost"] * qty / p["sell_qty"]
+        disc_c[d] += p["sell_price"] * qty - revenue * 100
+    for (d, pid), qty in returns.items():
+        p = by_product.get(pid)
+        if p is None:
+            bad.add(d)
+            continue
+        if p["ret_qty"]:
+            ret_c[d] += p["ret_cost"] * qty / p["ret_qty"]
+
+    return {d: (_rub(cost_c[d]), _rub(ret_c[d]), _rub(disc_c[d])) for d in days}, bad
+
+def load_profit_facts(db, store_ms_id: str, start: dt.date, end: dt.date):
+    """Последний день с фактами и продажи по дням до него — оба чтения из БД до запросов в МС."""
+    fact_end = last_fact_day(db, store_ms_id, start, end)
+    sales = load_sales_qty_by_day(db, store_ms_id, start, fact_end) if fact_end else {}
+    return fact_end, sales
+
+async def fetch_profit_range(ms: MSClient, db, store_ms_id: str, start: dt.date, end: dt.date) -> dict[dt.date, tuple[Decimal, Decimal, Decimal]]:
+    """
+    (cost, returns_cost, discount) по дням периода: 2 запроса на склад-период
+    (+ страницы), поштучный fetch_profit_snapshot — только для несошедшихся дней.
+    Отчёт за период берётся только за дни, для которых уже загружены факты продаж
+    (обычно до вчера): хвост без фактов (сегодня) всегда считается по дневным снимкам.
+    """
+    fact_end, sales = load_profit_facts(db, store_ms_id, start, end)
+    return await profit_range_from_facts(ms, store_ms_id, start, end, fact_end, sales)
+
+async def profit_range_from_facts(ms: MSClient, store_ms_id: str, start: dt.date, end: dt.date,
+                                  fact_end: dt.date | None, sales: dict) -> dict[dt.date, tuple[Decimal, Decimal, Decimal]]:
+    """fetch_profit_range по уже прочитанным фактам (load_profit_facts) — без обращений к БД."""
+    days = [start + dt.timedelta(days=i) for i in range((end - start).days + 1)]
+    covered = [d for d in days if fact_end is not None and d <= fact_end]
+    result: dict[dt.date, tuple[Decimal, Decimal, Decimal]] = {}
+    bad: set[dt.date] = set(days[len(covered):])
+    if covered:
+        by_product = await fetch_profit_by_product(ms, store_ms_id, start, fact_end)
+        returns = await fetch_return_qty_by_day(ms, store_ms_id, start, fact_end)
+        result, covered_bad = distribute_profit(by_product, sales, returns, covered)
+        bad |= covered_bad
+    for d in sorted(bad):
+        result[d] = await fetch_profit_snapshot(ms, store_ms_id, d)
+    if bad:
+        print(f"profit range {store_ms_id} {start}..{end}: per-day fallback for {len(bad)} of {len(days)} days")
+    return result
+
+async def main(days_back: int = 14, by_range: bool = True):
     today = dt.date.today()
     start = today - dt.timedelta(days=days_back-1)
 
@@ -65,17 +185,31 @@ def main(days_back: int = 14):
         return
 
     total_updates = 0
-    for w in warehouses:
-        d = start
-        while d <= today:
-            cost, ret_cost = fetch_profit_by_day(w.ms_id, d)
-            upsert_costs(db, w.id, d, cost, ret_cost)
+    async with MSClient() as ms:
+        for w in warehouses:
+            if by_range:
+                per_day = await fetch_profit_range(ms, db, w.ms_id, start, today)
+            cells = []
+            d = start
+            while d <= today:
+                # скидку отдаёт тот же отчёт — пишем её сразу, отдельный sync_discounts_daily не нужен
+                if by_range:
+                    cost, ret_cost, disc = per_day[d]
+                else:
+                    cost, ret_cost, disc = await fetch_profit_snapshot(ms, w.ms_id, d)
+                upsert_costs(db, w.id, d, cost, ret_cost)
+                upsert_discount(db, w.id, d, disc)
+                print(f"{w.name} {d}: cost={cost} returns_cost={ret_cost} discount={disc}")
+                cells.append((d, w.id))
+                total_updates += 1
+                d += dt.timedelta(days=1)
+            # склад целиком — одна транзакция: месяцы/годы и одно уведомление API на весь период
+            refresh_periods(db, cells)
             db.commit()
-            print(f"{w.name} {d}: cost={cost} returns_cost={ret_cost}")
-            total_updates += 1
-            d += dt.timedelta(days=1)
+        print(ms.stats_line())
     db.close()
     print(f"done, updated days: {total_updates}")
 
 if __name__ == "__main__":
-    main(days_back=14)
+    import os
+    asyncio.run(main(days_back=14, by_range=os.getenv("PROFIT_BY_DAY") != "1"))
@@ -1,20 +1,12 @@
+import asyncio
 import datetime as dt
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal, ROUND_HALF_UP
-import httpx
 from sqlalchemy.dialects.postgresql import insert
-from .config import settings
 from .db import SessionLocal
+from .period_rollup import refresh_periods
 from .models import Warehouse, SalesDaily
-
-MS_BASE = settings.MS_BASE_URL.rstrip("/")
-
-HEADERS = {
-    "Authorization": f"Bearer {settings.MS_API_TOKEN}",
-    "Accept": "application/json;charset=utf-8",
-    "Content-Type": "application/json",
-    "User-Agent": "worker-analytics/1.0",
-}
+from .ms_client import MSClient, BASE as MS_BASE
 
 def iter_months(start: dt.date, end: dt.date):
     cur = dt.date(start.year, start.month, 1)
@@ -25,19 +17,15 @@ def iter_months(start: dt.date, end: dt.date):
         yield month_start, month_end
         cur = cur + relativedelta(months=1)
 
-def fetch_sales_series(store_ms_id: str, date_from: dt.date, date_to: dt.date):
+async def fetch_sales_series(ms: MSClient, store_ms_id: str, date_from: dt.date, date_to: dt.date):
     params = {
         "momentFrom": f"{date_from} 00:00:00",
         "momentTo": f"{date_to} 23:59:59",
         "interval": "day",
         "filter": f"store={MS_BASE}/entity/store/{store_ms_id}",
     }
-    url = f"{MS_BASE}/report/sales/plotseries"
-    with httpx.Client(timeout=60.0, headers=HEADERS) as client:
-        r = client.get(url, params=params)
-        r.raise_for_status()
-        data = r.json()
-        return data.get("series", [])
+    data = await ms.get_json("/report/sales/plotseries", params=params)
+    return data.get("series", [])
 
 def upsert_sales_daily(session, warehouse_id: int, d: dt.date, revenue_rub: Decimal, receipts: int):
     revenue_rub = (revenue_rub if isinstance(revenue_rub, Decimal) else Decimal(str(revenue_rub)))
@@ -58,7 +46,7 @@ def upsert_sales_daily(session, warehouse_id: int, d: dt.date, revenue_rub: Deci
     )
     session.execute(stmt)
 
-def main(full_history: bool = False):
+async def main(full_history: bool = False):
     start = dt.date(2019, 1, 1)
     today = dt.date.today()
     if not full_history:
@@ -72,20 +60,24 @@ def main(full_history: bool = False):
         return
 
     total_points = 0
-    for w in warehouses:
-        for m_from, m_to in iter_months(start, today):
-            series = fetch_sales_series(w.ms_id, m_from, m_to)
-            for point in series:
-                d = dt.datetime.strptime(point["date"], "%Y-%m-%d %H:%M:%S").date()
-                # у МС суммы в копейках, переводим в рубли
-                revenue_rub = Decimal(str(point.get("sum", 0))) / Decimal(100)
-                receipts = int(point.get("quantity", 0))
-                upsert_sales_daily(db, w.id, d, revenue_rub, receipts)
-                total_points += 1
-            db.commit()
-            print(f"{w.name}: {m_from}..{m_to} -> {len(series)} days")
+    async with MSClient() as ms:
+        for w in warehouses:
+            for m_from, m_to in iter_months(start, today):
+                series = await fetch_sales_series(ms, w.ms_id, m_from, m_to)
+                for point in series:
+                    d = dt.datetime.strptime(point["date"], "%Y-%m-%d %H:%M:%S").date()
+                    # у МС суммы в копейках, переводим в рубли
+                    revenue_rub = Decimal(str(point.get("sum", 0))) / Decimal(100)
+                    receipts = int(point.get("quantity", 0))
+                    upsert_sales_daily(db, w.id, d, revenue_rub, receipts)
+                    total_points += 1
+                # месяц/год — один пересчёт на месяц серии, в той же транзакции
+                refresh_periods(db, [(m_from, w.id)])
+                db.commit()
+                print(f"{w.name}: {m_from}..{m_to} -> {len(series)} days")
+        print(ms.stats_line())
     db.close()
     print(f"done, upserted points: {total_points}")
 
 if __name__ == "__main__":
-    main(full_history=False)
+    asyncio.run(main(full_history=False))
@@ -1,9 +1,12 @@
-import asyncio, httpx
+import asyncio
 from datetime import date, timedelta
 from typing import Dict, Any, List
 from sqlalchemy import text
-from app.config import settings
-from app.db import get_session
+from app.ms_client import MSClient, BASE as MS_BASE
+from app.checkpoint import done_units, track
+from app.assortment_cache import price_cache, position_hrefs
+from app.writeoff_costing import documents_positions, costs_for_positions, kop_to_rub
+from app.writeoff_reasons import REASON_NAMES, doc_bucket
 from contextlib import contextmanager as _cm
 from app.db import get_session as _get_session
 
@@ -19,20 +22,6 @@ def session_cm():
             next(gen)
         except StopIteration:
             pass
-MS_BASE = settings.MS_BASE_URL.rstrip("/")
-
-def reason_from_doc(doc: Dict[str, Any]) -> str:
-    for a in (doc.get("attributes") or []):
-        name = (a.get("name") or "").lower()
-        val  = a.get("value")
-        sval = (str(val or "")).lower() if isinstance(val, (str,int,float)) else ""
-        if "причин" in name or "reason" in name:
-            if "брак" in sval: return "Брак"
-            if "инвент" in sval: return "Инвентаризация"
-    nm = (doc.get("name") or "").lower()
-    desc= (doc.get("description") or "").lower()
-    if "инвент" in nm or "инвент" in desc: return "Инвентаризация"
-    return "Брак"
 
 def rub_from_value(v):
     try:
@@ -40,62 +29,28 @@ def rub_from_value(v):
     except Exception:
         return 0.0
 
-async def fetch_json(ac, url, **params):
-    while True:
-        r = await ac.get(url, params=params or None)
-        if r.status_code == 429:
-            print("‼️ 429 Too Many Requests — сплю 20с и повторяю…", url)
-            await asyncio.sleep(20)
-            continue
-        r.raise_for_status()
-        return r.json()
-
-async def fetch_loss_docs(ac: httpx.AsyncClient, store_href: str, day: date) -> List[Dict[str, Any]]:
+async def fetch_loss_docs(ms: MSClient, store_href: str, day: date) -> List[Dict[str, Any]]:
     params = {
-        "limit": 100, "offset": 0,
         "filter": f"moment>={day} 00:00:00;moment<={day} 23:59:59;store={store_href}",
         "expand": "attributes",
         "order": "moment",
     }
-    res = []
-    while True:
-        data = await fetch_json(ac, f"{MS_BASE}/entity/loss", **params)
-        rows = data.get("rows") or []
-        res.extend(rows)
-        if len(rows) < params["limit"]:
-            break
-        params["offset"] += params["limit"]
-    return res
-
-async def fetch_positions(ac: httpx.AsyncClient, doc_href: str) -> List[Dict[str, Any]]:
-    data = await fetch_json(ac, f"{doc_href}/positions", limit=1000, expand="assortment")
-    return data.get("rows") or []
-
-_product_bp_cache: Dict[str, float] = {}
+    return [doc async for doc in ms.paged("/entity/loss", limit=100, params=params)]
 
-async def get_product_buy_price(ac: httpx.AsyncClient, product_href: str) -> float:
+async def get_product_buy_price(ms: MSClient, product_href: str) -> float:
     if not product_href:
         return 0.0
-    if product_href in _product_bp_cache:
-        return _product_bp_cache[product_href]
-    data = await fetch_json(ac, product_href)
-    bp = 0.0
-    if "buyPrice" in data:
-        v = data["buyPrice"]
-        if isinstance(v, dict) and "value" in v:
-            bp = rub_from_value(v["value"])
-        else:
-            bp = rub_from_value(v)
-    _product_bp_cache[product_href] = bp
-    return bp
+    # кэш в памяти + таблица assortment_price: цена переживает процесс
+    return rub_from_value(await price_cache.buy_price(ms, product_href))
 
-async def resolve_buy_price(ac: httpx.AsyncClient, pos: Dict[str, Any]) -> float:
+async def resolve_buy_price(ms: MSClient, pos: Dict[str, Any]) -> float:
     # 1) buyPrice прямо в позиции
     v = ((pos.get("buyPrice") or {}) or {}).get("value")
     if v:
         return rub_from_value(v)
     # 2) buyPrice в assortment (variant/product)
     ass = pos.get("assortment") or {}
+    price_cache.observe(ass)
     if "buyPrice" in ass:
         vv = ass["buyPrice"]
         if isinstance(vv, dict) and "value" in vv:
@@ -108,52 +63,85 @@ async def resolve_buy_price(ac: httpx.AsyncClient, pos: Dict[str, Any]) -> float
         href = (((ass.get("product") or {}).get("meta") or {}).get("href")) or ""
     else:
         href = meta.get("href") or ""
-    return await get_product_buy_price(ac, href)
+    return await get_product_buy_price(ms, href)
+
+CHECKPOINT_JOB = "writeoff_items"
+
+async def load_store_day(ms: MSClient, s, st: Dict[str, Any], cur: date, commit: bool = True) -> int:
+    # commit=False — запись остаётся в транзакции вызывающего (коммит вместе с rollup и отметками)
+    docs = await fetch_loss_docs(ms, st["href"], cur)
+    # сначала позиции всех документов дня (параллельно, DOC_CONCURRENCY), затем цены одним пакетом (filter=id=..), затем расчёт
+    pos_lists = await documents_positions(ms, [d.get("meta",{}).get("href") for d in docs])
+    doc_positions = list(zip(docs, pos_lists))
+    for _, rows in doc_positions:
+        for p in rows:
+            price_cache.observe(p.get("assortment"))
+    await price_cache.prefetch(ms, [h for _, rows in doc_positions for h in position_hrefs(rows)])
+    # чистим на день/склад
+    s.execute(text("DELETE FROM writeoff_item WHERE day=:d AND warehouse_id=:wid"),
+              {"d": cur, "wid": st["id"]})
+    ins = []
+    for d, positions in doc_positions:
+        doc_id   = d.get("id")
+        # в writeoff_item — уже корзина (Брак/Инвентаризация/Прочее), тем же правилом, что в sync_writeoff_daily
+        reason   = REASON_NAMES[doc_bucket(d)]
+        # себестоимость — тем же движком, что и sync_writeoff_daily (sum -> price*qty -> buyPrice*qty)
+        costs = await costs_for_positions(ms, positions)
+        for p, cost_kop in zip(positions, costs):
+            qty = float(p.get("quantity") or 0)
+            bp  = await resolve_buy_price(ms, p)   # RUB
+            cost= float(kop_to_rub(cost_kop))
+            ass = p.get("assortment") or {}
+            ins.append({
+                "d": cur, "wid": st["id"], "wname": st["name"],
+                "doc_id": doc_id, "pos_id": p.get("id"),
+                "pid": ass.get("id"), "pcode": ass.get("code"), "pname": ass.get("name"),
+                "reason": reason, "qty": qty, "bp": bp, "cost": cost
+            })
+    if ins:
+        s.execute(text("""
+            INSERT INTO writeoff_item
+            (day, warehouse_id, warehouse_name, doc_id, position_id, product_id, product_code, product_name, reason, qty, buy_price, cost)
+            VALUES
+            (:d, :wid, :wname, :doc_id, :pos_id, :pid, :pcode, :pname, :reason, :qty, :bp, :cost)
+        """), ins)
+    if commit:
+        s.commit()
+    return len(ins)
 
-async def run_range(start: date, end: date):
-    headers = {"Authorization": f"Bearer {settings.MS_API_TOKEN}", "Accept":"application/json;charset=utf-8"}
-    async with httpx.AsyncClient(timeout=60.0, headers=headers) as ac:
+async def run_range(start: date, end: date, resume: bool = True):
+    # склад-день — единица sync_checkpoint: с resume готовые пропускаем, упавшие повторяем
+    done = done_units(CHECKPOINT_JOB, start, end) if resume else set()
+    failed = 0
+    async with MSClient() as ms:
+        # закупочные цены: первый раз — весь каталог, дальше — только изменённое
+        await price_cache.warm(ms)
         # БД-сессия — обычный sync context manager
-with session_cm() as s:
-                       stores = s.execute(text("SELECT id, ms_id, name FROM warehouse WHERE ms_id IS NOT NULL")).mappings().all()
+        with session_cm() as s:
+            stores = s.execute(text("SELECT id, ms_id, name FROM warehouse WHERE ms_id IS NOT NULL")).mappings().all()
             stores = [{"id": r["id"], "href": f"{MS_BASE}/entity/store/{r['ms_id']}", "name": r["name"]} for r in stores]
 
             cur = start
             while cur <= end:
                 for st in stores:
-                    docs = await fetch_loss_docs(ac, st["href"], cur)
-                    # чистим на день/склад
-                    s.execute(text("DELETE FROM writeoff_item WHERE day=:d AND warehouse_id=:wid"),
-                              {"d": cur, "wid": st["id"]})
-                    ins = []
-                    for d in docs:
-                        doc_id   = d.get("id")
-                        doc_href = d.get("meta",{}).get("href")
-                        reason   = reason_from_doc(d)
-                        for p in (await fetch_positions(ac, doc_href)):
-                            qty = float(p.get("quantity") or 0)
-                            bp  = await resolve_buy_price(ac, p)   # RUB
-                            cost= round(qty * bp, 2)
-                            ass = p.get("assortment") or {}
-                            ins.append({
-                                "d": cur, "wid": st["id"], "wname": st["name"],
-                                "doc_id": doc_id, "pos_id": p.get("id"),
-                                "pid": ass.get("id"), "pcode": ass.get("code"), "pname": ass.get("name"),
-                                "reason": reason, "qty": qty, "bp": bp, "cost": cost
-                            })
-                    if ins:
-                        s.execute(text("""
-                            INSERT INTO writeoff_item
-                            (day, warehouse_id, warehouse_name, doc_id, position_id, product_id, product_code, product_name, reason, qty, buy_price, cost)
-                            VALUES
-                            (:d, :wid, :wname, :doc_id, :pos_id, :pid, :pcode, :pname, :reason, :qty, :bp, :cost)
-                        """), ins)
-                    s.commit()
+                    if (st["id"], cur) in done:
+                        continue
+                    try:
+                        with track(CHECKPOINT_JOB, st["id"], cur) as cp:
+                            cp["rows"] = await load_store_day(ms, s, st, cur)
+                    except Exception as e:
+                        s.rollback()
+                        failed += 1
+                        print(f"[FAIL] {cur} {st['name']}: {type(e).__name__}: {e}")
                 print(f"[OK] {cur} done")
-            cur += timedelta(days=1)
+                cur += timedelta(days=1)
+        price_cache.flush()
+        print(price_cache.stats_line())
+    if failed:
+        print(f"failed store-days: {failed} (rerun to retry)")
 
 if __name__ == "__main__":
     import os
     s = date.fromisoformat(os.environ.get("START") or "2019-01-01")
     e = date.fromisoformat(os.environ.get("END")   or date.today().isoformat())
-    asyncio.run(run_range(s, e))
+    asyncio.run(run_range(s, e, resume=os.environ.get("FORCE") != "1"))
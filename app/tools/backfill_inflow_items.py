@@ -0,0 +1,93 @@
+import os, sys, asyncio, datetime as dt, time
+from pathlib import Path
+from app.ms_client import MSClient
+from app.checkpoint import ALL_WAREHOUSES, done_units, track
+from app.tools.load_enter_day import load_day, _env
+
+CHECKPOINT_JOB = "inflow_items"
+
+# дней в работе одновременно; коннект из пула engine день берёт только на COPY (без await внутри),
+# так что число дней ограничено лимитами МС, а не пулом
+DAY_CONCURRENCY = int(os.getenv("DAY_CONCURRENCY") or 3)
+
+def _read_days(path: Path | None) -> set[str]:
+    if not path or not path.exists():
+        return set()
+    return {line.strip() for line in path.read_text(encoding="utf-8").splitlines() if line.strip()}
+
+def _append(path: Path | None, line: str):
+    if path:
+        with path.open("a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+async def run_range(start: dt.date, end: dt.date, concurrency: int = DAY_CONCURRENCY,
+                    ok_log: Path | None = None, err_log: Path | None = None, token: str | None = None,
+                    resume: bool = False):
+    """
+    Оприходования по дням за [start..end] в одном процессе: общий MSClient и engine,
+    несколько дней параллельно. Каждый день отмечается в sync_checkpoint; с resume дни,
+    отмеченные ok (в таблице или в ok_log), пропускаются, упавшие повторяются.
+    ok_log/err_log дописываются как в старом backfill_inflow_items.sh.
+    """
+    done = _read_days(ok_log) if resume else set()
+    if resume:
+        done |= {d.isoformat() for _, d in done_units(CHECKPOINT_JOB, start, end)}
+    days = [start + dt.timedelta(days=i) for i in range((end - start).days + 1)]
+    todo = [d for d in days if d.isoformat() not in done]
+    print(f"== inflow enter positions: {start} .. {end}: {len(todo)} to run, {len(days) - len(todo)} skipped ==")
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for d in todo:
+        queue.put_nowait(d)
+    stats = {"ok": 0, "err": 0}
+
+    async def worker(ms: MSClient):
+        while True:
+            try:
+                d = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t0 = time.monotonic()
+            try:
+                with track(CHECKPOINT_JOB, ALL_WAREHOUSES, d) as cp:
+                    docs, n = await load_day(ms, d)
+                    cp["rows"] = n
+            except Exception as e:
+                _append(err_log, d.isoformat())
+                stats["err"] += 1
+                print(f"[FAIL] {d}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            _append(ok_log, d.isoformat())
+            stats["ok"] += 1
+            print(f"[ok  ] {d}: docs={docs} positions={n} {time.monotonic() - t0:.1f}s")
+
+    async with MSClient(token=token) as ms:
+        await asyncio.gather(*[worker(ms) for _ in range(max(1, concurrency))])
+        print(ms.stats_line())
+    print(f"== Done. OK: {stats['ok']}  ERR: {stats['err']}")
+    return stats
+
+def main():
+    args = sys.argv[1:]
+    start_s = (args[0] if args else None) or os.getenv("START") or "2019-01-01"
+    end_s = (args[1] if len(args) > 1 else None) or os.getenv("END") or dt.date.today().isoformat()
+    token = _env("MS_TOKEN") or _env("MS_API_TOKEN")
+    if not token:
+        raise SystemExit("Нет MS_TOKEN/MS_API_TOKEN ни в окружении, ни в .env")
+
+    # пропуск готовых дней и учёт ok/err — только если задан LOG_DIR (бэкофил);
+    # ежедневный синк перезаливает дни всегда
+    log_dir = os.getenv("LOG_DIR")
+    ok_log = err_log = None
+    if log_dir:
+        Path(log_dir).mkdir(parents=True, exist_ok=True)
+        ok_log = Path(log_dir) / "inflow_backfill.ok"
+        err_log = Path(log_dir) / "inflow_backfill.err"
+
+    stats = asyncio.run(run_range(dt.date.fromisoformat(start_s), dt.date.fromisoformat(end_s),
+                                  ok_log=ok_log, err_log=err_log, token=token, resume=bool(log_dir)))
+    if stats["err"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+from typing import Sequence
+from sqlalchemy import Connection
+
+class CopyUpsert:
+    """
+    Потоковая загрузка строк в факт-таблицу: COPY ... FROM STDIN во временную staging-таблицу,
+    каждые batch_size строк (и на close) — один set-based INSERT ... SELECT ... ON CONFLICT.
+    Память ограничена пачкой, файлов нет. Транзакцией управляет вызывающий (conn из engine.begin()).
+
+        with engine.begin() as conn, CopyUpsert(conn, "sales_item_fact", COLUMNS, "position_id", UPDATE) as cu:
+            cu.write((...))
+    """
+
+    def __init__(self, conn: Connection, table: str, columns: Sequence[str], key: str,
+                 update: Sequence[str], batch_size: int = 50_000):
+        self.table = table
+        self.columns = tuple(columns)
+        self.key = key
+        self.update = tuple(update)
+        self.batch_size = batch_size
+        self.staging = f"_{table}_stg"
+        self.written = 0
+        self._pending = 0
+        self._copy_cm = None
+        self._copy = None
+        # psycopg-соединение под SQLAlchemy: COPY через него, в той же транзакции
+        self._raw = conn.connection.driver_connection
+        self._cur = self._raw.cursor()
+        cols = ", ".join(self.columns)
+        # только типы нужных колонок, без ограничений целевой таблицы
+        self._cur.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {self.staging} ON COMMIT DROP "
+            f"AS SELECT {cols} FROM {self.table} WITH NO DATA"
+        )
+        # порядковый номер строки в пачке: при дублях ключа побеждает записанная последней
+        self._cur.execute(f"ALTER TABLE {self.staging} ADD COLUMN IF NOT EXISTS _seq bigserial")
+        self._copy_sql = f"COPY {self.staging} ({cols}) FROM STDIN"
+        sets = ", ".join(f"{c} = EXCLUDED.{c}" for c in self.update)
+        # DISTINCT ON: одна и та же позиция дважды в пачке не должна ронять ON CONFLICT;
+        # ORDER BY _seq DESC — остаётся последняя версия строки, как при построчном upsert
+        self._upsert_sql = (
+            f"INSERT INTO {self.table} ({cols}, updated_at) "
+            f"SELECT DISTINCT ON ({self.key}) {cols}, now() FROM {self.staging} "
+            f"ORDER BY {self.key}, _seq DESC "
+            f"ON CONFLICT ({self.key}) DO UPDATE SET {sets}, updated_at = now()"
+        )
+
+    def write(self, row: Sequence):
+        if self._copy is None:
+            self._copy_cm = self._cur.copy(self._copy_sql)
+            self._copy = self._copy_cm.__enter__()
+        self._copy.write_row(row)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        if self._copy is not None:
+            self._copy_cm.__exit__(None, None, None)
+            self._copy_cm = self._copy = None
+        if not self._pending:
+            return 0
+        self._cur.execute(self._upsert_sql)
+        self._cur.execute(f"TRUNCATE {self.staging}")
+        n, self._pending = self._pending, 0
+        self.written += n
+        return n
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._cur.close()
+
+    def __enter__(self) -> "CopyUpsert":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # ошибка: COPY закрываем с ошибкой, транзакцию откатит engine.begin()
+        if self._copy is not None:
+            self._copy_cm.__exit__(exc_type, exc, tb)
+        self._cur.close()
@@ -1,9 +1,10 @@
-import os, datetime as dt, time, random, requests
+import os, asyncio, datetime as dt
 from decimal import Decimal, ROUND_HALF_UP
 from sqlalchemy import text
-from app.db import SessionLocal
-
-API = os.getenv("MS_BASE_URL", "https://api.moysklad.ru/api/remap/1.2").rstrip("/")
+from app.db import engine
+from app.ms_client import MSClient
+from app.tools.copy_upsert import CopyUpsert
+from app.data_changes import notify_changed
 
 def _env(name):
     v = os.getenv(name)
@@ -19,57 +20,53 @@ def _env(name):
         pass
     return None
 
-def _jget(url, headers, params=None, tries=0, timeout=60):
-    r = requests.get(url, headers=headers, params=params, timeout=timeout)
-    if r.status_code in (429,500,502,503) and tries < 5:
-        ra = r.headers.get("Retry-After")
-        try:
-            delay = float(ra) if ra else min(2**tries, 30) + random.uniform(0, 0.3)
-        except Exception:
-            delay = min(2**tries, 30) + random.uniform(0, 0.3)
-        time.sleep(delay)
-        return _jget(url, headers, params=params, tries=tries+1, timeout=timeout)
-    r.raise_for_status()
-    return r.json()
-
-def fetch_enters_day(day: dt.date, token: str):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json;charset=utf-8",
-        "Content-Type": "application/json",
-        "User-Agent": "worker-analytics/load-enter-day"
-    }
+async def fetch_enters_day(ms: MSClient, day: dt.date):
     next_day = day + dt.timedelta(days=1)
     filt = f"moment>={day} 00:00:00;moment<{next_day} 00:00:00"
-    url = f"{API}/entity/enter"
-    params = {"limit": 1000, "expand":"store", "filter": filt}
-    rows = []
-    while True:
-        data = _jget(url, headers=headers, params=params)
-        rows.extend(data.get("rows", []))
-        next_href = (data.get("meta") or {}).get("nextHref")
-        if not next_href: break
-        url, params = next_href, None
-    return rows, headers
-
-def fetch_positions(doc: dict, headers: dict):
-    # если expand не дал rows, берём по ссылке
+    # позиции сразу в списке: expand работает только при limit<=100
+    params = {"expand": "positions,store", "filter": filt}
+    return [doc async for doc in ms.paged("/entity/enter", limit=100, params=params)]
+
+def _positions_complete(doc: dict) -> bool:
+    pos = doc.get("positions") or {}
+    rows = pos.get("rows")
+    return rows is not None and len(rows) >= ((pos.get("meta") or {}).get("size") or 0)
+
+async def fetch_positions(ms: MSClient, doc: dict):
+    # если expand отдал все позиции — запрос не нужен, иначе берём по ссылке
     pos = (doc.get("positions") or {})
-    if "rows" in pos and pos["rows"]:
+    if _positions_complete(doc):
         return pos["rows"]
     href = (pos.get("meta") or {}).get("href")
     if not href:
         return []
-    out = []
-    url = href
-    params = {"limit": 1000}
-    while True:
-        data = _jget(url, headers=headers, params=params)
-        out.extend(data.get("rows", []))
-        next_href = (data.get("meta") or {}).get("nextHref")
-        if not next_href: break
-        url, params = next_href, None
-    return out
+    return [p async for p in ms.paged(href)]
+
+# документов, чьи позиции дочитываются параллельно; темп запросов всё равно держит лимитер клиента
+CONCURRENCY = int(os.getenv("ENTER_CONCURRENCY") or 8)
+
+async def iter_positions(ms: MSClient, docs: list, concurrency: int = CONCURRENCY):
+    """(doc, positions) по мере готовности: развёрнутые — сразу, остальные — параллельными запросами."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(doc):
+        async with sem:
+            return doc, await fetch_positions(ms, doc)
+
+    ready = [doc for doc in docs if _positions_complete(doc)]
+    tasks = [asyncio.create_task(one(doc)) for doc in docs if not _positions_complete(doc)]
+    # ошибка или брошенный генератор — недочитанные запросы снимаем, чтобы не висели на лимитере
+    try:
+        for doc in ready:
+            yield doc, doc["positions"]["rows"]
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
 
 def last_uuid_from_href(href: str):
     try:
@@ -78,11 +75,17 @@ def last_uuid_from_href(href: str):
         return None
 
 
-def upsert_positions(db, day: dt.date, doc: dict, positions: list):
+COLUMNS = ("position_id", "doc_id", "date", "warehouse_id", "product_id", "qty", "price", "cost", "inventory_based")
+UPDATE = COLUMNS[1:]
+
+# позиций в одной пачке COPY -> upsert; переопределяется INFLOW_BATCH_SIZE
+BATCH_SIZE = int(os.getenv("INFLOW_BATCH_SIZE") or 20_000)
+
+def position_rows(day: dt.date, doc: dict, positions: list):
     # поля: position_id (uuid PK), doc_id (uuid), date, warehouse_id(uuid), product_id(uuid), qty, price, cost, inventory_based
     doc_id = doc.get("id")
     moment = (doc.get("moment") or "")[:10]
-    date = moment or day.isoformat()
+    date = dt.date.fromisoformat(moment) if moment else day
     wh_id = None
     store = doc.get("store")
     if store and "meta" in store:
@@ -90,24 +93,6 @@ def upsert_positions(db, day: dt.date, doc: dict, positions: list):
 
     inv_flag = bool(doc.get("inventory"))
 
-    ins = text("""
-        INSERT INTO inflow_item_fact
-          (position_id, doc_id, date, warehouse_id, product_id, qty, price, cost, inventory_based)
-        VALUES
-          (:position_id, :doc_id, :date, :warehouse_id, :product_id, :qty, :price, :cost, :inventory_based)
-        ON CONFLICT (position_id) DO UPDATE SET
-          doc_id = EXCLUDED.doc_id,
-          date = EXCLUDED.date,
-          warehouse_id = EXCLUDED.warehouse_id,
-          product_id = EXCLUDED.product_id,
-          qty = EXCLUDED.qty,
-          price = EXCLUDED.price,
-          cost = EXCLUDED.cost,
-          inventory_based = EXCLUDED.inventory_based,
-          updated_at = now()
-    """)
-
-    n = 0
     for p in positions:
         pid = p.get("id")
         ass = p.get("assortment") or {}
@@ -120,13 +105,13 @@ def upsert_positions(db, day: dt.date, doc: dict, positions: list):
         sum_cents = p.get("sum")  # может быть None или 0
 
         # цена в рублях
-        price = Decimal(price_cents) / Decimal(100)
+        price = Decimal(str(price_cents)) / Decimal(100)
 
         # если sum пустой или 0, считаем total = price * qty
         if not sum_cents or int(sum_cents) == 0:
             total = price * qty
         else:
-            total = Decimal(sum_cents) / Decimal(100)
+            total = Decimal(str(sum_cents)) / Decimal(100)
 
         # нормализация округлений
         price = price.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
@@ -136,19 +121,33 @@ def upsert_positions(db, day: dt.date, doc: dict, positions: list):
         if not pid or not prod_id or not wh_id:
             continue
 
-        db.execute(ins, {
-            "position_id": pid,
-            "doc_id": doc_id,
-            "date": date,
-            "warehouse_id": wh_id,
-            "product_id": prod_id,
-            "qty": float(qty),
-            "price": float(price),
-            "cost": float(total),
-            "inventory_based": inv_flag,
-        })
-        n += 1
-    return n
+        yield (pid, doc_id, date, wh_id, prod_id, qty, price, total, inv_flag)
+
+async def load_day(ms: MSClient, day: dt.date, batch_size: int = BATCH_SIZE) -> tuple[int, int]:
+    """
+    Позиции оприходований за день -> inflow_item_fact: сначала все позиции дня из МС в память,
+    затем одной транзакцией COPY + set-based upsert пачками по batch_size. Возвращает (документов, позиций).
+    Коннект синхронного engine не держим через await — иначе параллельные дни сверх пула блокируют цикл событий.
+    """
+    docs = await fetch_enters_day(ms, day)
+    print(f"[enter] {day}: {len(docs)} документов")
+    rows: list[tuple] = []
+    async for d, positions in iter_positions(ms, docs):
+        rows.extend(position_rows(day, d, positions))
+    with engine.begin() as conn:
+        # день заменяется целиком — удалённые в МС документы и позиции уходят из фактов
+        conn.execute(text("DELETE FROM inflow_item_fact WHERE date = :d"), {"d": day})
+        with CopyUpsert(conn, "inflow_item_fact", COLUMNS, "position_id", UPDATE, batch_size=batch_size) as cu:
+            for row in rows:
+                cu.write(row)
+        notify_changed(conn, [(None, day, day)])
+    return len(docs), cu.written
+
+async def _load(day: dt.date, token: str):
+    async with MSClient(token=token) as ms:
+        _, n = await load_day(ms, day)
+    print(f"[done] upsert позиций: {n}")
+
 def main():
     day_s = os.getenv("DAY") or os.getenv("START")
     if not day_s:
@@ -157,21 +156,7 @@ def main():
     token = _env("MS_TOKEN") or _env("MS_API_TOKEN")
     if not token:
         raise SystemExit("Нет MS_TOKEN/MS_API_TOKEN ни в окружении, ни в .env")
-
-    docs, headers = fetch_enters_day(day, token)
-    print(f"[enter] {day}: {len(docs)} документов")
-
-    total_pos = 0
-    with SessionLocal() as db:
-        db.execute(text("SELECT 1"))
-        for i, d in enumerate(docs, 1):
-            rows = fetch_positions(d, headers)
-            cnt = upsert_positions(db, day, d, rows)
-            total_pos += cnt
-            if i % 5 == 0:
-                db.commit()
-        db.commit()
-    print(f"[done] upsert позиций: {total_pos}")
+    asyncio.run(_load(day, token))
 
 if __name__ == "__main__":
     main()
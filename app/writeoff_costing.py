@@ -0,0 +1,100 @@
+import asyncio
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, List
+from .assortment_cache import price_cache, buy_minor, norm_href
+from .ms_client import MSClient
+
+# документов списания, считаемых одновременно; темп запросов держит общий лимитер клиента
+DOC_CONCURRENCY = 8
+
+def _kop(v: Any) -> int:
+    """Денежное поле МС (копейки, число или {'value': ..}) -> целые копейки."""
+    return buy_minor(v)
+
+def _qty(p: Dict[str, Any]) -> Decimal:
+    try:
+        return Decimal(str(p.get("quantity") or 0))
+    except Exception:
+        return Decimal(0)
+
+def _mul(kop_per_unit: int, qty: Decimal) -> int:
+    return int((Decimal(kop_per_unit) * qty).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def needs_buy_price(p: Dict[str, Any]) -> bool:
+    return _kop(p.get("sum")) <= 0 and _kop(p.get("price")) <= 0
+
+def position_cost_kop(p: Dict[str, Any], buy_kop: int = 0) -> int:
+    """
+    Себестоимость позиции списания в копейках. Один порядок для всех:
+    positions.sum -> price * quantity -> buyPrice * quantity (buy_kop — из кэша цен).
+    """
+    s = _kop(p.get("sum"))
+    if s > 0:
+        return s
+    qty = _qty(p)
+    price = _kop(p.get("price"))
+    if price > 0:
+        return _mul(price, qty)
+    ass = p.get("assortment") or {}
+    buy = _kop(ass.get("buyPrice")) or buy_kop
+    return _mul(buy, qty)
+
+async def position_buy_kop(ms: MSClient, p: Dict[str, Any]) -> int:
+    """buyPrice позиции в копейках: из expand, иначе через кэш цен (variant без цены -> товар)."""
+    ass = p.get("assortment") or {}
+    bp = _kop(ass.get("buyPrice"))
+    if bp > 0:
+        return bp
+    href = norm_href((ass.get("meta") or {}).get("href"))
+    return await price_cache.buy_price(ms, href) if href else 0
+
+async def fetch_positions(ms: MSClient, doc_href: str) -> List[Dict[str, Any]]:
+    # expand работает только при limit<=100
+    base = norm_href(doc_href)
+    return [p async for p in ms.paged(f"{base}/positions", limit=100, params={"expand": "assortment"})]
+
+async def costs_for_positions(ms: MSClient, positions: List[Dict[str, Any]]) -> List[int]:
+    """Копейки по каждой позиции; цены для позиций без sum/price подтягиваются одним пакетом."""
+    need = [p for p in positions if needs_buy_price(p)]
+    for p in need:
+        price_cache.observe(p.get("assortment"))
+    if need:
+        hrefs = []
+        for p in need:
+            ass = p.get("assortment") or {}
+            hrefs.append((ass.get("meta") or {}).get("href"))
+            hrefs.append(((ass.get("product") or {}).get("meta") or {}).get("href"))
+        await price_cache.prefetch(ms, [h for h in hrefs if h])
+    out = []
+    for p in positions:
+        buy = await position_buy_kop(ms, p) if needs_buy_price(p) else 0
+        out.append(position_cost_kop(p, buy))
+    return out
+
+async def document_cost_kop(ms: MSClient, doc_href: str) -> int:
+    """Себестоимость документа списания в копейках."""
+    return sum(await costs_for_positions(ms, await fetch_positions(ms, doc_href)))
+
+async def documents_cost_kop(ms: MSClient, doc_hrefs: List[str], concurrency: int = DOC_CONCURRENCY) -> List[int]:
+    """Себестоимость нескольких документов параллельно (не больше concurrency сразу), порядок сохраняется."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(href: str) -> int:
+        async with sem:
+            return await document_cost_kop(ms, href)
+
+    return list(await asyncio.gather(*[one(h) for h in doc_hrefs]))
+
+async def documents_positions(ms: MSClient, doc_hrefs: List[str],
+                              concurrency: int = DOC_CONCURRENCY) -> List[List[Dict[str, Any]]]:
+    """Позиции нескольких документов параллельно (не больше concurrency сразу), порядок сохраняется."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(href: str) -> List[Dict[str, Any]]:
+        async with sem:
+            return await fetch_positions(ms, href)
+
+    return list(await asyncio.gather(*[one(h) for h in doc_hrefs]))
+
+def kop_to_rub(kop: int) -> Decimal:
+    return (Decimal(kop) / Decimal(100)).quantize(Decimal("0.01"))
@@ -0,0 +1,43 @@
+from typing import Any, Dict
+
+# корзины списаний: код (колонки writeoff_cost_*) -> название
+# (writeoff_item.reason, writeoff_daily_reason.reason, литералы в rollup._SQL)
+REASON_NAMES = {"defect": "Брак", "inventory": "Инвентаризация", "other": "Прочее"}
+
+def _value_text(val) -> str:
+    # значение доп. поля: строка/число или элемент справочника {"name": ...}
+    if isinstance(val, dict):
+        return str(val.get("name") or "")
+    return str(val or "")
+
+def doc_reason(doc: Dict[str, Any]) -> str:
+    """
+    Текст причины списания из документа loss (нужен expand=attributes):
+    поле «причина …»/«reason …», иначе любое поле со словами брак/инвентаризация,
+    иначе «инвент» в названии или комментарии документа. Пусто — причина неизвестна.
+    """
+    attrs = doc.get("attributes") or []
+    for a in attrs:
+        name = str(a.get("name") or "").lower()
+        if "причин" in name or "reason" in name:
+            return _value_text(a.get("value"))
+    for a in attrs:
+        val = _value_text(a.get("value"))
+        low = val.lower()
+        if "брак" in low or "инвент" in low:
+            return val
+    if "инвент" in (doc.get("name") or "").lower() or "инвент" in (doc.get("description") or "").lower():
+        return REASON_NAMES["inventory"]
+    return ""
+
+def bucket_for_reason(value: str) -> str:
+    """Текст причины -> код корзины; неизвестная или пустая причина — other."""
+    v = (value or "").strip().lower()
+    if "инвент" in v:
+        return "inventory"
+    if "брак" in v:
+        return "defect"
+    return "other"
+
+def doc_bucket(doc: Dict[str, Any]) -> str:
+    return bucket_for_reason(doc_reason(doc))
@@ -0,0 +1,31 @@
+"""add sync_checkpoint
+
+Revision ID: 3f1c7a9e2b10
+Revises: 25b5e5da6480
+Create Date: 2026-10-17 09:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '3f1c7a9e2b10'
+down_revision = '25b5e5da6480'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'sync_checkpoint',
+        sa.Column('job', sa.String(64), nullable=False),
+        sa.Column('warehouse_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('status', sa.String(16), nullable=False),
+        sa.Column('rows', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('duration_s', sa.Numeric(10, 3), nullable=False, server_default='0'),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('job', 'warehouse_id', 'day'),
+    )
+
+def downgrade():
+    op.drop_table('sync_checkpoint')
@@ -0,0 +1,25 @@
+"""add sync_watermark
+
+Revision ID: 8d4e2b6c1a57
+Revises: 3f1c7a9e2b10
+Create Date: 2026-10-17 10:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '8d4e2b6c1a57'
+down_revision = '3f1c7a9e2b10'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'sync_watermark',
+        sa.Column('entity', sa.String(64), primary_key=True),
+        sa.Column('updated_from', sa.String(32), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+
+def downgrade():
+    op.drop_table('sync_watermark')
@@ -0,0 +1,30 @@
+"""add assortment_price
+
+Revision ID: c5a0f7d93e21
+Revises: 8d4e2b6c1a57
+Create Date: 2026-10-17 11:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'c5a0f7d93e21'
+down_revision = '8d4e2b6c1a57'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'assortment_price',
+        sa.Column('href', sa.String(255), primary_key=True),
+        sa.Column('kind', sa.String(16), nullable=False),
+        sa.Column('product_href', sa.String(255), nullable=True),
+        sa.Column('buy_price', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('ms_updated', sa.String(32), nullable=True),
+        sa.Column('fetched_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+    op.create_index('ix_assortment_price_kind_updated', 'assortment_price', ['kind', 'ms_updated'])
+
+def downgrade():
+    op.drop_index('ix_assortment_price_kind_updated', table_name='assortment_price')
+    op.drop_table('assortment_price')
@@ -0,0 +1,50 @@
+"""add sales_monthly / sales_yearly
+
+Revision ID: e2b94d6f0a18
+Revises: c5a0f7d93e21
+Create Date: 2026-10-17 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = 'e2b94d6f0a18'
+down_revision = 'c5a0f7d93e21'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    'revenue', 'cost', 'discount', 'returns_cost', 'inflow_cost',
+    'writeoff_cost_total', 'writeoff_cost_defect', 'writeoff_cost_inventory', 'writeoff_cost_other',
+)
+
+def _table(name: str, key: str):
+    op.create_table(
+        name,
+        sa.Column(key, sa.Date(), nullable=False),
+        sa.Column('warehouse_id', sa.Integer(), sa.ForeignKey('warehouse.id', ondelete='RESTRICT'), nullable=False),
+        *[sa.Column(c, sa.Numeric(16, 2), nullable=False, server_default='0') for c in COLUMNS],
+        sa.Column('receipts_count', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint(key, 'warehouse_id'),
+    )
+
+def upgrade():
+    _table('sales_monthly', 'month')
+    _table('sales_yearly', 'year')
+    # начальное заполнение из того, что уже лежит в sales_daily
+    cols = ', '.join(COLUMNS + ('receipts_count',))
+    sums = ', '.join(f'SUM({c})' for c in COLUMNS + ('receipts_count',))
+    op.execute(f"""
+        INSERT INTO sales_monthly (month, warehouse_id, {cols})
+        SELECT date_trunc('month', date)::date, warehouse_id, {sums}
+          FROM sales_daily GROUP BY 1, 2
+    """)
+    op.execute(f"""
+        INSERT INTO sales_yearly (year, warehouse_id, {cols})
+        SELECT date_trunc('year', month)::date, warehouse_id, {sums}
+          FROM sales_monthly GROUP BY 1, 2
+    """)
+
+def downgrade():
+    op.drop_table('sales_yearly')
+    op.drop_table('sales_monthly')
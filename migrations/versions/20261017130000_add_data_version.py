@@ -0,0 +1,29 @@
+"""add data_version
+
+Revision ID: 7a3c51e8d294
+Revises: e2b94d6f0a18
+Create Date: 2026-10-17 13:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '7a3c51e8d294'
+down_revision = 'e2b94d6f0a18'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.execute("CREATE SEQUENCE data_version_seq")
+    op.create_table(
+        'data_version',
+        sa.Column('month', sa.Date(), nullable=False),
+        sa.Column('warehouse_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('month', 'warehouse_id'),
+    )
+
+def downgrade():
+    op.drop_table('data_version')
+    op.execute("DROP SEQUENCE data_version_seq")
@@ -0,0 +1,33 @@
+"""writeoff_item.reason: text -> bucket name
+
+Revision ID: 4b8e2f6a9c13
+Revises: 7a3c51e8d294
+Create Date: 2026-10-17 14:00:00
+
+"""
+from alembic import op
+
+revision = '4b8e2f6a9c13'
+down_revision = '7a3c51e8d294'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # writeoff_item создаётся загрузчиком, а не миграциями — на пустой базе таблицы может не быть.
+    # Свободный текст приводим к корзинам по правилу writeoff_reasons.bucket_for_reason
+    op.execute("""
+        DO $$
+        BEGIN
+            IF to_regclass('writeoff_item') IS NOT NULL THEN
+                UPDATE writeoff_item
+                   SET reason = CASE WHEN lower(reason) LIKE '%инвент%' THEN 'Инвентаризация'
+                                     WHEN lower(reason) LIKE '%брак%' THEN 'Брак'
+                                     ELSE 'Прочее' END
+                 WHERE reason IS NULL OR reason NOT IN ('Брак', 'Инвентаризация', 'Прочее');
+            END IF;
+        END $$
+    """)
+
+def downgrade():
+    # исходный текст причин не сохраняется
+    pass
@@ -0,0 +1,26 @@
+"""add data_topic_version
+
+Revision ID: 9e6d3a1c7f42
+Revises: 4b8e2f6a9c13
+Create Date: 2026-10-17 15:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '9e6d3a1c7f42'
+down_revision = '4b8e2f6a9c13'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'data_topic_version',
+        sa.Column('topic', sa.String(length=32), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('topic'),
+    )
+
+def downgrade():
+    op.drop_table('data_topic_version')
@@ -0,0 +1,60 @@
+import asyncio
+import json
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import httpx
+import pytest
+
+from app import writeoff_costing
+from app.assortment_cache import AssortmentPriceCache
+from app.ms_client import BASE, MSClient, RateLimiter
+
+FIXTURES = Path(__file__).parent / "fixtures" / "moysklad"
+_BASE_PATH = urlsplit(BASE).path
+
+
+def load_fixture(name: str) -> dict:
+    return json.loads((FIXTURES / name).read_text(encoding="utf-8"))
+
+
+class RecordedMS:
+    """
+    Записанные ответы МоегоСклада через настоящий MSClient: путь запроса (без базы API) -> файл фикстуры.
+    delays — задержка ответа по пути, чтобы документы завершались не в порядке запуска.
+    """
+
+    def __init__(self, routes: dict[str, str], delays: dict[str, float] | None = None):
+        self.routes = routes
+        self.delays = delays or {}
+        self.requests: list[str] = []
+        self.in_flight = 0
+        self.peak = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path[len(_BASE_PATH):]
+        self.requests.append(path)
+        if path not in self.routes:
+            return httpx.Response(404, json={"errors": [{"error": f"no fixture for {path}"}]})
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get(path, 0))
+            return httpx.Response(200, json=load_fixture(self.routes[path]))
+        finally:
+            self.in_flight -= 1
+
+    def client(self) -> MSClient:
+        ms = MSClient(limiter=RateLimiter(limit=10_000, interval=1.0, reserve=0), max_attempts=1)
+        ms._client = httpx.AsyncClient(base_url=BASE, transport=httpx.MockTransport(self.handler))
+        return ms
+
+
+@pytest.fixture
+def price_cache(monkeypatch):
+    """Пустой кэш цен без БД: всё, чего нет в памяти, берётся из записанных ответов МС."""
+    cache = AssortmentPriceCache()
+    monkeypatch.setattr(cache, "_load_db", lambda hrefs: {})
+    monkeypatch.setattr(cache, "_save_db", lambda entries: None)
+    monkeypatch.setattr(writeoff_costing, "price_cache", cache)
+    return cache
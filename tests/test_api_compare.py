@@ -0,0 +1,80 @@
+import re
+from datetime import date
+
+from sqlalchemy.dialects import postgresql
+
+from app.api import COMPARE_BUCKETS, _compare_ranges, _compare_result, _compare_stmt, _year_ago, summary_span
+
+
+def sql(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def pieces(stmt) -> list[tuple[str, str, str, str]]:
+    # (bucket, таблица, from, to) каждой ветки union
+    out = []
+    for part in sql(stmt).split("UNION ALL"):
+        m = re.search(r"'(\w+)' AS bucket\s+FROM (\w+)\s+WHERE \w+\.\w+ BETWEEN '([\d-]+)' AND '([\d-]+)'", part)
+        out.append(m.groups())
+    return out
+
+
+def test_ranges_previous_period_and_year_ago():
+    r = _compare_ranges(date(2025, 3, 1), date(2025, 3, 10))
+    assert r == {
+        "current": (date(2025, 3, 1), date(2025, 3, 10)),
+        "previous": (date(2025, 2, 19), date(2025, 2, 28)),
+        "previous_year": (date(2024, 3, 1), date(2024, 3, 10)),
+    }
+
+
+def test_year_ago_clamps_feb_29():
+    assert _year_ago(date(2024, 2, 29)) == date(2023, 2, 28)
+    assert _compare_ranges(date(2024, 2, 1), date(2024, 2, 29))["previous_year"] == (date(2023, 2, 1), date(2023, 2, 28))
+
+
+def test_summary_span_covers_all_buckets():
+    assert summary_span(date(2025, 3, 1), date(2025, 3, 10)) == (date(2024, 3, 1), date(2025, 3, 10))
+
+
+def test_compare_stmt_reads_each_bucket_from_rollups():
+    # 75 дней: полные январь-февраль — из месяцев, март — из дней; предыдущие 75 дней и год назад — так же
+    assert pieces(_compare_stmt(date(2024, 1, 1), date(2024, 3, 15), None)) == [
+        ("current", "sales_monthly", "2024-01-01", "2024-02-01"),
+        ("current", "sales_daily", "2024-03-01", "2024-03-15"),
+        ("previous", "sales_monthly", "2023-11-01", "2023-12-01"),
+        ("previous", "sales_daily", "2023-10-18", "2023-10-31"),
+        ("previous_year", "sales_monthly", "2023-01-01", "2023-02-01"),
+        ("previous_year", "sales_daily", "2023-03-01", "2023-03-15"),
+    ]
+
+
+def test_compare_stmt_one_filtered_sum_per_bucket_and_metric():
+    text = sql(_compare_stmt(date(2025, 3, 1), date(2025, 3, 10), None))
+    for b in COMPARE_BUCKETS:
+        assert text.count(f"FILTER (WHERE src.bucket = '{b}')") == 6
+    assert "GROUP BY" not in text.split("FROM (")[0]
+
+
+def test_compare_stmt_by_warehouse_filters_and_groups():
+    text = sql(_compare_stmt(date(2025, 3, 1), date(2025, 3, 10), [3, 5], by_warehouse=True))
+    assert text.rstrip().endswith("GROUP BY src.warehouse_id")
+    assert text.count("warehouse_id IN (3, 5)") == 3
+
+
+def test_compare_result_shapes_buckets():
+    class Row:
+        pass
+
+    row = Row()
+    for b in COMPARE_BUCKETS:
+        for k in ("revenue", "cost", "discount", "returns_cost", "inflow_cost"):
+            setattr(row, f"{b}_{k}", None)
+        setattr(row, f"{b}_receipts", None)
+    row.current_revenue = 10
+    row.current_receipts = 2
+    out = _compare_result(row)
+    assert set(out) == set(COMPARE_BUCKETS)
+    assert out["current"]["revenue"] == 10.0 and out["current"]["receipts"] == 2
+    assert out["previous"] == {"revenue": 0.0, "cost": 0.0, "discount": 0.0, "returns_cost": 0.0,
+                               "inflow_cost": 0.0, "receipts": 0}
@@ -0,0 +1,27 @@
+import datetime as dt
+
+from app import api, main
+
+D1, D2 = dt.date(2025, 10, 1), dt.date(2025, 10, 7)
+
+
+def test_sort_column_is_whitelisted():
+    stmt, params = api._top_products_v3_query(D1, D2, sort_by="revenue; DROP TABLE product", order="asc")
+    assert "ORDER BY revenue ASC" in str(stmt)
+    assert params["start"] == D1 and params["min_qty"] == 0.0
+    # по имени сортирует только v2 — в v3 имени нет
+    assert "ORDER BY name DESC" in str(api._top_products_v2_query(D1, D2, sort_by="name")[0])
+    assert "ORDER BY revenue" in str(api._top_products_v3_query(D1, D2, sort_by="name")[0])
+
+
+def test_inflow_items_warehouse_filter_is_optional():
+    stmt, _ = api._inflow_items_query(D1, D2, None, 10)
+    assert ":wh" not in str(stmt)
+    stmt, params = api._inflow_items_query(D1, D2, "wh-uuid", 10)
+    assert ":wh" in str(stmt) and params["wh"] == "wh-uuid"
+
+
+def test_routes_are_registered_once():
+    paths = [r.path for r in main.app.routes if getattr(r, "path", "").startswith("/api/")]
+    for path in ("/api/inflow/items", "/api/top/products_v2", "/api/top/products_v3"):
+        assert paths.count(path) == 1
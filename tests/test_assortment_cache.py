@@ -0,0 +1,82 @@
+import contextlib
+
+from app import assortment_cache
+from app.assortment_cache import AssortmentPriceCache, Entry
+
+H1, H2, H3 = (f"https://api/entity/product/{i}" for i in (1, 2, 3))
+
+
+class FakeDB:
+    """select старых цен -> old; upsert ... RETURNING -> written (только то, что пропустил WHERE)."""
+
+    def __init__(self, old, written):
+        self.old = old
+        self.written = written
+        self.commits = 0
+
+    def execute(self, stmt, params=None):
+        if stmt.is_insert:
+            return iter(self.written)
+        return FakeResult(self.old)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+def patch_db(monkeypatch, db, notified):
+    monkeypatch.setattr(assortment_cache, "SessionLocal", lambda: contextlib.nullcontext(db))
+    monkeypatch.setattr(assortment_cache, "notify_prices_changed", lambda conn: notified.append(conn))
+
+
+def entries(*pairs):
+    return {h: Entry("product", None, p, "2025-10-01 10:00:00") for h, p in pairs}
+
+
+def test_changed_counts_only_rows_returned_by_upsert(monkeypatch):
+    # H2 отброшен WHERE (в БД более свежий updated) — его цена не считается изменённой
+    db = FakeDB(old=[(H1, 100), (H2, 200)], written=[(H1, 150), (H3, 5)])
+    patch_db(monkeypatch, db, [])
+    cache = AssortmentPriceCache()
+    assert cache._save_db(entries((H1, 150), (H2, 999), (H3, 5))) == 2
+
+
+def test_unchanged_price_is_not_counted(monkeypatch):
+    db = FakeDB(old=[(H1, 100)], written=[(H1, 100)])
+    patch_db(monkeypatch, db, [])
+    assert AssortmentPriceCache()._save_db(entries((H1, 100))) == 0
+
+
+def test_one_notification_per_run(monkeypatch):
+    notified = []
+    db = FakeDB(old=[], written=[(H1, 100)])
+    patch_db(monkeypatch, db, notified)
+    cache = AssortmentPriceCache()
+    # несколько записей за прогон (entry/prefetch/observe) — без уведомлений
+    cache._save_db(entries((H1, 100)))
+    cache._save_db(entries((H1, 100)))
+    assert notified == []
+    cache.flush()
+    assert len(notified) == 1
+    # нечего сообщать — повторный flush молчит
+    cache.flush()
+    assert len(notified) == 1
+
+
+def test_observe_threshold_writes_without_notifying(monkeypatch):
+    notified, saved = [], []
+    monkeypatch.setattr(assortment_cache, "notify_prices_changed", lambda conn: notified.append(conn))
+    cache = AssortmentPriceCache()
+    monkeypatch.setattr(cache, "_save_db", lambda e: saved.append(len(e)) or 0)
+    for i in range(1000):
+        cache.observe({"meta": {"type": "product", "href": f"https://api/entity/product/{i}"},
+                       "buyPrice": {"value": 1}, "updated": "2025-10-01 10:00:00"})
+    assert saved == [1000]
+    assert notified == []
@@ -0,0 +1,72 @@
+import asyncio
+import datetime as dt
+from types import SimpleNamespace
+
+from app import backfill_async as bf
+
+M = dt.date(2025, 10, 1)
+
+
+class FakeWriter:
+    def __init__(self, db):
+        self.rows = []
+        self.flushed = []
+
+    def add(self, day, warehouse_id, **values):
+        self.rows.append((day, warehouse_id))
+
+    def flush(self):
+        self.flushed.extend(self.rows)
+        self.rows.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def run(monkeypatch, tasks, behaviour):
+    writers, marks = [], []
+
+    def make_writer(db):
+        writers.append(FakeWriter(db))
+        return writers[-1]
+
+    async def run_task(ms, t):
+        delay, fail = behaviour[(t.w.id, t.metric)]
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("boom")
+        return [(t.day, {"revenue": 1})]
+
+    monkeypatch.setattr(bf, "SalesDailyWriter", make_writer)
+    monkeypatch.setattr(bf, "run_task", run_task)
+    monkeypatch.setattr(bf, "mark", lambda job, wh, day, status, *a, **kw: marks.append((wh, status)))
+    failed = asyncio.run(bf.run_tasks(None, None, tasks, workers=4))
+    return failed, writers[0].flushed, marks
+
+
+def test_failed_unit_rows_are_not_written(monkeypatch):
+    w1, w2 = SimpleNamespace(id=1, name="A"), SimpleNamespace(id=2, name="B")
+    tasks = [bf.Task(w1, M, M, "sales"), bf.Task(w1, M, M, "profit"),
+             bf.Task(w2, M, M, "sales"), bf.Task(w2, M, M, "profit")]
+    # у склада 1 sales готов раньше, чем падает profit
+    behaviour = {(1, "sales"): (0, False), (1, "profit"): (0.02, True),
+                 (2, "sales"): (0.01, False), (2, "profit"): (0.01, False)}
+    failed, flushed, marks = run(monkeypatch, tasks, behaviour)
+    assert failed == 1
+    assert {wh for _, wh in flushed} == {2}
+    assert (1, "error") in marks and (1, "ok") not in marks
+    assert (2, "ok") in marks
+
+
+def test_task_in_flight_when_unit_fails_is_dropped(monkeypatch):
+    w1 = SimpleNamespace(id=1, name="A")
+    tasks = [bf.Task(w1, M, M, "profit"), bf.Task(w1, M, M, "sales")]
+    # profit падает сразу, sales ещё в работе и завершается позже
+    behaviour = {(1, "profit"): (0, True), (1, "sales"): (0.02, False)}
+    failed, flushed, marks = run(monkeypatch, tasks, behaviour)
+    assert failed == 1
+    assert flushed == []
+    assert marks.count((1, "error")) == 1
@@ -0,0 +1,78 @@
+import datetime as dt
+import json
+from types import SimpleNamespace
+
+from app.data_changes import (
+    ALL_WAREHOUSES, DataVersions, parse_payload, payload_topic, spans_from_cells,
+)
+
+D = dt.date
+T = [dt.datetime(2025, 10, i, tzinfo=dt.timezone.utc) for i in range(1, 10)]
+
+
+def row(month, wh, version, t):
+    return SimpleNamespace(month=month, warehouse_id=wh, version=version, updated_at=t)
+
+
+def versions(rows, topics=()) -> DataVersions:
+    v = DataVersions()
+    v._query = lambda where="", params=None: rows
+    v._query_topics = lambda topic=None: [SimpleNamespace(topic=k, version=n, updated_at=t) for k, n, t in topics]
+    v.load()
+    return v
+
+
+ROWS = [
+    row(D(2025, 9, 1), 1, 5, T[0]),
+    row(D(2025, 10, 1), 1, 7, T[1]),
+    row(D(2025, 10, 1), 2, 9, T[2]),
+    row(D(2025, 11, 1), ALL_WAREHOUSES, 8, T[3]),
+]
+
+
+def test_stamp_all_warehouses_takes_max_per_month():
+    v = versions(ROWS)
+    assert v.stamp(D(2025, 9, 15), D(2025, 10, 2)) == (9, T[2])
+    assert v.stamp(D(2025, 9, 1), D(2025, 9, 30)) == (5, T[0])
+
+
+def test_stamp_for_warehouses_includes_all_warehouses_rows():
+    v = versions(ROWS)
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31), [1]) == (7, T[1])
+    # изменение «по всем складам» (warehouse_id=0) меняет тег и у отдельного склада
+    assert v.stamp(D(2025, 10, 1), D(2025, 11, 30), [1]) == (8, T[3])
+
+
+def test_stamp_without_versions_is_zero():
+    v = versions(ROWS)
+    assert v.stamp(D(2024, 1, 1), D(2024, 12, 31)) == (0, None)
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31), [42]) == (0, None)
+
+
+def test_stamp_crosses_year_boundary():
+    v = versions([row(D(2025, 12, 1), 1, 3, T[0]), row(D(2026, 1, 1), 1, 4, T[1])])
+    assert v.stamp(D(2025, 12, 31), D(2026, 1, 1), [1]) == (4, T[1])
+
+
+def test_stamp_topics_raise_version_only_when_asked():
+    v = versions(ROWS, topics=[("prices", 20, T[5])])
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31)) == (9, T[2])
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31), None, ("prices",)) == (20, T[5])
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31), None, ("other",)) == (9, T[2])
+
+
+def test_reload_applies_newer_versions():
+    v = versions(ROWS)
+    v._query = lambda where="", params=None: [row(D(2025, 10, 1), 1, 11, T[4])]
+    v.reload([(1, D(2025, 10, 3), D(2025, 10, 3))])
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31), [1]) == (11, T[4])
+    assert v.stamp(D(2025, 10, 1), D(2025, 10, 31)) == (11, T[4])
+
+
+def test_payloads_and_spans():
+    assert parse_payload(json.dumps([[1, "2025-10-01", "2025-10-02"], [None, "2025-10-03", "2025-10-03"]])) == [
+        (1, D(2025, 10, 1), D(2025, 10, 2)), (None, D(2025, 10, 3), D(2025, 10, 3))]
+    assert payload_topic(json.dumps({"topic": "prices"})) == "prices"
+    assert payload_topic("[]") is None
+    cells = [(D(2025, 10, 5), 1), (D(2025, 10, 1), 1), (D(2025, 10, 3), 2)]
+    assert sorted(spans_from_cells(cells)) == [(1, D(2025, 10, 1), D(2025, 10, 5)), (2, D(2025, 10, 3), D(2025, 10, 3))]
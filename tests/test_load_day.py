@@ -0,0 +1,83 @@
+import asyncio
+import contextlib
+import datetime as dt
+
+from app.tools import load_enter_day, load_retail_day
+
+DAY = dt.date(2025, 10, 1)
+
+
+class FakeCopy:
+    def __init__(self, log, *a, **kw):
+        self.log = log
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, row):
+        self.log.append(("write", row[0]))
+        self.written += 1
+
+
+class FakeConn:
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, stmt, params=None):
+        self.log.append(("sql", str(stmt).split()[0], params["d"]))
+
+
+def patch_db(monkeypatch, module, log):
+    @contextlib.contextmanager
+    def begin():
+        log.append("begin")
+        yield FakeConn(log)
+        log.append("commit")
+
+    monkeypatch.setattr(module.engine, "begin", begin, raising=False)
+    monkeypatch.setattr(module, "CopyUpsert", lambda *a, **kw: FakeCopy(log, *a, **kw))
+    monkeypatch.setattr(module, "notify_changed", lambda conn, spans: log.append("notify"))
+
+
+def test_retail_day_takes_connection_only_after_all_pages(monkeypatch):
+    log = []
+    patch_db(monkeypatch, load_retail_day, log)
+    store = {"meta": {"href": "https://x/entity/store/wh1"}}
+
+    async def pages(ms, day):
+        for i in range(2):
+            await asyncio.sleep(0)
+            log.append(("page", i))
+            yield {"id": f"d{i}", "store": store}, [
+                {"id": f"p{i}", "assortment": {"meta": {"href": "https://x/entity/product/a"}}, "quantity": 1}
+            ]
+
+    monkeypatch.setattr(load_retail_day, "iter_retail_day", pages)
+    docs, n = asyncio.run(load_retail_day.load_day(None, DAY))
+    assert (docs, n) == (2, 2)
+    # день заменяется целиком: DELETE в той же транзакции, что и COPY
+    assert log == [("page", 0), ("page", 1), "begin", ("sql", "DELETE", DAY), ("write", "p0"), ("write", "p1"), "notify", "commit"]
+
+
+def test_enter_day_takes_connection_only_after_all_positions(monkeypatch):
+    log = []
+    patch_db(monkeypatch, load_enter_day, log)
+    store = {"meta": {"href": "https://x/entity/store/wh1"}}
+    docs = [{"id": "d1", "moment": "2025-10-01 10:00:00", "store": store}]
+
+    async def fetch_docs(ms, day):
+        return docs
+
+    async def positions(ms, docs):
+        await asyncio.sleep(0)
+        log.append("positions")
+        yield docs[0], [{"id": "p1", "assortment": {"meta": {"href": "https://x/entity/product/a"}}, "quantity": 2}]
+
+    monkeypatch.setattr(load_enter_day, "fetch_enters_day", fetch_docs)
+    monkeypatch.setattr(load_enter_day, "iter_positions", positions)
+    assert asyncio.run(load_enter_day.load_day(None, DAY)) == (1, 1)
+    assert log == ["positions", "begin", ("sql", "DELETE", DAY), ("write", "p1"), "notify", "commit"]
@@ -0,0 +1,112 @@
+import datetime as dt
+
+import pytest
+
+from app import period_rollup
+from app.period_rollup import period_lock_keys, refresh_periods, split_range
+
+D = dt.date
+
+
+# --- split_range ---
+
+def test_full_years_months_and_edge_days():
+    out = split_range(D(2023, 11, 15), D(2025, 2, 10))
+    assert out == {
+        "year": [(D(2024, 1, 1), D(2024, 1, 1))],
+        "month": [(D(2023, 12, 1), D(2023, 12, 1)), (D(2025, 1, 1), D(2025, 1, 1))],
+        "day": [(D(2023, 11, 15), D(2023, 11, 30)), (D(2025, 2, 1), D(2025, 2, 10))],
+    }
+
+
+def test_adjacent_years_are_merged():
+    out = split_range(D(2022, 1, 1), D(2024, 12, 31))
+    assert out == {"year": [(D(2022, 1, 1), D(2024, 1, 1))], "month": [], "day": []}
+
+
+def test_adjacent_months_are_merged_when_years_are_not_allowed():
+    out = split_range(D(2024, 1, 1), D(2024, 12, 31), coarsest="month")
+    assert out == {"year": [], "month": [(D(2024, 1, 1), D(2024, 12, 1))], "day": []}
+
+
+def test_day_only_splits_by_month_but_merges_spans():
+    out = split_range(D(2024, 1, 20), D(2024, 3, 5), coarsest="day")
+    assert out == {"year": [], "month": [], "day": [(D(2024, 1, 20), D(2024, 3, 5))]}
+
+
+def test_single_day_and_leap_february():
+    assert split_range(D(2024, 2, 29), D(2024, 2, 29))["day"] == [(D(2024, 2, 29), D(2024, 2, 29))]
+    assert split_range(D(2024, 2, 1), D(2024, 2, 29))["month"] == [(D(2024, 2, 1), D(2024, 2, 1))]
+
+
+def test_empty_range():
+    assert split_range(D(2024, 3, 2), D(2024, 3, 1)) == {"year": [], "month": [], "day": []}
+
+
+@pytest.mark.parametrize("start, end", [
+    (D(2023, 11, 15), D(2025, 2, 10)),
+    (D(2024, 1, 1), D(2024, 1, 31)),
+    (D(2019, 12, 31), D(2021, 1, 1)),
+    (D(2024, 2, 28), D(2024, 3, 1)),
+])
+def test_pieces_cover_every_day_exactly_once(start, end):
+    # rollup-консистентность: суммы по кускам = сумма по дням, только если дни не теряются и не дублируются
+    out = split_range(start, end)
+    days = []
+    for a, b in out["year"]:
+        y = a
+        while y <= b:
+            days += [y + dt.timedelta(days=i) for i in range((D(y.year + 1, 1, 1) - y).days)]
+            y = D(y.year + 1, 1, 1)
+    for a, b in out["month"]:
+        m = a
+        while m <= b:
+            nxt = D(m.year + (m.month == 12), m.month % 12 + 1, 1)
+            days += [m + dt.timedelta(days=i) for i in range((nxt - m).days)]
+            m = nxt
+    for a, b in out["day"]:
+        days += [a + dt.timedelta(days=i) for i in range((b - a).days + 1)]
+    assert sorted(days) == [start + dt.timedelta(days=i) for i in range((end - start).days + 1)]
+    assert len(days) == len(set(days))
+
+
+# --- refresh_periods ---
+
+class FakeDB:
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, stmt, params=None):
+        self.calls.append((str(stmt), params))
+
+
+def test_refresh_locks_periods_before_recomputing(monkeypatch):
+    notified = []
+    monkeypatch.setattr(period_rollup, "notify_changed", lambda db, spans: notified.append(spans))
+    db = FakeDB()
+    cells = [(D(2025, 1, 5), 2), (D(2024, 12, 31), 1), (D(2025, 1, 20), 2)]
+    assert refresh_periods(db, cells) == 2
+    assert [c[0] for c in db.calls] == [period_rollup._LOCK, period_rollup._MONTHLY, period_rollup._YEARLY]
+    assert db.calls[0][1] == {"keys": period_lock_keys([(D(2024, 12, 1), 1), (D(2025, 1, 1), 2)])}
+    assert db.calls[1][1] == {"periods": [D(2024, 12, 1), D(2025, 1, 1)], "whs": [1, 2]}
+    assert db.calls[2][1] == {"periods": [D(2024, 1, 1), D(2025, 1, 1)], "whs": [1, 2]}
+    assert len(notified) == 1
+
+
+def test_lock_keys_are_sorted_unique_and_cover_year():
+    keys = period_lock_keys([(D(2025, 3, 1), 7), (D(2025, 1, 1), 7), (D(2025, 1, 1), 7)])
+    assert keys == sorted(set(keys))
+    assert keys == [7 * 100000 + 2025 * 13, 7 * 100000 + 2025 * 13 + 1, 7 * 100000 + 2025 * 13 + 3]
+
+
+def test_lock_keys_do_not_collide_across_years_and_warehouses():
+    months = [(D(y, m, 1), wh) for y in (2019, 2020, 2030) for m in range(1, 13) for wh in (1, 2, 300)]
+    keys = period_lock_keys(months)
+    assert len(keys) == len(months) + 3 * 3
+    assert max(keys) < 2 ** 31
+
+
+def test_refresh_without_cells_does_nothing():
+    db = FakeDB()
+    assert refresh_periods(db, []) == 0
+    assert db.calls == []
@@ -0,0 +1,97 @@
+import asyncio
+import datetime as dt
+
+import orjson
+
+from app.response_cache import MISS, ResponseCache, cached_endpoint, make_key, response_cache, scope
+
+D = dt.date
+OCT = scope(D(2025, 10, 1), D(2025, 10, 31))
+
+
+def test_make_key_ignores_order_defaults_and_list_order():
+    a = make_key("x", {"start": "2025-10-01", "warehouse_id": [2, 1], "group": None})
+    b = make_key("x", {"warehouse_id": (1, 2), "start": "2025-10-01", "limit": ""})
+    assert a == b
+
+
+def test_lru_evicts_by_entries_and_bytes():
+    c = ResponseCache(max_entries=2)
+    for k in "abc":
+        c.put((k,), b"{}", OCT)
+    assert c.get(("a",)) is MISS and c.get(("c",)) == b"{}"
+
+    c = ResponseCache(max_bytes=10)
+    c.put(("a",), b"12345", OCT)
+    c.put(("b",), b"12345", OCT)
+    c.get(("a",))                       # a — свежая, вытесняется b
+    c.put(("c",), b"1", OCT)
+    assert c.get(("b",)) is MISS and c.get(("a",)) == b"12345"
+
+
+def test_put_with_stale_epoch_is_dropped():
+    c = ResponseCache()
+    epoch = c.epoch()
+    c.invalidate([(None, D(2025, 1, 1), D(2025, 1, 1))])
+    c.put(("a",), b"{}", OCT, epoch)
+    assert c.get(("a",)) is MISS
+    c.put(("a",), b"{}", OCT, c.epoch())
+    assert c.get(("a",)) == b"{}"
+
+
+def test_invalidate_matches_dates_and_warehouses():
+    c = ResponseCache()
+    c.put(("all",), b"1", OCT)
+    c.put(("wh1",), b"1", scope(D(2025, 10, 1), D(2025, 10, 31), 1))
+    c.put(("wh2",), b"1", scope(D(2025, 10, 1), D(2025, 10, 31), [2, 3]))
+    c.put(("sep",), b"1", scope(D(2025, 9, 1), D(2025, 9, 30)))
+    assert c.invalidate([(1, D(2025, 10, 5), D(2025, 10, 5))]) == 2
+    assert c.get(("wh2",)) == b"1" and c.get(("sep",)) == b"1"
+    # None — изменение по всем складам
+    assert c.invalidate([(None, D(2025, 10, 31), D(2025, 11, 2))]) == 1
+    assert c.get(("sep",)) == b"1"
+
+
+def test_invalidate_topic_drops_only_dependent_entries():
+    c = ResponseCache()
+    c.put(("top",), b"1", scope(D(2025, 10, 1), D(2025, 10, 31), None, ("prices",)))
+    c.put(("summary",), b"1", OCT)
+    assert c.invalidate_topic("prices") == 1
+    assert c.get(("top",)) is MISS and c.get(("summary",)) == b"1"
+
+
+def test_cached_renders_once_and_skips_errors():
+    c = ResponseCache()
+    calls = []
+    assert c.cached("e", {"a": 1}, OCT, lambda: calls.append(1) or {"v": 1}) == b'{"v":1}'
+    assert c.cached("e", {"a": 1}, OCT, lambda: calls.append(1) or {"v": 2}) == b'{"v":1}'
+    assert calls == [1]
+    err = object()
+    assert c.cached("e", {"a": 2}, OCT, lambda: err) is err
+    assert c.get(make_key("e", {"a": 2})) is MISS
+
+
+def test_cached_endpoint_sync_async_and_bad_dates():
+    response_cache.clear()
+    calls = []
+
+    @cached_endpoint("t_sync")
+    def sync_ep(start, end, session=None):
+        calls.append("sync")
+        return {"start": start}
+
+    @cached_endpoint("t_async")
+    async def async_ep(start, end, session=None):
+        calls.append("async")
+        return {"start": start}
+
+    try:
+        for _ in range(2):
+            assert orjson.loads(sync_ep(start="2025-10-01", end="2025-10-02", session=object()).body) == {"start": "2025-10-01"}
+            assert orjson.loads(asyncio.run(async_ep(start="2025-10-01", end="2025-10-02")).body) == {"start": "2025-10-01"}
+        assert calls == ["sync", "async"]
+        # кривые даты — мимо кэша, эндпоинт отвечает сам
+        assert sync_ep(start="bad", end="2025-10-02") == {"start": "bad"}
+        assert calls[-1] == "sync"
+    finally:
+        response_cache.clear()
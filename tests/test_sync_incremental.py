@@ -0,0 +1,20 @@
+import datetime as dt
+
+from app.sync_incremental import MS_TZ, repull_cells
+
+
+def test_repull_covers_every_store_for_last_days():
+    today = dt.date(2025, 3, 1)
+    cells = repull_cells({"s1": object(), "s2": object()}, 3, today)
+    assert cells == {(s, d) for s in ("s1", "s2")
+                     for d in (dt.date(2025, 3, 1), dt.date(2025, 2, 28), dt.date(2025, 2, 27))}
+
+
+def test_repull_disabled_by_default():
+    assert repull_cells({"s1": object()}, 0, dt.date(2025, 3, 1)) == set()
+
+
+def test_moysklad_time_zone_is_moscow():
+    # 22:30 UTC — уже следующий день по Москве (UTC+3)
+    utc = dt.datetime(2025, 3, 1, 22, 30, tzinfo=dt.timezone.utc)
+    assert utc.astimezone(MS_TZ).date() == dt.date(2025, 3, 2)
@@ -0,0 +1,104 @@
+import datetime as dt
+from decimal import Decimal
+
+from app.sync_profit_daily import distribute_profit
+
+D1, D2, D3 = dt.date(2025, 10, 1), dt.date(2025, 10, 2), dt.date(2025, 10, 3)
+DAYS = [D1, D2, D3]
+
+
+def report(sell_qty, sell_cost, sell_price, sell_sum, ret_qty=0, ret_cost=0) -> dict:
+    # суммы отчёта — в копейках, как их отдаёт МойСклад
+    return {
+        "sell_qty": Decimal(sell_qty), "sell_cost": Decimal(sell_cost),
+        "sell_price": Decimal(sell_price), "sell_sum": Decimal(sell_sum),
+        "ret_qty": Decimal(ret_qty), "ret_cost": Decimal(ret_cost),
+    }
+
+
+def test_cost_and_discount_follow_period_averages():
+    # 3 шт. по средней себестоимости 100 руб., средняя цена 200 руб., выручка 190 + 400 = 590
+    by_product = {"a": report(3, 30000, 20000, 59000)}
+    sales = {(D1, "a"): (Decimal(1), Decimal("190")), (D3, "a"): (Decimal(2), Decimal("400"))}
+    result, bad = distribute_profit(by_product, sales, {}, DAYS)
+    assert bad == set()
+    assert result[D1] == (Decimal("100.00"), Decimal("0.00"), Decimal("10.00"))
+    assert result[D2] == (Decimal("0.00"), Decimal("0.00"), Decimal("0.00"))
+    assert result[D3] == (Decimal("200.00"), Decimal("0.00"), Decimal("0.00"))
+    # за период — ровно итоги отчёта
+    assert sum(r[0] for r in result.values()) == Decimal("300.00")
+    assert sum(r[2] for r in result.values()) == Decimal("10.00")
+
+
+def test_returns_are_spread_by_return_qty():
+    by_product = {"a": report(1, 10000, 20000, 20000, ret_qty=2, ret_cost=18000)}
+    sales = {(D1, "a"): (Decimal(1), Decimal("200"))}
+    returns = {(D2, "a"): Decimal(1), (D3, "a"): Decimal(1)}
+    result, bad = distribute_profit(by_product, sales, returns, DAYS)
+    assert bad == set()
+    assert result[D2][1] == result[D3][1] == Decimal("90.00")
+
+
+def test_qty_mismatch_marks_only_that_products_days():
+    by_product = {"a": report(2, 20000, 10000, 20000), "b": report(1, 5000, 10000, 10000)}
+    sales = {(D1, "a"): (Decimal(1), Decimal("100")), (D2, "b"): (Decimal(1), Decimal("100"))}
+    _, bad = distribute_profit(by_product, sales, {}, DAYS)
+    assert bad == {D1}
+
+
+def test_revenue_mismatch_marks_days_even_when_qty_matches():
+    by_product = {"a": report(1, 10000, 20000, 20000)}
+    sales = {(D2, "a"): (Decimal(1), Decimal("150"))}
+    _, bad = distribute_profit(by_product, sales, {}, DAYS)
+    assert bad == {D2}
+
+
+def test_revenue_rounding_within_a_kopeck_per_row_is_accepted():
+    by_product = {"a": report(2, 20000, 10000, Decimal("20001"))}
+    sales = {(D1, "a"): (Decimal(1), Decimal("100")), (D2, "a"): (Decimal(1), Decimal("100"))}
+    _, bad = distribute_profit(by_product, sales, {}, DAYS)
+    assert bad == set()
+
+
+def test_product_missing_from_facts_fails_whole_period():
+    by_product = {"a": report(1, 10000, 10000, 10000)}
+    result, bad = distribute_profit(by_product, {}, {}, DAYS)
+    assert result == {}
+    assert bad == set(DAYS)
+
+
+def test_sale_missing_from_report_marks_its_day():
+    sales = {(D3, "x"): (Decimal(1), Decimal("100"))}
+    _, bad = distribute_profit({}, sales, {}, DAYS)
+    assert bad == {D3}
+
+
+def test_range_is_clamped_to_days_with_facts(monkeypatch):
+    import asyncio
+    from app import sync_profit_daily as spd
+
+    calls = []
+
+    async def by_product(ms, store, start, end):
+        calls.append(("report", start, end))
+        return {"a": report(1, 10000, 10000, 10000)}
+
+    async def returns(ms, store, start, end):
+        return {}
+
+    async def snapshot(ms, store, day):
+        calls.append(("snapshot", day))
+        return Decimal("1"), Decimal("0"), Decimal("0")
+
+    monkeypatch.setattr(spd, "last_fact_day", lambda db, store, start, end: D2)
+    monkeypatch.setattr(spd, "load_sales_qty_by_day",
+                        lambda db, store, start, end: {(D1, "a"): (Decimal(1), Decimal("100"))})
+    monkeypatch.setattr(spd, "fetch_profit_by_product", by_product)
+    monkeypatch.setattr(spd, "fetch_return_qty_by_day", returns)
+    monkeypatch.setattr(spd, "fetch_profit_snapshot", snapshot)
+
+    result = asyncio.run(spd.fetch_profit_range(None, None, "wh", D1, D3))
+    # отчёт за период — только по D2 включительно, сегодняшний D3 без фактов — дневным снимком
+    assert calls == [("report", D1, D2), ("snapshot", D3)]
+    assert result[D1] == (Decimal("100.00"), Decimal("0.00"), Decimal("0.00"))
+    assert result[D3] == (Decimal("1"), Decimal("0"), Decimal("0"))
@@ -0,0 +1,71 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.db_async import get_async_session
+from app.response_cache import MISS, make_key, response_cache
+
+PARAMS = {"start": "2025-10-01", "end": "2025-10-07"}
+
+
+class FakeSession:
+    async def execute(self, *a, **kw):
+        raise AssertionError("no DB access expected")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    calls = {"live": 0, "local": 0}
+
+    async def live(ms, start, end, store):
+        calls["live"] += 1
+        return [{"product": "live"}]
+
+    async def local(session, s, e, store):
+        calls["local"] += 1
+        return [{"product": "local"}]
+
+    async def session():
+        yield FakeSession()
+
+    monkeypatch.setattr(main, "_top_products_live", live)
+    monkeypatch.setattr(main, "get_top_products_async", local)
+    monkeypatch.setattr(main, "_top_refresh_last", {})
+    main.app.dependency_overrides[get_async_session] = session
+    main.app.state.ms = None
+    response_cache.clear()
+    try:
+        yield TestClient(main.app), calls
+    finally:
+        main.app.dependency_overrides.clear()
+        response_cache.clear()
+
+
+def test_bad_dates_are_400(client):
+    c, _ = client
+    r = c.get("/api/top/products", params={"start": "2025-13-01", "end": "2025-10-07"})
+    assert r.status_code == 400
+
+
+def test_refresh_is_not_cached_and_has_no_etag(client):
+    c, calls = client
+    r = c.get("/api/top/products", params={**PARAMS, "refresh": "1"})
+    assert r.status_code == 200
+    assert r.json()["source"] == "moysklad"
+    assert "etag" not in r.headers
+    key = make_key("top_products", {"start": PARAMS["start"], "end": PARAMS["end"], "warehouse_id": None})
+    assert response_cache.get(key) is MISS
+    # обычный запрос после refresh — локальный результат, а не живой отчёт
+    r = c.get("/api/top/products", params=PARAMS)
+    assert r.json() == {"data": [{"product": "local"}], "source": "local"}
+    assert "etag" in r.headers
+    assert calls == {"live": 1, "local": 1}
+
+
+def test_refresh_is_rate_limited_per_client(client):
+    c, calls = client
+    assert c.get("/api/top/products", params={**PARAMS, "refresh": "1"}).status_code == 200
+    r = c.get("/api/top/products", params={**PARAMS, "refresh": "true"})
+    assert r.status_code == 429
+    assert int(r.headers["retry-after"]) >= 1
+    assert calls["live"] == 1
@@ -0,0 +1,151 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from app.writeoff_costing import (
+    costs_for_positions, documents_cost_kop, documents_positions, kop_to_rub, needs_buy_price, position_cost_kop,
+)
+from .conftest import RecordedMS, load_fixture
+
+LOSS = "/entity/loss/4d1a2c3e-8f9b-11ee-0a80-0d7a00112233"
+DOCS = [f"/entity/loss/6f0a1b2c-8f9b-11ee-0a80-0d7a0000100{i}" for i in range(1, 6)]
+
+
+def positions(name: str = "loss_positions_mixed.json") -> list[dict]:
+    return load_fixture(name)["rows"]
+
+
+# --- position_cost_kop: порядок sum -> price*qty -> buyPrice*qty -> buy_kop ---
+
+def test_sum_wins_over_price_and_buy_price():
+    p = positions()[0]      # sum=12500, price=5000, qty=2.5, buyPrice=3100
+    assert position_cost_kop(p, buy_kop=999) == 12500
+
+
+def test_price_times_qty_when_sum_is_zero():
+    p = positions()[1]      # sum=0, price=333, qty=1.5
+    assert position_cost_kop(p) == 500
+
+
+def test_expanded_buy_price_when_sum_and_price_are_zero():
+    p = positions()[2]      # buyPrice {'value': 101}, qty=0.5
+    assert needs_buy_price(p)
+    assert position_cost_kop(p, buy_kop=999) == 51
+
+
+def test_buy_kop_fallback_without_expanded_buy_price():
+    p = positions()[3]      # модификация без buyPrice, qty=3
+    assert needs_buy_price(p)
+    assert position_cost_kop(p) == 0
+    assert position_cost_kop(p, buy_kop=2000) == 6000
+
+
+# --- округление дробных количеств ---
+
+@pytest.mark.parametrize("price, qty, expected", [
+    (333, "1.5", 500),      # 499.5 -> 500
+    (101, "0.5", 51),       # 50.5 -> 51, а не банковское 50
+    (101, "0.25", 25),      # 25.25 -> 25
+    (3, "0.5", 2),          # 1.5 -> 2
+    (1999, "0.333", 666),   # 665.667 -> 666
+])
+def test_fractional_quantity_rounds_half_up(price, qty, expected):
+    p = {"quantity": float(qty), "price": price, "sum": 0}
+    assert position_cost_kop(p) == expected
+    p = {"quantity": float(qty), "assortment": {"buyPrice": {"value": float(price)}}}
+    assert position_cost_kop(p) == expected
+
+
+def test_missing_or_bad_quantity_costs_zero():
+    assert position_cost_kop({"price": 500}) == 0
+    assert position_cost_kop({"price": 500, "quantity": "n/a"}) == 0
+
+
+# --- денежные поля: {'value': ..} и просто число ---
+
+@pytest.mark.parametrize("field", ["sum", "price"])
+def test_money_value_dict_equals_bare_number(field):
+    bare = {"quantity": 2, field: 1234.0}
+    wrapped = {"quantity": 2, field: {"value": 1234.0}}
+    assert position_cost_kop(bare) == position_cost_kop(wrapped) > 0
+
+
+def test_buy_price_value_dict_equals_bare_number():
+    bare = {"quantity": 4, "assortment": {"buyPrice": 250}}
+    wrapped = {"quantity": 4, "assortment": {"buyPrice": {"value": 250.0, "currency": {}}}}
+    assert position_cost_kop(bare) == position_cost_kop(wrapped) == 1000
+
+
+def test_fractional_kopecks_in_money_field_are_rounded():
+    assert position_cost_kop({"quantity": 1, "sum": {"value": 100.5}}) == 101
+
+
+# --- цена модификации без buyPrice берётся у товара через price_cache ---
+
+def test_variant_without_buy_price_uses_product_price(price_cache):
+    ms_rec = RecordedMS({
+        "/entity/variant": "entity_variant.json",
+        "/entity/product": "entity_product.json",
+    })
+
+    async def run():
+        async with ms_rec.client() as ms:
+            return await costs_for_positions(ms, positions())
+
+    assert asyncio.run(run()) == [12500, 500, 51, 6000]
+    # цены подтянуты одним списочным запросом на вид, без GET на каждый href
+    assert sorted(ms_rec.requests) == ["/entity/product", "/entity/variant"]
+    assert price_cache.stats["fetched"] == 2
+
+
+# --- documents_cost_kop ---
+
+def test_documents_keep_input_order_under_concurrency(price_cache):
+    routes = {f"{d}/positions": f"loss_doc{i}_positions.json" for i, d in enumerate(DOCS, 1)}
+    # первый документ отвечает дольше всех, последний — быстрее всех
+    delays = {f"{d}/positions": 0.05 * (len(DOCS) - i) for i, d in enumerate(DOCS)}
+    ms_rec = RecordedMS(routes, delays)
+
+    async def run():
+        async with ms_rec.client() as ms:
+            return await documents_cost_kop(ms, [d + "?expand=positions" for d in DOCS], concurrency=2)
+
+    # документ i: sum=i*100 + price i * qty 2
+    assert asyncio.run(run()) == [102 * i for i in range(1, 6)]
+    assert ms_rec.peak == 2
+
+
+def test_documents_cost_empty_list(price_cache):
+    async def run():
+        async with RecordedMS({}).client() as ms:
+            return await documents_cost_kop(ms, [])
+
+    assert asyncio.run(run()) == []
+
+
+def test_documents_positions_keep_order_under_concurrency():
+    routes = {f"{d}/positions": f"loss_doc{i}_positions.json" for i, d in enumerate(DOCS, 1)}
+    delays = {f"{d}/positions": 0.05 * (len(DOCS) - i) for i, d in enumerate(DOCS)}
+    ms_rec = RecordedMS(routes, delays)
+
+    async def run():
+        async with ms_rec.client() as ms:
+            return await documents_positions(ms, DOCS, concurrency=3)
+
+    result = asyncio.run(run())
+    assert result == [load_fixture(f"loss_doc{i}_positions.json")["rows"] for i in range(1, 6)]
+    assert ms_rec.peak == 3
+
+
+# --- kop_to_rub ---
+
+@pytest.mark.parametrize("kop, rub", [
+    (0, Decimal("0.00")),
+    (5, Decimal("0.05")),
+    (12345, Decimal("123.45")),
+    (-250, Decimal("-2.50")),
+])
+def test_kop_to_rub(kop, rub):
+    assert kop_to_rub(kop) == rub
+    assert str(kop_to_rub(kop)) == str(rub)
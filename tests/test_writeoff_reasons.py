@@ -0,0 +1,78 @@
+import datetime as dt
+import re
+
+import pytest
+
+from app import rollup
+from app.writeoff_reasons import REASON_NAMES, bucket_for_reason, doc_bucket, doc_reason
+
+
+def loss(*attrs, name="", description="") -> dict:
+    return {"name": name, "description": description,
+            "attributes": [{"name": n, "value": v} for n, v in attrs]}
+
+
+@pytest.mark.parametrize("doc, bucket", [
+    (loss(("ПРИЧИНА СПИСАНИЯ", {"name": "Брак упаковки"})), "defect"),
+    (loss(("Причина", "Инвентаризация")), "inventory"),
+    (loss(("Reason", "Порча")), "other"),
+    # поле без «причин»: решает значение
+    (loss(("Комментарий кладовщика", "брак")), "defect"),
+    (loss(name="Инвентаризация 12.10"), "inventory"),
+    (loss(description="после инвентаризации"), "inventory"),
+    # причина неизвестна — «Прочее», а не «Брак»
+    (loss(), "other"),
+    (loss(("Сотрудник", "Иванов")), "other"),
+])
+def test_doc_bucket(doc, bucket):
+    assert doc_bucket(doc) == bucket
+
+
+def test_reason_field_wins_over_document_name():
+    doc = loss(("Причина списания", "брак"), name="инвентаризация")
+    assert doc_reason(doc) == "брак"
+    assert doc_bucket(doc) == "defect"
+
+
+def test_bucket_for_reason_handles_empty():
+    assert bucket_for_reason(None) == "other"
+    assert bucket_for_reason("  ") == "other"
+
+
+def test_rollup_sql_uses_the_same_bucket_names():
+    # rollup читает writeoff_item.reason как есть — литералы в SQL должны совпадать с REASON_NAMES
+    literals = set(re.findall(r"reason = '([^']+)'", rollup._SQL["writeoff"]))
+    assert literals == set(REASON_NAMES.values())
+
+
+class FakeDB:
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, stmt, params=None):
+        self.calls.append((str(stmt), params))
+
+
+def test_recompute_cells_runs_one_statement_per_part(monkeypatch):
+    refreshed = []
+    monkeypatch.setattr(rollup, "refresh_periods", lambda db, cells: refreshed.append(cells))
+    db = FakeDB()
+    d1, d2 = dt.date(2025, 10, 1), dt.date(2025, 10, 2)
+    n = rollup.recompute_cells(db, [(d2, 1), (d1, 2), (d2, 1)], parts=("sales", "writeoff"))
+    assert n == 2
+    sqls = [c[0] for c in db.calls]
+    assert sqls == [rollup._SQL["sales"], rollup._SQL["writeoff"], rollup._REASON_DELETE, rollup._REASON_INSERT]
+    # ячейки без дублей, отсортированы, параллельными массивами
+    assert db.calls[0][1] == {"days": [d1, d2], "whs": [2, 1]}
+    assert refreshed == [[(d1, 2), (d2, 1)]]
+
+
+def test_recompute_cells_rejects_unknown_part():
+    with pytest.raises(ValueError):
+        rollup.recompute_cells(FakeDB(), [(dt.date(2025, 10, 1), 1)], parts=("sales", "profit"))
+
+
+def test_recompute_cells_without_cells_is_a_no_op():
+    db = FakeDB()
+    assert rollup.recompute_cells(db, []) == 0
+    assert db.calls == []
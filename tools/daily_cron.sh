@@ -10,7 +10,11 @@ set +a
 # нормализуем токен (на всякий)
 if [[ -n "${MS_API_TOKEN:-}" ]]; then export MS_TOKEN="$MS_API_TOKEN"; fi
 
-DAY="$(date -d 'yesterday' +%F)"
-echo "[$(date '+%F %T')] run daily_sync for $DAY"
-tools/daily_sync.sh "$DAY"
-echo "[$(date '+%F %T')] done $DAY"
+PY="./.venv/bin/python"; [ -x "$PY" ] || PY="$(command -v python3)"
+
+# инкрементальный синк: только документы, изменённые с прошлого прогона (отметки в sync_watermark);
+# плюс перезаливка последних REPULL_DAYS дней целиком — удалённые в МС документы в change feed не попадают
+REPULL_DAYS="${REPULL_DAYS:-7}"
+echo "[$(date '+%F %T')] run incremental sync (repull last $REPULL_DAYS days)"
+REPULL_DAYS="$REPULL_DAYS" PYTHONPATH="$PWD" "$PY" -m app.sync_incremental
+echo "[$(date '+%F %T')] done"
@@ -9,10 +9,5 @@ END="${2:-$(date +%F)}"
 
 export PYTHONPATH="$APP_DIR"
 
-echo "== inflow enter positions: $START .. $END =="
-cur="$START"
-while [ "$(date -d "$cur" +%s)" -le "$(date -d "$END" +%s)" ]; do
-  DAY="$cur" "$PY" -m app.tools.load_enter_day
-  echo "[ok] $cur"
-  cur="$(date -I -d "$cur + 1 day")"
-done
+# один процесс на весь диапазон (без LOG_DIR дни перезаливаются всегда)
+"$PY" -m app.tools.backfill_inflow_items "$START" "$END"